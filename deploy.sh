@@ -10,4 +10,23 @@ gcloud config set project $PROJECTID
 
 
 git rev-parse HEAD >static/version.html
+
+# Bundle the discovery documents so clients are built without fetching them.
+# An API whose document can't be fetched is still deployed: util/clients.py
+# falls back to fetching its document at runtime.
+mkdir -p discovery
+for API in dataproc/v1 monitoring/v3 pubsub/v1 compute/v1; do
+ DOCUMENT=discovery/${API/\//.}.json
+ if ! curl -sf https://www.googleapis.com/discovery/v1/apis/$API/rest \
+  -o $DOCUMENT.tmp; then
+  rm -f $DOCUMENT.tmp $DOCUMENT
+  echo Failed to fetch $API discovery document, it is fetched at runtime instead
+  continue
+ fi
+ mv $DOCUMENT.tmp $DOCUMENT
+done
 gcloud app deploy -q app.yaml cron.yaml queue.yaml
+# The pull worker service is only needed with SHAMASH_CONSUMER_MODE: pull
+if grep -q "SHAMASH_CONSUMER_MODE: pull" app.yaml; then
+ gcloud app deploy -q worker.yaml
+fi
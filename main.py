@@ -1,15 +1,22 @@
 """Entry point for Shamash."""
+import time
+
+IMPORT_TIME = time.time()
+
 import logging
+import threading
 
 import flask_admin
-from flask import Flask, request, redirect
+from flask import Flask, Response, jsonify, request, redirect
 from google.appengine.api import taskqueue
+from googleapiclient.errors import HttpError
 
-from model import settings
-from monitoring import dataproc_monitoring, metrics
-from scaling import scaling, scaling_decisions
-from util import utils, pubsub
+from model import provisioning, settings
+from monitoring import dataproc_monitoring, metrics, scheduler
+from scaling import pipeline, resizer, scaling, scaling_decisions, worker
+from util import config, instrumentation, tracing, utils, pubsub
 from view.AdminCustomView import AdminCustomView
+from view.DashboardView import DashboardView
 
 app = Flask(__name__)
 
@@ -17,36 +24,146 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = '123456790'
 app.config['FLASK_ADMIN_SWATCH'] = 'slate'
 
+_bootstrap_lock = threading.Lock()
+_bootstrapped = False
+
 
 def create_app():
     """
-    Do initialization
+    Register the admin views. Nothing here may call out to the network, the
+    one time setup is done by bootstrap().
     """
-
-    hostname = utils.get_host_name()
     admin = flask_admin.Admin(
         app, 'Admin', base_template='layout.html', template_mode='bootstrap3')
 
     admin.add_view(AdminCustomView(settings.Settings))
-    logging.info("Starting Shamash on %s", hostname)
-    clusters = settings.get_all_clusters_settings()
-    for cluster in clusters.iter():
-        met = metrics.Metrics(cluster.Cluster)
-        met.init_metrics()
+    admin.add_view(DashboardView(name='Dashboard', endpoint='dashboard'))
+
+
+def provision(hostname):
+    """
+    Create the metric descriptors, topics, subscriptions and push
+    endpoints, or remove the endpoints in pull mode.
+
+    :return: whether every metric descriptor is there, Pub/Sub failures
+    raise
+    """
+    # The descriptors are per project, the cluster is only a label
+    met = metrics.Metrics(None)
+    descriptors_ok = met.init_metrics()
 
     client = pubsub.get_pubsub_client()
     pubsub.create_topic(client, 'shamash-monitoring')
     pubsub.create_topic(client, 'shamash-scaling')
     pubsub.create_subscriptions(client, 'monitoring', 'shamash-monitoring')
     pubsub.create_subscriptions(client, 'scaling', 'shamash-scaling')
+    if config.CONSUMER_MODE == 'pull':
+        # Drop the push endpoints, the worker service pulls
+        pubsub.pull(client, 'monitoring', None)
+        pubsub.pull(client, 'scaling', None)
+        return descriptors_ok
     pubsub.pull(client, 'monitoring',
                 'https://shamash-dot-{}/get_monitoring_data'.format(hostname))
     pubsub.pull(client, 'scaling', "https://shamash-dot-{}/scale".format(hostname))
+    return descriptors_ok
+
+
+def bootstrap():
+    """
+    Do initialization once per instance, skipping the setup if it already
+    succeeded for this version and host.
+    """
+    global _bootstrapped
+    if _bootstrapped:
+        return
+    with _bootstrap_lock:
+        if _bootstrapped:
+            return
+        started = time.time()
+        hostname = utils.get_host_name()
+        logging.info("Starting Shamash on %s", hostname)
+        # The worker service takes the consumer mode the default service
+        # provisioned instead of setting up the subscriptions itself
+        if not worker.is_worker_service() and \
+                not provisioning.is_provisioned():
+            # Serve anyway when something failed, the next instance will
+            # try again
+            try:
+                provisioned = provision(hostname)
+            except (pubsub.PubSubException, HttpError) as e:
+                logging.error(e)
+                provisioned = False
+            if provisioned:
+                provisioning.mark_provisioned()
+            else:
+                logging.warning('Provisioning incomplete, not marking it')
+        _bootstrapped = True
+        logging.info('Cold start took %.3fs, bootstrap %.3fs',
+                     time.time() - IMPORT_TIME, time.time() - started)
 
 
 create_app()
 
 
+@app.before_request
+def before_request():
+    """Trace the request and make sure the instance is initialized."""
+    tracing.start(request.endpoint, cluster=request.args.get('cluster_name'))
+    bootstrap()
+
+
+@app.after_request
+def after_request(response):
+    """Log the trace of the request and write the instrumentation counts to
+    Stackdriver when it is time."""
+    tracing.finish(status=response.status_code)
+    if instrumentation.flush_due(config.INSTRUMENTATION_FLUSH_SECONDS):
+        instrumentation.flush(metrics.TimeSeriesBatch())
+    return response
+
+
+@app.teardown_request
+def teardown_request(exception):
+    """Log the trace of a request that failed before after_request."""
+    tracing.finish(error=str(exception) if exception else None)
+
+
+@app.route('/_ah/warmup')
+def warmup():
+    """
+    Warmup request, initialize before serving traffic
+    :return:
+    """
+    bootstrap()
+    return '', 200
+
+
+@app.route('/_ah/start')
+def start():
+    """
+    Start of a shamash-worker instance, pulls the subscriptions until the
+    instance stops
+    :return:
+    """
+    consumer_mode = provisioning.get_consumer_mode()
+    if consumer_mode != 'pull':
+        logging.error('The subscriptions are provisioned for %s mode, not '
+                      'pulling them', consumer_mode)
+        return '', 404
+    worker.run()
+    return '', 200
+
+
+@app.route('/_ah/stop')
+def stop():
+    """
+    Stop of a shamash-worker instance
+    :return:
+    """
+    worker.stop()
+    return '', 200
+
+
 @app.route('/')
 def index():
     """
@@ -62,6 +179,9 @@ def get_monitoring_data():
     After data is gathered from cluster into pub sub this function is invoked
     :return:
     """
+    if config.PIPELINE_MODE == 'direct':
+        # /monitors already decided, the topic is only a fan out
+        return 'OK', 204
     return scaling_decisions.should_scale(request.json['message']['data'])
 
 
@@ -71,12 +191,24 @@ def scale():
     Called when decide  to scale is made
     :return:
     """
-    try:
-        scaler = scaling.Scale(request.json['message']['data'])
-    except scaling.ScalingException as e:
-        logging.info(e)
-        return 'error', 500
-    return scaler.do_scale()
+    return scaling.scale_message(request.json['message']['data'])
+
+
+@app.route('/preview', methods=['GET'])
+def preview():
+    """
+    Show what scaling would do to the clusters now, without doing it
+    :return:
+    """
+    cluster_names = request.args.getlist('cluster_name')
+    clusters = [
+        cluster for cluster in settings.get_all_clusters_settings()
+        if cluster.Cluster in cluster_names or
+        (not cluster_names and cluster.Enabled)
+    ]
+    decisions = scaling.preview(clusters)
+    return jsonify(
+        {'decisions': [decision.to_dict() for decision in decisions]})
 
 
 @app.route('/tasks/check-load')
@@ -84,7 +216,13 @@ def check_load():
     """Entry point for cron task that launches a task for each cluster
     check cluster stats"""
     clusters = settings.get_all_clusters_settings()
-    for cluster in clusters.iter():
+    if config.MONITORING_MODE == 'adaptive':
+        return scheduler.ensure_polling(clusters)
+    if config.MONITORING_MODE == 'region':
+        return check_load_by_region(clusters)
+    if config.MONITORING_MODE == 'batch':
+        return check_load_in_batches(clusters)
+    for cluster in clusters:
         if cluster.Enabled :
             task = taskqueue.add(queue_name='shamash',
                              url="/monitors",
@@ -97,6 +235,41 @@ def check_load():
     return 'ok', 200
 
 
+def check_load_by_region(clusters):
+    """Launch a task for each region with enabled clusters."""
+    regions = set()
+    for cluster in clusters:
+        if cluster.Enabled:
+            regions.add(cluster.Region)
+        else:
+            logging.debug("Cluster %s is disabled.", cluster.Cluster)
+    for region in regions:
+        task = taskqueue.add(queue_name='shamash',
+                             url="/monitors/region",
+                             method='GET',
+                             params={'region': region})
+        logging.debug('Task %s enqueued, ETA %s.', task.name, task.eta)
+    return 'ok', 200
+
+
+def check_load_in_batches(clusters):
+    """Launch a task for each batch of enabled clusters."""
+    names = []
+    for cluster in clusters:
+        if cluster.Enabled:
+            names.append(cluster.Cluster)
+        else:
+            logging.debug("Cluster %s is disabled.", cluster.Cluster)
+    for i in range(0, len(names), config.MONITORING_BATCH_SIZE):
+        task = taskqueue.add(
+            queue_name='shamash',
+            url="/monitors/batch",
+            method='GET',
+            params={'cluster_name': names[i:i + config.MONITORING_BATCH_SIZE]})
+        logging.debug('Task %s enqueued, ETA %s.', task.name, task.eta)
+    return 'ok', 200
+
+
 @app.route('/monitors', methods=['GET'])
 def monitors():
     """
@@ -104,30 +277,80 @@ def monitors():
     :return:
     """
     dp = dataproc_monitoring.DataProc(request.args.get('cluster_name'))
-    return dp.check_load()
+    return dp.check_load(pipeline.handle_monitor_data)
+
+
+@app.route('/monitors/region', methods=['GET'])
+def monitors_region():
+    """
+    called by task to check all the clusters of a region at once
+    :return:
+    """
+    region = request.args.get('region')
+    return dataproc_monitoring.check_region_load(
+        region, settings.get_region_clusters_settings(region),
+        pipeline.handle_monitor_data)
+
+
+@app.route('/monitors/batch', methods=['GET'])
+def monitors_batch():
+    """
+    called by task to check a batch of clusters concurrently
+    :return:
+    """
+    return dataproc_monitoring.check_clusters_load(
+        request.args.getlist('cluster_name'), pipeline.handle_monitor_data)
+
+
+@app.route('/monitors/poll', methods=['GET'])
+def monitors_poll():
+    """
+    called by task to check a cluster and schedule its next check
+    :return:
+    """
+    return scheduler.poll(request.args.get('cluster_name'),
+                          int(request.args.get('generation')),
+                          int(request.args.get('sequence')),
+                          pipeline.handle_monitor_data)
 
 
 @app.route('/patch', methods=['GET'])
 def patch():
     """
-    called by task to do the actual cluster update
+    called by task to start the actual cluster update
     :return:
     """
-    new_workers = int(request.args.get('new_workers'))
-    new_preemptible = int(request.args.get('new_preemptible'))
     cluster_name = request.args.get('cluster_name')
     logging.debug('Task Starting for  %s', cluster_name)
-    dp = dataproc_monitoring.DataProc(cluster_name)
-    logging.debug('Patching new_workers %s new_preemptible %s', new_workers,
-                  new_preemptible)
     try:
-        logging.debug('Start Patching %s', cluster_name)
-        dp.patch_cluster(new_workers, new_preemptible)
-        logging.debug('Done Patching %s', cluster_name)
+        return resizer.start_resize(cluster_name)
     except dataproc_monitoring.DataProcException as e:
         logging.error(e)
         return 'error', 500
-    return 'ok', 200
+
+
+@app.route('/patch/poll', methods=['GET'])
+def patch_poll():
+    """
+    called by task to follow a cluster update until it is done
+    :return:
+    """
+    try:
+        return resizer.poll_resize(request.args.get('cluster_name'),
+                                   request.args.get('operation'))
+    except dataproc_monitoring.DataProcException as e:
+        logging.error(e)
+        return 'error', 500
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Latency, call, retry and error counts of this instance for Prometheus
+    :return:
+    """
+    return Response(instrumentation.render(),
+                    content_type=instrumentation.PROMETHEUS_CONTENT_TYPE)
 
 
 @app.route('/favicon.ico')
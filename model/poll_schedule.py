@@ -0,0 +1,30 @@
+"""Schedule of the adaptive monitoring of a cluster."""
+from google.appengine.ext import ndb
+
+
+class PollSchedule(ndb.Model):
+    """The chain of /monitors/poll tasks of a cluster.
+
+    Keyed by the cluster name. A new chain gets a new Generation, Sequence is
+    the poll the chain expects next, so a retried or duplicated task can tell
+    it was superseded.
+    """
+    Generation = ndb.IntegerProperty(default=0, indexed=False)
+    Sequence = ndb.IntegerProperty(default=0, indexed=False)
+    IntervalSeconds = ndb.IntegerProperty(indexed=False)
+    NextPollAt = ndb.DateTimeProperty(indexed=False)
+    # What the last successful poll saw
+    ContainersPending = ndb.IntegerProperty(indexed=False)
+    MemoryAvailablePct = ndb.FloatProperty(indexed=False)
+
+    def is_current(self, generation, sequence):
+        return self.Generation == generation and self.Sequence == sequence
+
+
+def get_schedule(cluster_name):
+    """
+    Get the poll schedule of a cluster.
+
+    :return: PollSchedule or None if the cluster was never polled
+    """
+    return PollSchedule.get_by_id(cluster_name)
@@ -0,0 +1,78 @@
+"""Record of the one time setup done by Shamash."""
+import datetime
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from util import config, utils
+
+# Bump when the topics, subscriptions, push endpoints or metric descriptors
+# that Shamash sets up change so that the next instance provisions again.
+PROVISIONING_VERSION = 2
+
+MARKER_ID = 'shamash'
+MEMCACHE_KEY = 'shamash-provisioned'
+
+_provisioned_marker = None
+
+
+class Provisioning(ndb.Model):
+    """Singleton marking that the Pub/Sub and metrics setup succeeded."""
+    Marker = ndb.StringProperty(indexed=False)
+    ProvisionedAt = ndb.DateTimeProperty(indexed=False)
+
+
+def _current_marker():
+    return '{}:{}:{}'.format(PROVISIONING_VERSION, utils.get_host_name(),
+                             config.CONSUMER_MODE)
+
+
+def is_provisioned():
+    """
+    Check whether this version of the setup already succeeded.
+
+    :return: bool
+    """
+    global _provisioned_marker
+    marker = _current_marker()
+    if _provisioned_marker == marker:
+        return True
+    stored = memcache.get(MEMCACHE_KEY)
+    if stored is None:
+        entity = Provisioning.get_by_id(MARKER_ID)
+        if entity is None:
+            return False
+        stored = entity.Marker
+        memcache.set(MEMCACHE_KEY, stored)
+    if stored == marker:
+        _provisioned_marker = marker
+        return True
+    return False
+
+
+def get_consumer_mode():
+    """
+    Get the consumer mode the subscriptions were last provisioned for.
+
+    :return: 'push', 'pull' or None if nothing was provisioned yet
+    """
+    stored = memcache.get(MEMCACHE_KEY)
+    if stored is None:
+        entity = Provisioning.get_by_id(MARKER_ID)
+        if entity is None:
+            return None
+        stored = entity.Marker
+    return stored.rsplit(':', 1)[-1]
+
+
+def mark_provisioned():
+    """Record that the setup succeeded."""
+    global _provisioned_marker
+    marker = _current_marker()
+    Provisioning(
+        id=MARKER_ID, Marker=marker,
+        ProvisionedAt=datetime.datetime.utcnow()).put()
+    memcache.set(MEMCACHE_KEY, marker)
+    _provisioned_marker = marker
+    logging.info('Provisioning %s recorded', marker)
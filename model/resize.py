@@ -0,0 +1,240 @@
+"""Progress of cluster resizes.
+
+Each cluster has at most one resize at a time. Its ResizeState is the lease:
+a decision can only lead to a patch after claiming it, and every change is
+made in a transaction so concurrent decisions, patch tasks and polls never
+overwrite each other.
+"""
+import datetime
+import logging
+
+from google.appengine.ext import ndb
+
+# A /patch task is scheduled for the target
+PENDING = 'pending'
+# The patch was sent, its operation is followed by /patch/poll
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Outcomes of claim()
+CLAIMED = 'claimed'
+REPLACED = 'replaced'
+QUEUED = 'queued'
+STABILIZING = 'stabilizing'
+
+# A pending lease whose /patch task didn't run by then is free again
+PENDING_TIMEOUT_SECONDS = 5 * 60
+# A running lease whose operation didn't finish by then is free again, even
+# when its /patch/poll tasks were dropped
+RESIZE_TIMEOUT_SECONDS = 60 * 60
+
+
+class ResizeState(ndb.Model):
+    """The resize in flight, or the last one, of a cluster.
+
+    Keyed by the cluster name.
+    """
+    State = ndb.StringProperty(indexed=False)
+    OperationName = ndb.StringProperty(indexed=False)
+    Workers = ndb.IntegerProperty(indexed=False)
+    Preemptibles = ndb.IntegerProperty(indexed=False)
+    Direction = ndb.StringProperty(indexed=False)
+    # Worker groups to patch once the current operation is done
+    RemainingChanges = ndb.JsonProperty(indexed=False)
+    # When the cluster data the resize was decided on was read, epoch seconds
+    ObservedAt = ndb.FloatProperty(indexed=False)
+    PendingSince = ndb.DateTimeProperty(indexed=False)
+    PatchAfter = ndb.DateTimeProperty(indexed=False)
+    StartedAt = ndb.DateTimeProperty(indexed=False)
+    FinishedAt = ndb.DateTimeProperty(indexed=False)
+    DurationSeconds = ndb.FloatProperty(indexed=False)
+    Polls = ndb.IntegerProperty(default=0, indexed=False)
+    Error = ndb.TextProperty()
+    # The latest decision made while the resize is running
+    QueuedWorkers = ndb.IntegerProperty(indexed=False)
+    QueuedPreemptibles = ndb.IntegerProperty(indexed=False)
+    QueuedDirection = ndb.StringProperty(indexed=False)
+    QueuedObservedAt = ndb.FloatProperty(indexed=False)
+
+    @property
+    def in_flight(self):
+        return self.State == RUNNING
+
+    @property
+    def elapsed_seconds(self):
+        return (datetime.datetime.utcnow() - self.StartedAt).total_seconds()
+
+    @property
+    def pending_expired(self):
+        return (datetime.datetime.utcnow() - self.PatchAfter).total_seconds() > \
+            PENDING_TIMEOUT_SECONDS
+
+    @property
+    def running_expired(self):
+        return self.elapsed_seconds > RESIZE_TIMEOUT_SECONDS
+
+    def _set_target(self, workers, preemptibles, direction, observed_at):
+        self.Workers = workers
+        self.Preemptibles = preemptibles
+        self.Direction = direction
+        self.ObservedAt = observed_at
+
+    def _clear_queue(self):
+        self.QueuedWorkers = None
+        self.QueuedPreemptibles = None
+        self.QueuedDirection = None
+        self.QueuedObservedAt = None
+
+
+def get_state(cluster_name):
+    """
+    Get the resize state of a cluster.
+
+    :return: ResizeState or None if Shamash never resized it
+    """
+    return ResizeState.get_by_id(cluster_name)
+
+
+def _is_reversal(state, direction, now, stabilization_seconds):
+    """Whether direction turns back a resize that is running or just done."""
+    if state.Direction is None or direction == state.Direction:
+        return False
+    if state.State in (PENDING, RUNNING):
+        return True
+    return state.FinishedAt is not None and \
+        (now - state.FinishedAt).total_seconds() < stabilization_seconds
+
+
+@ndb.transactional
+def claim(cluster_name, workers, preemptibles, direction, observed_at,
+          cooldown_seconds, stabilization_seconds):
+    """
+    Ask to resize a cluster.
+
+    A free cluster is leased to the caller, who must schedule /patch after
+    the returned countdown, the end of the cooldown of the last resize. A
+    decision for a cluster that waits for its patch replaces the target, one
+    for a cluster being resized is queued for after it, replacing any queued
+    one. Decisions that would reverse a resize that is running or finished
+    less than stabilization_seconds ago are dropped. Leases whose /patch
+    task or operation polls were lost are released once they time out.
+
+    :param direction: 'up' or 'down'
+    :param observed_at: epoch seconds the data of the decision was read
+    :return: outcome, countdown in seconds when CLAIMED
+    """
+    now = datetime.datetime.utcnow()
+    state = ResizeState.get_by_id(cluster_name)
+    if state is None:
+        state = ResizeState(id=cluster_name)
+    elif state.State == PENDING and state.pending_expired:
+        logging.warning('Patch of %s never ran, releasing it', cluster_name)
+        state.State = FAILED
+        state.Error = 'Patch task lost'
+    elif state.State == RUNNING and state.running_expired:
+        logging.warning('Resize of %s is running for %.0fs, releasing it',
+                        cluster_name, state.elapsed_seconds)
+        state.State = FAILED
+        state.Error = 'Operation {} timed out'.format(state.OperationName)
+        state.FinishedAt = now
+        state.DurationSeconds = state.elapsed_seconds
+    elif _is_reversal(state, direction, now, stabilization_seconds):
+        return STABILIZING, None
+
+    if state.State == PENDING:
+        state._set_target(workers, preemptibles, direction, observed_at)
+        state.put()
+        return REPLACED, None
+    if state.State == RUNNING:
+        state.QueuedWorkers = workers
+        state.QueuedPreemptibles = preemptibles
+        state.QueuedDirection = direction
+        state.QueuedObservedAt = observed_at
+        state.put()
+        return QUEUED, None
+
+    countdown = 0
+    if state.FinishedAt is not None:
+        countdown = max(0, cooldown_seconds -
+                        (now - state.FinishedAt).total_seconds())
+    state._set_target(workers, preemptibles, direction, observed_at)
+    state.State = PENDING
+    state.PendingSince = now
+    state.PatchAfter = now + datetime.timedelta(seconds=countdown)
+    state.OperationName = None
+    state.RemainingChanges = None
+    state.Error = None
+    state._clear_queue()
+    state.put()
+    return CLAIMED, countdown
+
+
+@ndb.transactional
+def begin_patch(cluster_name):
+    """
+    Take the pending target of a cluster to patch it.
+
+    :return: ResizeState or None if no patch is pending
+    """
+    state = ResizeState.get_by_id(cluster_name)
+    if state is None or state.State != PENDING:
+        return None
+    state.State = RUNNING
+    state.StartedAt = datetime.datetime.utcnow()
+    state.Polls = 0
+    state.put()
+    return state
+
+
+@ndb.transactional
+def record_started(cluster_name, operation_name, remaining_changes):
+    """Record the patch operation of the running resize."""
+    state = ResizeState.get_by_id(cluster_name)
+    state.OperationName = operation_name
+    state.RemainingChanges = remaining_changes
+    state.put()
+    return state
+
+
+@ndb.transactional
+def record_poll(cluster_name):
+    """Count a poll of an unfinished operation."""
+    state = ResizeState.get_by_id(cluster_name)
+    state.Polls += 1
+    state.put()
+    return state
+
+
+@ndb.transactional
+def record_finished(cluster_name, error=None, cooldown_seconds=0):
+    """
+    Record the outcome of a resize and move a queued target up.
+
+    :param error: error message if the resize failed
+    :param cooldown_seconds: wait before patching the queued target
+    :return: ResizeState, countdown of the /patch task to schedule for the
+    queued target or None
+    """
+    state = ResizeState.get_by_id(cluster_name)
+    now = datetime.datetime.utcnow()
+    state.FinishedAt = now
+    state.DurationSeconds = (now - state.StartedAt).total_seconds()
+    state.State = FAILED if error else DONE
+    state.Error = error
+    state.RemainingChanges = None
+    logging.info('Resize of %s to %s workers and %s preemptible %s after '
+                 '%.1fs and %s polls', cluster_name, state.Workers,
+                 state.Preemptibles, state.State, state.DurationSeconds,
+                 state.Polls)
+    countdown = None
+    if state.QueuedWorkers is not None:
+        state._set_target(state.QueuedWorkers, state.QueuedPreemptibles,
+                          state.QueuedDirection, state.QueuedObservedAt)
+        state._clear_queue()
+        countdown = cooldown_seconds
+        state.State = PENDING
+        state.PendingSince = now
+        state.PatchAfter = now + datetime.timedelta(seconds=countdown)
+    state.put()
+    return state, countdown
@@ -1,21 +1,34 @@
 """"Settings Class and utils"""
-import googleapiclient.discovery
+import datetime
+import logging
+import threading
+import time
+
+from google.appengine.api import datastore_errors, memcache
 from google.appengine.ext import ndb
-from google.auth import app_engine
+from googleapiclient.errors import HttpError
 
-from util import utils
+from model import provisioning
+from util import clients, instrumentation, tracing, utils
 from monitoring import metrics
-SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
-CREDENTIALS = app_engine.Credentials(scopes=SCOPES)
 
+LOCAL_CACHE_TTL_SECONDS = 30
+MEMCACHE_TTL_SECONDS = 10 * 60
+MEMCACHE_PREFIX = 'shamash-settings-'
+GENERATION_KEY = 'shamash-settings-generation'
 
-def get_regions():
+REGIONS_ID = 'regions'
+REGIONS_MEMCACHE_KEY = 'shamash-regions'
+REGIONS_TTL_SECONDS = 24 * 60 * 60
+
+
+def fetch_regions():
     """
-    Get all available regions.
+    Get all available regions from the Compute API.
 
     :return: all regions
     """
-    compute = googleapiclient.discovery.build('compute', 'v1')
+    compute = clients.get_client('compute')
 
     request = compute.regions().list(project=utils.get_project_id())
 
@@ -28,12 +41,54 @@ def get_regions():
     return rg
 
 
+class RegionList(ndb.Model):
+    """Last list of regions read from the Compute API."""
+    Regions = ndb.StringProperty(repeated=True, indexed=False)
+    Updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+def get_regions():
+    """
+    Get all available regions, cached in memcache and Datastore.
+
+    :return: all regions, empty if they can't be read
+    """
+    regions = memcache.get(REGIONS_MEMCACHE_KEY)
+    if regions is not None:
+        return regions
+    stored = RegionList.get_by_id(REGIONS_ID)
+    max_age = datetime.timedelta(seconds=REGIONS_TTL_SECONDS)
+    if stored is not None and \
+            stored.Updated > datetime.datetime.utcnow() - max_age:
+        regions = stored.Regions
+    else:
+        try:
+            regions = fetch_regions()
+            RegionList(id=REGIONS_ID, Regions=regions).put()
+        except (HttpError, KeyError) as e:
+            logging.error(e)
+            if stored is None:
+                return []
+            regions = stored.Regions
+    memcache.set(REGIONS_MEMCACHE_KEY, regions, time=REGIONS_TTL_SECONDS)
+    return regions
+
+
+def _validate_region(prop, value):
+    """Region must be a known region, when the regions can be read."""
+    regions = get_regions()
+    if regions and value not in regions:
+        raise datastore_errors.BadValueError(
+            'Unknown region {}'.format(value))
+    return value
+
+
 class Settings(ndb.Model):
     """Setting management for Shamash."""
     Enabled = ndb.BooleanProperty(required=True, default=True)
     Cluster = ndb.StringProperty(indexed=True, required=True)
     Region = ndb.StringProperty(
-        choices=get_regions(), default='us-east1', required=True)
+        default='us-east1', required=True, validator=_validate_region)
     AddRemoveUpDelta = ndb.IntegerProperty(default=0, required=False)
     AddRemoveDownDelta = ndb.IntegerProperty(default=0, required=False)
     UseMemoryForScaling = ndb.BooleanProperty(required=True, default=True)
@@ -46,25 +101,131 @@ class Settings(ndb.Model):
     MinInstances = ndb.IntegerProperty(default=2, required=True)
     GracefulDecommissionTimeout = ndb.IntegerProperty(
         default=0, required=False)
+    PredictiveScaling = ndb.BooleanProperty(default=False, required=False)
+    ProvisioningLeadMinutes = ndb.IntegerProperty(default=10, required=False)
+    CooldownMinutes = ndb.IntegerProperty(default=2, required=False)
+    StabilizationMinutes = ndb.IntegerProperty(default=10, required=False)
+    # Bumped on every save, scaling messages carry the version they were
+    # decided with
+    Version = ndb.IntegerProperty(default=0, required=False)
+
+    def _pre_put_hook(self):
+        self.Version = (self.Version or 0) + 1
 
     def _post_put_hook(self, future):
-        met = metrics.Metrics(self.Cluster)
-        met.init_metrics()
+        invalidate_settings_cache()
+        if not provisioning.is_provisioned():
+            met = metrics.Metrics(self.Cluster)
+            met.init_metrics()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        invalidate_settings_cache()
+
+
+class _LocalCache(object):
+    """Thread safe in process cache with expiring entries."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local_cache = _LocalCache(LOCAL_CACHE_TTL_SECONDS)
+
+
+def _get_generation():
+    """
+    Return the current memcache generation of the settings.
+
+    Bumping the generation invalidates every cached entry at once. A new
+    generation is a timestamp so an evicted counter never brings back old
+    entries.
+    """
+    generation = memcache.get(GENERATION_KEY)
+    if generation is None:
+        generation = repr(time.time())
+        if not memcache.add(GENERATION_KEY, generation):
+            generation = memcache.get(GENERATION_KEY) or generation
+    return generation
+
+
+def invalidate_settings_cache():
+    """
+    Drop all cached settings.
+
+    Takes effect at once in this instance and through memcache. Other
+    instances may serve their in process copy for up to
+    LOCAL_CACHE_TTL_SECONDS.
+    """
+    _local_cache.clear()
+    memcache.set(GENERATION_KEY, repr(time.time()))
+
+
+def _cached(key, load):
+    """Get a value from the local cache, memcache or the loader."""
+    value = _local_cache.get(key)
+    if value is not None:
+        return value
+    memcache_key = '{}{}-{}'.format(MEMCACHE_PREFIX, _get_generation(), key)
+    value = memcache.get(memcache_key)
+    if value is None:
+        with instrumentation.timed('datastore.settings'), tracing.call(
+                'datastore', 'settings ' + key):
+            value = load()
+        memcache.set(memcache_key, value, time=MEMCACHE_TTL_SECONDS)
+    _local_cache.set(key, value)
+    return value
 
 
 def get_cluster_settings(cluster_name):
     """
+    Get the settings of a cluster.
 
     :param cluster_name:
-    :return:
+    :return: Settings or None if the cluster is not managed
+    """
+    # Cache misses as an empty list so they are not read again
+    found = _cached('cluster-' + cluster_name, lambda: Settings.query(
+        Settings.Cluster == cluster_name).fetch(1))
+    if found:
+        return found[0]
+    return None
+
+
+def get_region_clusters_settings(region):
+    """
+    Get the settings of all enabled clusters in a region.
+
+    :param region:
+    :return: list of Settings
     """
-    return Settings.query(Settings.Cluster == cluster_name)
+    return [
+        st for st in get_all_clusters_settings()
+        if st.Region == region and st.Enabled
+    ]
 
 
 def get_all_clusters_settings():
     """
     Get all entities of setting kind.
 
-    :return:
+    :return: list of Settings
     """
-    return Settings.query()
+    return _cached('all', lambda: Settings.query().fetch())
@@ -0,0 +1,104 @@
+"""Chart data of the cluster metrics for the admin dashboard."""
+import logging
+import math
+
+import numpy as np
+from google.appengine.api import memcache
+
+from monitoring import metrics
+
+# Metrics and time windows, in minutes, the dashboard can show
+CHART_METRICS = ('YARNMemoryAvailablePercentage', 'ContainerPendingRatio',
+                 'YarnNodes', 'Workers', 'PreemptibleWorkers')
+CHART_WINDOWS = {
+    '1h': 60,
+    '6h': 6 * 60,
+    '1d': 24 * 60,
+    '7d': 7 * 24 * 60,
+    '30d': 30 * 24 * 60
+}
+
+# Stackdriver aligns to at least a minute and to about this many points
+# per pixel, LTTB picks the points that are drawn out of them
+MIN_ALIGNMENT_SECONDS = 60
+POINTS_PER_PIXEL = 4
+
+CHART_MEMCACHE_PREFIX = 'shamash-chart-'
+CHART_CACHE_SECONDS = 60
+
+
+def lttb(times, values, threshold):
+    """
+    Downsample a series with Largest-Triangle-Three-Buckets.
+
+    Keeps the first and the last point and from every bucket in between the
+    point forming the largest triangle with the point kept before it and
+    the mean of the next bucket, which preserves the peaks and dips a
+    chart shows.
+
+    :param times: time ordered numpy array
+    :param values: numpy array
+    :param threshold: number of points to keep
+    :return: times, values
+    """
+    size = len(times)
+    if threshold >= size or threshold < 3:
+        return times, values
+    every = (size - 2) / float(threshold - 2)
+    kept = [0]
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(math.floor(i * every)) + 1
+        end = int(math.floor((i + 1) * every)) + 1
+        next_end = min(int(math.floor((i + 2) * every)) + 1, size)
+        next_time = times[end:next_end].mean()
+        next_value = values[end:next_end].mean()
+        areas = np.abs(
+            (times[previous] - next_time) *
+            (values[start:end] - values[previous]) -
+            (times[previous] - times[start:end]) *
+            (next_value - values[previous]))
+        previous = start + int(areas.argmax())
+        kept.append(previous)
+    kept.append(size - 1)
+    kept = np.array(kept)
+    return times[kept], values[kept]
+
+
+def get_alignment_seconds(window_minutes, width):
+    """Alignment period giving about POINTS_PER_PIXEL points per pixel."""
+    seconds = window_minutes * 60 // (width * POINTS_PER_PIXEL)
+    seconds -= seconds % MIN_ALIGNMENT_SECONDS
+    return max(MIN_ALIGNMENT_SECONDS, seconds)
+
+
+def get_chart_data(cluster_name, custom_metric_type, window, width):
+    """
+    Points of a cluster metric to draw on a chart width pixels wide.
+
+    Results are cached in memcache for CHART_CACHE_SECONDS.
+
+    :param window: one of CHART_WINDOWS
+    :param width: chart width in pixels, at most one point per pixel is
+    returned
+    :return: dict with times in epoch seconds and values
+    """
+    key = '{}{}-{}-{}-{}'.format(CHART_MEMCACHE_PREFIX, cluster_name,
+                                 custom_metric_type, window, width)
+    data = memcache.get(key)
+    if data is not None:
+        return data
+    minutes = CHART_WINDOWS[window]
+    alignment_seconds = get_alignment_seconds(minutes, width)
+    met = metrics.Metrics(cluster_name)
+    times, values = met.read_timeseries(
+        custom_metric_type, minutes,
+        alignment_period_seconds=alignment_seconds, aligner='ALIGN_MEAN')
+    read = len(times)
+    times, values = lttb(times, values, width)
+    logging.debug('Chart %s %s %s: %s points aligned to %ss, %s kept',
+                  cluster_name, custom_metric_type, window, read,
+                  alignment_seconds, len(times))
+    data = {'times': times.tolist(), 'values': values.tolist()}
+    memcache.set(key, data, time=CHART_CACHE_SECONDS)
+    return data
@@ -1,21 +1,19 @@
 """Dataproc actions."""
-import base64
 import json
 import logging
 
 import backoff
-import googleapiclient.discovery
-from google.auth import app_engine
 from googleapiclient.errors import HttpError
 
 from model import settings
-from util import pubsub, utils
-
-SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+from monitoring import snapshot
+from util import (clients, concurrency, config, instrumentation, pubsub,
+                  utils)
 
 MONITORING_TOPIC = 'shamash-monitoring'
 
-CREDENTIALS = app_engine.Credentials(scopes=SCOPES)
+WORKERS_MASK = 'config.worker_config.num_instances'
+SECONDARY_WORKERS_MASK = 'config.secondary_worker_config.num_instances'
 
 
 class DataProcException(Exception):
@@ -28,60 +26,242 @@ class DataProcException(Exception):
         return repr(self.parameter)
 
 
+def list_region_clusters(region):
+    """
+    Get the json of every cluster in a region.
+
+    :param region:
+    :return: list of clusters
+    """
+    dataproc = clients.get_client('dataproc')
+    project_id = utils.get_project_id()
+
+    @backoff.on_exception(
+        backoff.expo, HttpError, max_tries=8, giveup=utils.fatal_code,
+        on_backoff=instrumentation.count_retries('dataproc.clusters.list'))
+    def _do_request(page_token=None):
+        kwargs = dict(projectId=project_id, region=region)
+        if page_token:
+            kwargs['pageToken'] = page_token
+        return dataproc.projects().regions().clusters().list(
+            **kwargs).execute()
+
+    out = []
+    try:
+        response = _do_request()
+        out.extend(response.get('clusters', []))
+        next_token = response.get('nextPageToken')
+        while next_token:
+            response = _do_request(next_token)
+            out.extend(response.get('clusters', []))
+            next_token = response.get('nextPageToken')
+    except HttpError as e:
+        logging.error(e)
+        raise DataProcException(e)
+    return out
+
+
+def check_region_load(region, clusters_settings, handle=None):
+    """
+    Publish the metrics of all managed clusters of a region using a single
+    paginated clusters().list instead of a clusters().get per cluster.
+
+    :param region:
+    :param clusters_settings: Settings of the clusters to monitor
+    :param handle: called with the list of monitoring data instead of
+    publish_monitor_data
+    :return:
+    """
+    managed = dict((st.Cluster, st) for st in clusters_settings)
+    if not managed:
+        return 'OK', 204
+    try:
+        region_clusters = list_region_clusters(region)
+    except DataProcException as e:
+        logging.error(e)
+        return 'Error', 500
+
+    monitor_data_list = []
+    for cluster_data in region_clusters:
+        cluster_settings = managed.pop(cluster_data.get('clusterName'), None)
+        if cluster_settings is None:
+            continue
+        try:
+            dp = DataProc(cluster_settings.Cluster, cluster_settings,
+                          cluster_data)
+            monitor_data = dp.get_monitor_data()
+        except DataProcException as e:
+            # Busy clusters may be listed without metrics, retry next tick
+            logging.warning('Skipping %s: %s', cluster_settings.Cluster, e)
+            continue
+        monitor_data_list.append(monitor_data)
+    for cluster_name in managed:
+        logging.warning('Cluster %s not found in %s', cluster_name, region)
+
+    try:
+        (handle or publish_monitor_data)(monitor_data_list)
+    except pubsub.PubSubException as e:
+        logging.error(e)
+        return 'Error', 500
+    logging.debug('Handled %s clusters of %s', len(monitor_data_list),
+                  region)
+    return 'OK', 204
+
+
+def check_clusters_load(cluster_names, handle=None):
+    """
+    Read several clusters concurrently and publish their metrics together.
+
+    Clusters that failed are logged and checked again on the next run, a
+    retry of the whole batch would publish the others twice. The batch only
+    fails if no cluster could be read.
+
+    :param cluster_names:
+    :param handle: called with the list of monitoring data instead of
+    publish_monitor_data
+    :return:
+    """
+
+    def _monitor(cluster_name):
+        return DataProc(cluster_name).get_monitor_data()
+
+    monitor_data_list = []
+    for cluster_name, monitor_data, error in concurrency.run_bounded(
+            _monitor, cluster_names, config.MONITORING_CONCURRENCY,
+            config.CLUSTER_TIMEOUT_SECONDS):
+        if error is not None:
+            logging.error('Monitoring %s failed: %s', cluster_name, error)
+            continue
+        monitor_data_list.append(monitor_data)
+    try:
+        (handle or publish_monitor_data)(monitor_data_list)
+    except pubsub.PubSubException as e:
+        logging.error(e)
+        return 'Error', 500
+    failed = len(cluster_names) - len(monitor_data_list)
+    if failed and not monitor_data_list:
+        return 'Error', 500
+    if failed:
+        logging.warning('Monitoring %s of %s clusters failed', failed,
+                        len(cluster_names))
+    return 'OK', 204
+
+
+def publish_monitor_data(monitor_data_list):
+    """
+    Publish the metrics of several clusters with as few calls as possible.
+
+    Up to pubsub.MAX_ITEMS_PER_MESSAGE clusters share a message. Only the
+    clusters of failed calls are published again, once. The metrics of
+    clusters that still fail after some went through are dropped, they are
+    read again on the next check, rather than failing the caller whose
+    retry would publish the others twice.
+
+    :param monitor_data_list: list of get_monitor_data() results
+    :raises PubSubException: if nothing could be published
+    """
+    publisher = pubsub.Publisher(MONITORING_TOPIC)
+    for monitor_data in monitor_data_list:
+        publisher.add(monitor_data)
+    failures = publisher.flush()
+    if not failures:
+        return
+    for failure in failures:
+        for monitor_data in failure['items']:
+            publisher.add(monitor_data)
+    failures = publisher.flush()
+    if not failures:
+        return
+    if not publisher.message_ids:
+        raise pubsub.PubSubException(failures[0]['error'])
+    logging.error('Dropped the metrics of %s clusters',
+                  sum(len(failure['items']) for failure in failures))
+
+
 class DataProc(object):
     """Class for interacting with a Dataproc cluster."""
 
-    def __init__(self, cluster_name):
-        self.dataproc = googleapiclient.discovery. \
-            build('dataproc', 'v1',
-                  credentials=CREDENTIALS)
+    def __init__(self, cluster_name, cluster_settings=None,
+                 cluster_data=None):
+        """
+        :param cluster_name:
+        :param cluster_settings: the cluster Settings, queried if not given
+        :param cluster_data: cluster json that was already read, e.g. from
+        clusters().list, used as the first snapshot
+        """
+        self.dataproc = clients.get_client('dataproc')
         self.cluster_name = cluster_name
         self.project_id = utils.get_project_id()
-        s = settings.get_cluster_settings(cluster_name)
-        if s.count(1) == 1:
-            for st in s:
-                self.cluster_settings = st
-        else:
+        self._snapshot = None
+        if cluster_data is not None:
+            self._snapshot = snapshot.ClusterSnapshot.from_cluster_data(
+                cluster_data)
+        if cluster_settings is not None:
+            self.cluster_settings = cluster_settings
+            return
+        self.cluster_settings = settings.get_cluster_settings(cluster_name)
+        if self.cluster_settings is None:
             raise DataProcException('Cluster not found!')
 
+    @instrumentation.instrumented('dataproc.get_cluster', 'cluster_name')
     def __get_cluster_data(self):
         """Get a json with cluster data/status."""
 
         @backoff.on_exception(
-            backoff.expo, HttpError, max_tries=8, giveup=utils.fatal_code)
+            backoff.expo, HttpError, max_tries=8, giveup=utils.fatal_code,
+            on_backoff=instrumentation.count_retries('dataproc.clusters.get'))
         def _do_request():
             return self.dataproc.projects().regions().clusters().get(
                 projectId=utils.get_project_id(),
                 region=self.cluster_settings.Region,
                 clusterName=self.cluster_name).execute()
 
-        @backoff.on_predicate(backoff.expo)
-        def _validate_json(js):
-            if 'metrics' not in js:
-                return False
-            if 'yarnMetrics' not in js['metrics']:
-                return False
-            return True
+        def _missing_yarn_metrics(js):
+            return 'yarnMetrics' not in js.get('metrics', {})
+
+        # Dataproc omits the metrics while the cluster is busy so re-read
+        # until they show up.
+        @backoff.on_predicate(
+            backoff.expo, predicate=_missing_yarn_metrics, max_tries=8,
+            on_backoff=instrumentation.count_retries(
+                'dataproc.missing_yarn_metrics'))
+        def _fetch():
+            return _do_request()
 
         try:
-            res = _do_request()
+            res = _fetch()
         except HttpError as e:
             logging.error(e)
             raise e
-        _validate_json(res)
         return res
 
+    def get_snapshot(self, refresh=False):
+        """
+        Return the cluster snapshot, reading the cluster only if needed.
+
+        :param refresh: force a new clusters().get call
+        :return: snapshot.ClusterSnapshot
+        """
+        if self._snapshot is None or refresh:
+            try:
+                self._snapshot = snapshot.ClusterSnapshot.from_cluster_data(
+                    self.__get_cluster_data())
+            except (HttpError, ValueError) as e:
+                logging.error(e)
+                raise DataProcException(e)
+        return self._snapshot
+
+    def refresh_snapshot(self):
+        """Drop the current snapshot and read the cluster again."""
+        return self.get_snapshot(refresh=True)
+
     def get_cluster_status(self):
         """Get status of the cluster.running updating etc."""
-        try:
-            cluster_data = self.__get_cluster_data()
-
-        except (HttpError, KeyError) as e:
-            logging.error(e)
-            raise DataProcException(e)
-        else:
-            status = cluster_data['status']['state']
-            return status
+        status = self.get_snapshot().status
+        if status is None:
+            raise DataProcException('No status for {}'.format(
+                self.cluster_name))
+        return status
 
     def get_yarn_memory_available_percentage(self):
         """The percentage of remaining memory available to YARN
@@ -91,17 +271,10 @@ class DataProc(object):
 
         """
         try:
-            yarn_memory_mb_allocated = int(
-                self.get_yarn_metric('yarn-memory-mb-allocated'))
-            yarn_memory_mb_available = int(
-                self.get_yarn_metric('yarn-memory-mb-available'))
-            total_memory = yarn_memory_mb_allocated + yarn_memory_mb_available
-            if total_memory == 0:
-                return 0
-            return int(yarn_memory_mb_available) / int(total_memory)
-        except DataProcException as e:
+            return self.get_snapshot().yarn_memory_available_percentage
+        except KeyError as e:
             logging.error(e)
-            raise
+            raise DataProcException(e)
 
     def get_container_pending_ratio(self):
         """The ratio of pending containers to containers allocated
@@ -111,20 +284,10 @@ class DataProc(object):
         a number, not a percentage.
         """
         try:
-
-            yarn_containers_pending = int(
-                self.get_yarn_metric('yarn-containers-pending'))
-
-            yarn_container_allocated = int(
-                self.get_yarn_metric('yarn-containers-allocated'))
-
-            if yarn_container_allocated == 0:
-                return yarn_containers_pending
-
-            return yarn_containers_pending / yarn_container_allocated
-        except DataProcException as e:
+            return self.get_snapshot().container_pending_ratio
+        except KeyError as e:
             logging.error(e)
-            raise
+            raise DataProcException(e)
 
     def get_yarn_metric(self, metric_name):
         """
@@ -134,45 +297,86 @@ class DataProc(object):
         :return: metric value
         """
         try:
-            res = self.__get_cluster_data()
-            metric = int(res['metrics']['yarnMetrics'][metric_name])
-        except (HttpError, KeyError) as e:
+            metric = self.get_snapshot().get_yarn_metric(metric_name)
+        except KeyError as e:
             logging.error(e)
             raise DataProcException(e)
         return metric
 
     def get_number_of_preemptible_workers(self):
         """Get the number of 'real workers."""
-        nodes = 0
         if self.cluster_settings.PreemptiblePct == 0:
             return 0
         if self.get_number_of_workers() - self.get_yarn_metric(
                 'yarn-nodes-active') == 0:
             return 0
-        try:
-            res = self.__get_cluster_data()
-        except HttpError as e:
-            logging.error(e)
-            raise DataProcException(e)
-        if res.get('config') is not None:
-            if res.get('config').get('secondaryWorkerConfig') is not None:
-                nodes = res.get('config').get('secondaryWorkerConfig').get(
-                    'numInstances')
-                if nodes is None:
-                    nodes = 0
-        return nodes
+        return self.get_snapshot().secondary_workers
 
+    @instrumentation.instrumented('dataproc.patch_cluster', 'cluster_name')
     def patch_cluster(self, worker_nodes, preemptible_nodes):
-        """Update number of nodes in a cluster."""
+        """
+        Start updating the number of nodes of a cluster.
+
+        Both worker groups are resized with a single patch. If Dataproc
+        rejects the combined update mask they are patched one at a time,
+        preemptible workers first: they are the quickest to add when scaling
+        out and the cheapest to lose when scaling in. Only the first patch is
+        sent, the others are returned for when its operation is done.
+
+        :return: name of the patch operation or None if the cluster already
+        has that size, changes still to patch
+        """
+        self.refresh_snapshot()
+        if self.get_cluster_status().lower() != 'running':
+            raise DataProcException('Cluster {} is not running'.format(
+                self.cluster_name))
         logging.debug("Wants %s %s got %s %s", worker_nodes,
                       preemptible_nodes,
                       self.get_number_of_workers(),
                       self.get_number_of_preemptible_workers())
+        changes = []
+        if self.get_number_of_preemptible_workers() != preemptible_nodes:
+            changes.append([SECONDARY_WORKERS_MASK, 'secondaryWorkerConfig',
+                            preemptible_nodes])
+        if self.get_number_of_workers() != worker_nodes:
+            changes.append([WORKERS_MASK, 'workerConfig', worker_nodes])
+        if not changes:
+            return None, []
+
+        if len(changes) > 1:
+            try:
+                return self.patch_changes(changes), []
+            except HttpError as e:
+                if e.resp.status != 400:
+                    raise DataProcException(e)
+                logging.info('Combined patch of %s rejected, patching one '
+                             'group at a time: %s', self.cluster_name, e)
+        try:
+            return self.patch_changes(changes[:1]), changes[1:]
+        except HttpError as e:
+            raise DataProcException(e)
+
+    def patch_changes(self, changes):
+        """
+        Send a single patch for worker group sizes.
+
+        :param changes: list of [update mask, config key, number of nodes]
+        :return: name of the patch operation
+        """
+        if self.cluster_settings.GracefulDecommissionTimeout != 0:
+            gracefuldecommissiontimeout = str(self.cluster_settings.GracefulDecommissionTimeout * 60) + 's'
+        else:
+            gracefuldecommissiontimeout = '0s'
+        mask = ','.join(change[0] for change in changes)
+        body = {'config': dict((config_key, {'numInstances': nodes})
+                               for _, config_key, nodes in changes)}
 
         @backoff.on_exception(
-            backoff.expo, HttpError, max_tries=8, giveup=utils.fatal_code)
-        def _do_request(mask, gracefuldecommissiontimeout):
-            self.dataproc.projects().regions().clusters().patch(
+            backoff.expo, HttpError, max_tries=8, giveup=utils.fatal_code,
+            on_backoff=instrumentation.count_retries(
+                'dataproc.clusters.patch'))
+        def _do_request():
+            return self.dataproc.projects().regions().clusters().patch(
                 projectId=self.project_id,
                 region=self.cluster_settings.Region,
                 clusterName=self.cluster_name,
@@ -180,84 +384,79 @@ class DataProc(object):
                 gracefulDecommissionTimeout=gracefuldecommissiontimeout,
                 body=body).execute()
 
-        @backoff.on_predicate(backoff.expo)
-        def _is_cluster_running():
-            return self.get_cluster_status().lower() == 'running'
+        operation = _do_request()
+        logging.info('Patching %s %s, operation %s', self.cluster_name, mask,
+                     operation.get('name'))
+        return operation.get('name')
 
-        # Wait for cluster
-        _is_cluster_running()
-        if self.cluster_settings.GracefulDecommissionTimeout != 0:
-            gracefuldecommissiontimeout = str(self.cluster_settings.GracefulDecommissionTimeout * 60) + 's'
-        else:
-            gracefuldecommissiontimeout = '0s'
-        if self.get_number_of_workers() != worker_nodes:
-            body = json.loads(
-                '{"config":{"workerConfig":{"numInstances":%d}}}' %
-                worker_nodes)
-            update_mask = 'config.worker_config.num_instances'
-            try:
-                _do_request(update_mask, gracefuldecommissiontimeout)
-            except HttpError as e:
-                raise DataProcException(e)
+    def get_operation(self, operation_name):
+        """
+        Get a long running Dataproc operation.
+
+        :param operation_name: full operation name
+        :return: operation json
+        """
+
+        @backoff.on_exception(
+            backoff.expo, HttpError, max_tries=8, giveup=utils.fatal_code,
+            on_backoff=instrumentation.count_retries(
+                'dataproc.operations.get'))
+        def _do_request():
+            return self.dataproc.projects().regions().operations().get(
+                name=operation_name).execute()
 
-        if self.get_number_of_preemptible_workers() == preemptible_nodes:
-            return 'ok', 204
-        body = json.loads(
-            '{"config":{"secondaryWorkerConfig":{"numInstances":%d}}}' %
-            preemptible_nodes)
-        update_mask = 'config.secondary_worker_config.num_instances'
-        _is_cluster_running()
         try:
-            _do_request(update_mask, gracefuldecommissiontimeout)
+            return _do_request()
         except HttpError as e:
+            logging.error(e)
             raise DataProcException(e)
-        return 'ok', 200
 
     def get_number_of_workers(self):
         """Get the number of 'real workers."""
-        try:
-            res = self.__get_cluster_data()
-        except (HttpError, KeyError) as e:
-            logging.error(e)
-            raise DataProcException(e)
-        else:
-            nodes = int(res['config']['workerConfig']['numInstances'])
-            return nodes
+        nodes = self.get_snapshot().workers
+        if nodes is None:
+            raise DataProcException('No worker config for {}'.format(
+                self.cluster_name))
+        return nodes
 
-    def check_load(self):
-        """Get the current cluster metrics and publish them to pub/sub."""
+    def get_monitor_data(self):
+        """Get the current cluster metrics as published to pub/sub."""
+        monitor_data = {
+            'cluster': self.cluster_name,
+            'yarn_memory_available_percentage':
+            float(self.get_yarn_memory_available_percentage()),
+            'container_pending_ratio':
+            float(self.get_container_pending_ratio()),
+            'number_of_nodes':
+            int(self.get_yarn_metric('yarn-nodes-active')),
+            'worker_nodes': int(self.get_number_of_workers()),
+            'yarn_containers_pending':
+            int(self.get_yarn_metric('yarn-containers-pending')),
+            'preemptible_workers':
+            self.get_number_of_preemptible_workers(),
+            'snapshot': self.get_snapshot().to_dict()
+        }
+        if self.cluster_settings.PreemptiblePct != 0:
+            monitor_data['preemptible_nodes'] = int(
+                self.get_number_of_preemptible_workers())
+        logging.debug('Monitor data for %s is %s', self.cluster_name,
+                      json.dumps(monitor_data))
+        return monitor_data
+
+    def check_load(self, handle=None):
+        """
+        Get the current cluster metrics and publish them to pub/sub.
+
+        :param handle: called with a list of the monitoring data instead of
+        publish_monitor_data
+        """
         try:
-            monitor_data = {
-                'cluster': self.cluster_name,
-                'yarn_memory_available_percentage':
-                float(self.get_yarn_memory_available_percentage()),
-                'container_pending_ratio':
-                float(self.get_container_pending_ratio()),
-                'number_of_nodes':
-                int(self.get_yarn_metric('yarn-nodes-active')),
-                'worker_nodes': int(self.get_number_of_workers()),
-                'yarn_containers_pending':
-                int(self.get_yarn_metric('yarn-containers-pending')),
-                'preemptible_workers':
-                self.get_number_of_preemptible_workers()
-            }
-            if self.cluster_settings.PreemptiblePct != 0:
-                monitor_data['preemptible_nodes'] = int(
-                    self.get_number_of_preemptible_workers())
+            monitor_data = self.get_monitor_data()
         except DataProcException as e:
             logging.error(e)
             return 'Error', 500
-        msg = {
-            'messages': [{
-                'data': base64.b64encode(json.dumps(monitor_data))
-            }]
-        }
-
-        logging.debug('Monitor data for %s is %s', self.cluster_name,
-                      json.dumps(monitor_data))
-        pubsub_client = pubsub.get_pubsub_client()
         try:
-            pubsub.publish(pubsub_client, msg, MONITORING_TOPIC)
+            (handle or publish_monitor_data)([monitor_data])
         except pubsub.PubSubException as e:
             logging.error(e)
             return 'Error', 500
@@ -1,17 +1,27 @@
 """Handling metrics."""
+import calendar
 import datetime
+import json
 import logging
+import re
 
 import backoff
-import googleapiclient.discovery
-from google.auth import app_engine
+import numpy as np
 from googleapiclient.errors import HttpError
 
-from util import utils
+from util import clients, instrumentation, utils
 
-SCOPES = ('https://www.googleapis.com/auth/monitoring',
-          'https://www.googleapis.com/auth/cloud-platform')
-CREDENTIALS = app_engine.Credentials(scopes=SCOPES)
+METRIC_DOMAIN = 'custom.googleapis.com'
+
+# timeSeries.create accepts at most 200 series per call and a series may
+# appear only once in a call.
+MAX_TIME_SERIES_PER_REQUEST = 200
+
+_SERIES_INDEX_RE = re.compile(r'timeSeries\[(\d+)\]')
+
+# timeSeries.list partial response with only what read_timeseries parses
+POINTS_FIELDS = ('nextPageToken,'
+                 'timeSeries(points(interval(endTime),value(doubleValue)))')
 
 
 def format_rfc3339(datetime_instance=None):
@@ -32,6 +42,34 @@ def get_now_rfc3339():
     return format_rfc3339(datetime.datetime.utcnow())
 
 
+def parse_rfc3339(value):
+    """
+    Convert an RFC 3339 UTC timestamp as returned by Stackdriver to epoch
+    seconds.
+
+    :param value: e.g. 2018-01-01T10:00:00.123456Z
+    :return: float
+    """
+    # Sliced rather than strptime, this runs for every point read
+    fraction = 0.0
+    if len(value) > 20:
+        fraction = float('0.' + value[20:].rstrip('Z'))
+    return calendar.timegm(
+        (int(value[0:4]), int(value[5:7]), int(value[8:10]),
+         int(value[11:13]), int(value[14:16]), int(value[17:19]))) + fraction
+
+
+def to_epoch(datetime_instance):
+    """
+    Convert a naive UTC datetime to epoch seconds.
+
+    :param datetime_instance:
+    :return: float
+    """
+    return calendar.timegm(datetime_instance.timetuple()) + \
+        datetime_instance.microsecond / 1e6
+
+
 def get_start_time(minutes):
     """
     Create start time for minuets from now.
@@ -45,17 +83,171 @@ def get_start_time(minutes):
     return format_rfc3339(start_time)
 
 
+def _append_points(response, times, values):
+    """Add the end times and values of a timeSeries.list response."""
+    for ts in response.get('timeSeries', []):
+        for point in ts.get('points', []):
+            times.append(parse_rfc3339(point['interval']['endTime']))
+            values.append(float(point['value'].get('doubleValue', 0)))
+
+
+def build_timeseries(project_id, cluster_name, custom_metric_type, data_point,
+                     end_time=None, labels=None):
+    """
+    Build a single point GAUGE time series for a cluster metric.
+
+    :param project_id:
+    :param cluster_name:
+    :param custom_metric_type: metric name without the domain
+    :param data_point: the value
+    :param end_time: datetime of the point, defaults to utcnow
+    :param labels: dict of more metric labels
+    :return: TimeSeries json
+    """
+    metric_labels = dict(labels or {})
+    metric_labels['cluster_name'] = cluster_name
+    if end_time is None:
+        now = get_now_rfc3339()
+    else:
+        now = format_rfc3339(end_time)
+    return {
+        'metricKind': 'GAUGE',
+        'valueType': 'DOUBLE',
+        'points': [{
+            'interval': {
+                'startTime': now,
+                'endTime': now
+            },
+            'value': {
+                'doubleValue': float(data_point)
+            }
+        }],
+        'metric': {
+            'type': '{}/{}'.format(METRIC_DOMAIN, custom_metric_type),
+            'labels': metric_labels
+        },
+        'resource': {
+            'type': 'global',
+            'labels': {
+                'project_id': project_id
+            }
+        }
+    }
+
+
+def _series_errors(error, count):
+    """
+    Map a timeSeries.create error to the series it refers to.
+
+    The API reports partial failures in the error message as
+    "timeSeries[i]: reason" entries. If none are found the error applies to
+    every series of the request.
+
+    :param error: HttpError
+    :param count: number of series in the request
+    :return: dict of index to message
+    """
+    try:
+        message = json.loads(error.content)['error']['message']
+    except (ValueError, KeyError, TypeError):
+        message = str(error)
+    errors = {}
+    matches = list(_SERIES_INDEX_RE.finditer(message))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(message)
+        index = int(match.group(1))
+        if index < count:
+            errors[index] = message[match.start():end].strip(' ;,')
+    if not errors:
+        errors = dict((i, message) for i in range(count))
+    return errors
+
+
+class TimeSeriesBatch(object):
+    """Collect metric points of any number of clusters and write them with
+    as few timeSeries.create calls as possible."""
+
+    def __init__(self):
+        self.monitorservice = clients.get_client('monitoring')
+        self.project_id = utils.get_project_id()
+        self.project_resource = "projects/{0}".format(self.project_id)
+        self.series = []
+
+    def __len__(self):
+        return len(self.series)
+
+    def add(self, cluster_name, custom_metric_type, data_point,
+            end_time=None, labels=None):
+        """Queue a point for a cluster metric, end_time defaults to now."""
+        self.series.append(
+            build_timeseries(self.project_id, cluster_name,
+                             custom_metric_type, data_point, end_time,
+                             labels))
+
+    def _requests(self):
+        """Split the queued series into valid timeSeries.create bodies."""
+        requests = []
+        for ts in self.series:
+            key = (ts['metric']['type'],
+                   tuple(sorted(ts['metric']['labels'].items())))
+            for keys, series in requests:
+                if key not in keys and \
+                        len(series) < MAX_TIME_SERIES_PER_REQUEST:
+                    break
+            else:
+                keys, series = set(), []
+                requests.append((keys, series))
+            keys.add(key)
+            series.append(ts)
+        return [series for _, series in requests]
+
+    @instrumentation.instrumented('metrics.write')
+    def flush(self):
+        """
+        Write all queued points.
+
+        :return: list of dicts with cluster, metric and error for every
+        series that was not written, empty if all succeeded
+        """
+
+        @backoff.on_exception(
+            backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code,
+            on_backoff=instrumentation.count_retries(
+                'monitoring.timeSeries.create'))
+        def _do_request(series):
+            self.monitorservice.projects().timeSeries().create(
+                name=self.project_resource,
+                body={'timeSeries': series}).execute()
+
+        failures = []
+        for series in self._requests():
+            try:
+                _do_request(series)
+            except HttpError as e:
+                logging.error(e)
+                for index, message in sorted(
+                        _series_errors(e, len(series)).items()):
+                    ts = series[index]
+                    failures.append({
+                        'cluster': ts['metric']['labels']['cluster_name'],
+                        'metric': ts['metric']['type'].split('/')[-1],
+                        'error': message
+                    })
+        self.series = []
+        for failure in failures:
+            logging.error('Failed writing %s for %s: %s', failure['metric'],
+                          failure['cluster'], failure['error'])
+        return failures
+
+
 class Metrics(object):
     """Writing and reading metrics."""
 
     def __init__(self, cluster_name):
-        self.monitorservice = googleapiclient.discovery. \
-            build('monitoring',
-                  'v3',
-                  credentials=CREDENTIALS)
+        self.monitorservice = clients.get_client('monitoring')
         self.project_id = utils.get_project_id()
         self.project_resource = "projects/{0}".format(self.project_id)
-        self.metric_domain = 'custom.googleapis.com'
+        self.metric_domain = METRIC_DOMAIN
         self.cluster_name = cluster_name
         self.metrics = [
             'ContainerPendingRatio', 'YARNMemoryAvailablePercentage',
@@ -63,101 +255,93 @@ class Metrics(object):
         ]
 
     def init_metrics(self):
-        """Make sure that we have all of our custom metrics."""
+        """
+        Make sure that we have all of our custom metrics.
+
+        :return: whether every descriptor exists or was created
+        """
+        ok = True
         for met in self.metrics:
             if not self._custom_metric_exists(met):
-                self._create_custom_metric(met)
+                ok = self._create_custom_metric(met) and ok
+        return ok
 
+    @instrumentation.instrumented('metrics.write_value', 'cluster_name')
     def write_timeseries_value(self, custom_metric_type, data_point):
         """Write the custom metric obtained."""
-        now = get_now_rfc3339()
-        custom_metric = "{}/{}".format(self.metric_domain, custom_metric_type)
-        timeseries_data = {
-            'metricKind': 'GAUGE',
-            'valueType': 'DOUBLE',
-            'points': [{
-                'interval': {
-                    'startTime': now,
-                    'endTime': now
-                },
-                'value': {
-                    'doubleValue': data_point
-                }
-            }],
-            'metric': {
-                'type': custom_metric,
-                "labels": {
-                    'cluster_name': self.cluster_name
-                }
-            },
-            'resource': {
-                'type': 'global',
-                'labels': {
-                    'project_id': self.project_id
-                }
-            }
-        }
-
-        @backoff.on_exception(
-            backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
-        def _do_request():
-            self.monitorservice.projects().timeSeries().create(
-                name=self.project_resource,
-                body={'timeSeries': [timeseries_data]}).execute()
-
-        try:
-            _do_request()
-            return True
-        except HttpError as e:
-            logging.error(e)
-            return False
-
-    def read_timeseries(self, custom_metric_type, minutes):
+        batch = TimeSeriesBatch()
+        batch.add(self.cluster_name, custom_metric_type, data_point)
+        return not batch.flush()
+
+    @instrumentation.instrumented('metrics.read', 'cluster_name')
+    def read_timeseries(self, custom_metric_type, minutes, start_time=None,
+                        alignment_period_seconds=None, aligner=None,
+                        reducer=None, fields=POINTS_FIELDS):
         """
-        Get the time series from stackdriver.
+        Get the points of a cluster metric from stackdriver.
 
         :param custom_metric_type:
         :param minutes:
-        :return: json object
+        :param start_time: RFC 3339 start of the interval, overrides minutes
+        :param alignment_period_seconds: have Stackdriver reduce the points
+        to one per period with aligner
+        :param aligner: e.g. ALIGN_MEAN, ALIGN_MAX, defaults to ALIGN_MEAN
+        :param reducer: combine the series of the metric into one, e.g.
+        REDUCE_MEAN, needs an alignment period
+        :param fields: partial response of timeSeries.list, must keep the
+        end time and double value of the points
+        :return: time ordered numpy arrays of epoch seconds and values
         """
-
-        out = []
+        if reducer and not alignment_period_seconds:
+            raise ValueError('A reducer needs an alignment period')
         custom_metric = '{}/{}'.format(self.metric_domain, custom_metric_type)
         default_request_kwargs = dict(
             name=self.project_resource,
             filter='metric.type="{0}" AND metric.labels.cluster_name="{1}"'.
             format(custom_metric, self.cluster_name),
             pageSize=10000,
-            interval_startTime=get_start_time(minutes),
+            interval_startTime=start_time or get_start_time(minutes),
             interval_endTime=get_now_rfc3339())
+        if alignment_period_seconds:
+            default_request_kwargs.update(
+                aggregation_alignmentPeriod='{}s'.format(
+                    int(alignment_period_seconds)),
+                aggregation_perSeriesAligner=aligner or 'ALIGN_MEAN')
+        if reducer:
+            default_request_kwargs['aggregation_crossSeriesReducer'] = reducer
+        if fields:
+            default_request_kwargs['fields'] = fields
 
         @backoff.on_exception(
-            backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
+            backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code,
+            on_backoff=instrumentation.count_retries(
+                'monitoring.timeSeries.list'))
         def _do_request(next_page_token=None):
             kwargs = default_request_kwargs.copy()
             if next_page_token:
-                kwargs['nextPageToken'] = next_page_token
+                kwargs['pageToken'] = next_page_token
             req = self.monitorservice.projects().timeSeries().list(**kwargs)
             return req.execute()
 
+        times = []
+        values = []
         try:
             response = _do_request()
-
-            out.extend(response.get('timeSeries', []))
-
+            _append_points(response, times, values)
             next_token = response.get('nextPageToken')
-
             while next_token:
                 response = _do_request(next_token)
-                out.extend(response.get('timeSeries', []))
+                _append_points(response, times, values)
                 next_token = response.get('nextPageToken')
         except HttpError as e:
             logging.info(e)
-        return out
+        times = np.array(times, dtype=float)
+        values = np.array(values, dtype=float)
+        order = times.argsort()
+        return times[order], values[order]
 
     def _create_custom_metric(self, custom_metric_type):
         """Create custom metric descriptor."""
-        self._custom_metric_exists(custom_metric_type)
         custom_metric = "{}/{}".format(self.metric_domain, custom_metric_type)
         metrics_descriptor = {
             'type': custom_metric,
@@ -178,7 +362,8 @@ class Metrics(object):
             _do_request()
         except HttpError as e:
             logging.error(e)
-        return
+            return False
+        return True
 
     def _custom_metric_exists(self, custom_metric_type):
         custom_metric = "{}/{}".format(self.metric_domain, custom_metric_type)
@@ -186,13 +371,12 @@ class Metrics(object):
         @backoff.on_exception(
             backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
         def _do_request():
-            self.monitorservice.projects().metricDescriptors().list(
+            return self.monitorservice.projects().metricDescriptors().list(
                 name=self.project_resource,
                 filter='metric.type="{0}"'.format(custom_metric),).execute()
 
         try:
-            _do_request()
-            return True
+            return bool(_do_request().get('metricDescriptors'))
         except HttpError as e:
             logging.error(e)
             return False
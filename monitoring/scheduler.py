@@ -0,0 +1,178 @@
+"""Adaptive monitoring, polling busy clusters more often than idle ones.
+
+In adaptive mode every enabled cluster has its own chain of /monitors/poll
+tasks. Each poll monitors the cluster and enqueues the next one with a
+countdown picked from what the cluster is doing, in the same transaction
+that moves the chain's PollSchedule on. /tasks/check-load only restarts the
+chains that stopped.
+"""
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from model import poll_schedule, resize, settings
+from monitoring import dataproc_monitoring
+from util import config
+
+# Interval ceilings of clusters with pending containers or a memory swing,
+# and of clusters that are running containers without changing much
+ACTIVE_POLL_SECONDS = 60
+STEADY_POLL_SECONDS = 120
+# Change of YARNMemoryAvailablePercentage between polls that counts as busy
+VOLATILE_MEMORY_PCT = 10
+
+# A chain whose next poll is overdue by this much is restarted. Leaves
+# time for the task queue to retry the poll.
+STALE_SECONDS = 5 * 60
+
+
+def next_interval(schedule, cluster_snapshot, resizing):
+    """
+    Pick the countdown to the next poll of a cluster.
+
+    Clusters being resized or with a growing number of pending containers
+    are polled every POLL_MIN_SECONDS. The others back off, doubling the
+    interval at every poll up to a ceiling that is lower the busier they
+    are, POLL_MAX_SECONDS for idle clusters.
+
+    :param schedule: PollSchedule with the interval and the last poll
+    :param cluster_snapshot: the cluster now
+    :param resizing: whether a resize of the cluster is pending or running
+    :return: seconds
+    """
+    pending = cluster_snapshot.get_yarn_metric('yarn-containers-pending')
+    memory = 100 * cluster_snapshot.yarn_memory_available_percentage
+    if resizing or (schedule.ContainersPending is not None and
+                    pending > schedule.ContainersPending):
+        return config.POLL_MIN_SECONDS
+    if pending or (schedule.MemoryAvailablePct is not None and
+                   abs(memory - schedule.MemoryAvailablePct) >=
+                   VOLATILE_MEMORY_PCT):
+        ceiling = ACTIVE_POLL_SECONDS
+    elif cluster_snapshot.get_yarn_metric('yarn-containers-allocated'):
+        ceiling = STEADY_POLL_SECONDS
+    else:
+        ceiling = config.POLL_MAX_SECONDS
+    return max(config.POLL_MIN_SECONDS,
+               min(2 * schedule.IntervalSeconds, ceiling))
+
+
+def _enqueue_poll(cluster_name, generation, sequence, countdown):
+    task = taskqueue.add(queue_name='shamash',
+                         url='/monitors/poll',
+                         method='GET',
+                         countdown=countdown,
+                         params={'cluster_name': cluster_name,
+                                 'generation': generation,
+                                 'sequence': sequence},
+                         transactional=True)
+    logging.debug('Task %s enqueued, ETA %s Cluster %s', task.name, task.eta,
+                  cluster_name)
+
+
+def _is_stale(schedule, now):
+    return schedule is None or schedule.NextPollAt is None or \
+        (now - schedule.NextPollAt).total_seconds() > STALE_SECONDS
+
+
+@ndb.transactional
+def _restart(cluster_name):
+    now = datetime.datetime.utcnow()
+    schedule = poll_schedule.get_schedule(cluster_name)
+    if not _is_stale(schedule, now):
+        return False
+    if schedule is None:
+        schedule = poll_schedule.PollSchedule(id=cluster_name)
+    schedule.Generation += 1
+    schedule.Sequence = 0
+    schedule.IntervalSeconds = config.POLL_MIN_SECONDS
+    schedule.NextPollAt = now
+    _enqueue_poll(cluster_name, schedule.Generation, 0, 0)
+    schedule.put()
+    return True
+
+
+@ndb.transactional
+def _advance(cluster_name, generation, sequence, interval, cluster_snapshot):
+    schedule = poll_schedule.get_schedule(cluster_name)
+    if schedule is None or not schedule.is_current(generation, sequence):
+        return False
+    schedule.Sequence += 1
+    schedule.IntervalSeconds = interval
+    schedule.NextPollAt = datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=interval)
+    if cluster_snapshot is not None:
+        schedule.ContainersPending = cluster_snapshot.get_yarn_metric(
+            'yarn-containers-pending')
+        schedule.MemoryAvailablePct = \
+            100 * cluster_snapshot.yarn_memory_available_percentage
+    _enqueue_poll(cluster_name, generation, schedule.Sequence, interval)
+    schedule.put()
+    return True
+
+
+def ensure_polling(clusters_settings):
+    """
+    Restart the poll chains of the enabled clusters that stopped.
+
+    :param clusters_settings: Settings of the clusters
+    :return: response body, status code
+    """
+    now = datetime.datetime.utcnow()
+    for cluster_settings in clusters_settings:
+        if not cluster_settings.Enabled:
+            logging.debug("Cluster %s is disabled.", cluster_settings.Cluster)
+            continue
+        # Most chains are alive, only take the transaction for the others
+        if not _is_stale(
+                poll_schedule.get_schedule(cluster_settings.Cluster), now):
+            continue
+        if _restart(cluster_settings.Cluster):
+            logging.info('Polling of %s started', cluster_settings.Cluster)
+    return 'ok', 200
+
+
+def poll(cluster_name, generation, sequence, handle=None):
+    """
+    Monitor a cluster and schedule its next poll.
+
+    A disabled or removed cluster ends its chain, ensure_polling starts a
+    new one once it is enabled again.
+
+    :param generation: chain of the poll
+    :param sequence: position of the poll in the chain
+    :param handle: passed on to DataProc.check_load
+    :return: response body, status code
+    """
+    schedule = poll_schedule.get_schedule(cluster_name)
+    if schedule is None or not schedule.is_current(generation, sequence):
+        logging.info('Poll %s/%s of %s was superseded', generation, sequence,
+                     cluster_name)
+        return 'Gone', 200
+    cluster_settings = settings.get_cluster_settings(cluster_name)
+    if cluster_settings is None or not cluster_settings.Enabled:
+        logging.info('Stopped polling %s', cluster_name)
+        return 'Disabled', 200
+
+    # Unless the cluster could be read, back off as if it was idle
+    interval = min(2 * schedule.IntervalSeconds, config.POLL_MAX_SECONDS)
+    cluster_snapshot = None
+    try:
+        dp = dataproc_monitoring.DataProc(cluster_name, cluster_settings)
+        result = dp.check_load(handle)
+        if result[1] < 500:
+            cluster_snapshot = dp.get_snapshot()
+            state = resize.get_state(cluster_name)
+            resizing = state is not None and \
+                state.State in (resize.PENDING, resize.RUNNING)
+            interval = next_interval(schedule, cluster_snapshot, resizing)
+    finally:
+        # Scheduled even if the poll failed, its retries are superseded
+        if _advance(cluster_name, generation, sequence, interval,
+                    cluster_snapshot):
+            logging.debug('Next poll of %s in %ss', cluster_name, interval)
+        else:
+            logging.info('Poll chain of %s moved on', cluster_name)
+    return result
@@ -0,0 +1,107 @@
+"""Point in time view of a Dataproc cluster."""
+import time
+
+# Bumped whenever the fields of to_dict change
+SNAPSHOT_VERSION = 1
+
+
+class ClusterSnapshot(object):
+    """Parsed result of a single clusters().get call.
+
+    All YARN metrics and worker counts are extracted once so that every
+    getter for a monitoring tick is served without going back to the API.
+    """
+
+    def __init__(self, cluster_name, status, yarn_metrics, workers,
+                 secondary_workers, fetched_at=None):
+        self.cluster_name = cluster_name
+        self.status = status
+        self.yarn_metrics = yarn_metrics
+        self.workers = workers
+        self.secondary_workers = secondary_workers
+        if fetched_at is None:
+            fetched_at = time.time()
+        self.fetched_at = fetched_at
+
+    @classmethod
+    def from_cluster_data(cls, cluster_data, fetched_at=None):
+        """
+        Build a snapshot from a clusters().get/list resource.
+
+        :param cluster_data: cluster json as returned by the Dataproc API
+        :param fetched_at: epoch seconds of the read, defaults to now
+        :return: ClusterSnapshot
+        """
+        yarn_metrics = {}
+        raw_metrics = cluster_data.get('metrics', {}).get('yarnMetrics', {})
+        for name, value in raw_metrics.items():
+            yarn_metrics[name] = int(value)
+        config = cluster_data.get('config') or {}
+        workers = (config.get('workerConfig') or {}).get('numInstances')
+        secondary = (config.get('secondaryWorkerConfig') or {}).get(
+            'numInstances')
+        return cls(
+            cluster_data.get('clusterName'),
+            cluster_data.get('status', {}).get('state'),
+            yarn_metrics,
+            int(workers) if workers is not None else None,
+            int(secondary) if secondary is not None else 0,
+            fetched_at)
+
+    def to_dict(self):
+        """Serialize for a Pub/Sub message."""
+        return {
+            'version': SNAPSHOT_VERSION,
+            'cluster_name': self.cluster_name,
+            'status': self.status,
+            'yarn_metrics': self.yarn_metrics,
+            'workers': self.workers,
+            'secondary_workers': self.secondary_workers,
+            'fetched_at': self.fetched_at
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuild a snapshot serialized by to_dict.
+
+        :param data: dict
+        :return: ClusterSnapshot or None if it is of another version
+        """
+        if data.get('version') != SNAPSHOT_VERSION:
+            return None
+        return cls(data['cluster_name'], data['status'], data['yarn_metrics'],
+                   data['workers'], data['secondary_workers'],
+                   data['fetched_at'])
+
+    def get_yarn_metric(self, metric_name):
+        """
+        Return a yarn metric by name.
+
+        :param metric_name: the metric to retrieve
+        :return: metric value, raises KeyError if the cluster didn't report it
+        """
+        return self.yarn_metrics[metric_name]
+
+    @property
+    def yarn_memory_available_percentage(self):
+        """yarn_memory_mb_available / (available + allocated)."""
+        yarn_memory_mb_allocated = self.get_yarn_metric(
+            'yarn-memory-mb-allocated')
+        yarn_memory_mb_available = self.get_yarn_metric(
+            'yarn-memory-mb-available')
+        total_memory = yarn_memory_mb_allocated + yarn_memory_mb_available
+        if total_memory == 0:
+            return 0
+        return float(yarn_memory_mb_available) / total_memory
+
+    @property
+    def container_pending_ratio(self):
+        """ContainerPending / ContainerAllocated, or ContainerPending."""
+        yarn_containers_pending = self.get_yarn_metric(
+            'yarn-containers-pending')
+        yarn_container_allocated = self.get_yarn_metric(
+            'yarn-containers-allocated')
+        if yarn_container_allocated == 0:
+            return yarn_containers_pending
+        return float(yarn_containers_pending) / yarn_container_allocated
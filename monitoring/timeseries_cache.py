@@ -0,0 +1,212 @@
+"""Per cluster cache of recent custom metric points."""
+import datetime
+import logging
+import threading
+import time
+
+import numpy as np
+from google.appengine.api import memcache
+
+from monitoring import metrics
+from util import config
+
+MAX_POINTS = 1024
+
+# Points written by other instances may take a while to be readable, so
+# incremental reads start a little before the last synced time.
+SYNC_OVERLAP_SECONDS = 120
+
+MEMCACHE_PREFIX = 'shamash-ts-'
+MEMCACHE_TTL_SECONDS = 2 * 60 * 60
+
+
+class SeriesWindow(object):
+    """Bounded, time ordered, array backed window of a single series."""
+
+    def __init__(self, capacity=MAX_POINTS):
+        self.times = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.size = 0
+        # The interval that was read from Stackdriver, epoch seconds
+        self.synced_from = None
+        self.synced_until = None
+
+    def __len__(self):
+        return self.size
+
+    def merge(self, times, values):
+        """
+        Add points, replacing the ones with the same timestamp.
+
+        :param times: epoch seconds
+        :param values:
+        """
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if not len(times):
+            return
+        order = times.argsort()
+        times = times[order]
+        values = values[order]
+        size = self.size
+        if size == 0 or times[0] > self.times[size - 1]:
+            if len(times) > len(self.times):
+                times = times[-len(self.times):]
+                values = values[-len(self.values):]
+            overflow = size + len(times) - len(self.times)
+            if overflow > 0:
+                self.times[:size - overflow] = \
+                    self.times[overflow:size].copy()
+                self.values[:size - overflow] = \
+                    self.values[overflow:size].copy()
+                size -= overflow
+            self.times[size:size + len(times)] = times
+            self.values[size:size + len(times)] = values
+            self.size = size + len(times)
+            return
+        # New points first so they win over cached ones with the same
+        # (millisecond rounded) timestamp.
+        all_times = np.concatenate((times, self.times[:size]))
+        all_values = np.concatenate((values, self.values[:size]))
+        _, index = np.unique(np.round(all_times * 1000), return_index=True)
+        index = index[-len(self.times):]
+        self.size = len(index)
+        self.times[:self.size] = all_times[index]
+        self.values[:self.size] = all_values[index]
+
+    def evict(self, before):
+        """Drop the points older than before."""
+        keep = self.times[:self.size].searchsorted(before)
+        if keep:
+            self.size -= keep
+            self.times[:self.size] = \
+                self.times[keep:keep + self.size].copy()
+            self.values[:self.size] = \
+                self.values[keep:keep + self.size].copy()
+        if self.synced_from is not None:
+            self.synced_from = max(self.synced_from, before)
+
+    def since(self, start):
+        """Return copies of the times and values from start on."""
+        first = self.times[:self.size].searchsorted(start)
+        return (self.times[first:self.size].copy(),
+                self.values[first:self.size].copy())
+
+    def to_dict(self):
+        """Serializable form for memcache."""
+        return {
+            'times': self.times[:self.size].tolist(),
+            'values': self.values[:self.size].tolist(),
+            'synced_from': self.synced_from,
+            'synced_until': self.synced_until
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Inverse of to_dict."""
+        window = cls()
+        window.merge(data['times'], data['values'])
+        window.synced_from = data['synced_from']
+        window.synced_until = data['synced_until']
+        return window
+
+
+class TimeSeriesCache(object):
+    """Keep the recent points of every cluster metric in process, fetching
+    only what is newer than the last read."""
+
+    def __init__(self, use_memcache=True):
+        self.use_memcache = use_memcache
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _memcache_key(cluster_name, custom_metric_type):
+        return '{}{}-{}'.format(MEMCACHE_PREFIX, cluster_name,
+                                custom_metric_type)
+
+    def _get_window(self, cluster_name, custom_metric_type):
+        key = (cluster_name, custom_metric_type)
+        window = self._windows.get(key)
+        if window is None and self.use_memcache:
+            data = memcache.get(
+                self._memcache_key(cluster_name, custom_metric_type))
+            if data is not None:
+                window = SeriesWindow.from_dict(data)
+        if window is None:
+            window = SeriesWindow()
+        self._windows[key] = window
+        return window
+
+    def _save(self, cluster_name, windows):
+        if not self.use_memcache:
+            return
+        memcache.set_multi(
+            dict((self._memcache_key(cluster_name, name), window.to_dict())
+                 for name, window in windows.items()),
+            time=MEMCACHE_TTL_SECONDS)
+
+    def record(self, cluster_name, points, timestamp):
+        """
+        Add points that were just written to Stackdriver.
+
+        :param cluster_name:
+        :param points: dict of metric type to value
+        :param timestamp: epoch seconds of the points
+        """
+        windows = {}
+        with self._lock:
+            for custom_metric_type, value in points.items():
+                window = self._get_window(cluster_name, custom_metric_type)
+                window.merge([timestamp], [value])
+                windows[custom_metric_type] = window
+            self._save(cluster_name, windows)
+
+    def read(self, cluster_name, custom_metric_type, minutes):
+        """
+        Get the last minutes of a cluster metric.
+
+        :param cluster_name:
+        :param custom_metric_type:
+        :param minutes:
+        :return: times in epoch seconds, values
+        """
+        now = time.time()
+        start = now - minutes * 60
+        with self._lock:
+            window = self._get_window(cluster_name, custom_metric_type)
+            if window.synced_until is None or window.synced_from > start:
+                fetch_from = start
+            else:
+                fetch_from = max(start,
+                                 window.synced_until - SYNC_OVERLAP_SECONDS)
+
+        met = metrics.Metrics(cluster_name)
+        times, values = met.read_timeseries(
+            custom_metric_type, minutes,
+            start_time=metrics.format_rfc3339(
+                datetime.datetime.utcfromtimestamp(fetch_from)))
+        logging.debug('Read %s new points of %s for %s', len(times),
+                      custom_metric_type, cluster_name)
+
+        with self._lock:
+            window.merge(times, values)
+            if window.synced_from is None or fetch_from == start:
+                window.synced_from = start
+            window.synced_until = now
+            window.evict(start)
+            self._save(cluster_name, {custom_metric_type: window})
+            return window.since(start)
+
+
+_cache = TimeSeriesCache(use_memcache=config.TIMESERIES_CACHE_MEMCACHE)
+
+
+def record(cluster_name, points, timestamp):
+    """Add freshly written points to the process wide cache."""
+    _cache.record(cluster_name, points, timestamp)
+
+
+def read(cluster_name, custom_metric_type, minutes):
+    """Read a cluster metric through the process wide cache."""
+    return _cache.read(cluster_name, custom_metric_type, minutes)
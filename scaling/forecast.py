@@ -0,0 +1,118 @@
+"""Seasonal forecasts of cluster metrics."""
+import numpy as np
+
+DAY_SECONDS = 24 * 60 * 60
+
+HOLT_WINTERS_ALPHA = 0.3
+HOLT_WINTERS_BETA = 0.05
+HOLT_WINTERS_GAMMA = 0.3
+
+
+def resample(times, values, step, start, end, how=np.minimum):
+    """
+    Put a series on a regular grid.
+
+    Each bin keeps the reduction (by default the minimum, i.e. the worst
+    case of available memory) of its points, empty bins are interpolated.
+
+    :param times: sorted epoch seconds
+    :param values:
+    :param step: bin width in seconds
+    :param start: first bin start
+    :param end: last bin end
+    :param how: numpy ufunc used to reduce a bin
+    :return: bin start times, values
+    """
+    grid = np.arange(start, end, float(step))
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    inside = (times >= start) & (times < end)
+    times = times[inside]
+    values = values[inside]
+    if not len(times):
+        return grid, np.zeros(len(grid)) * np.nan
+    bins = ((times - start) // step).astype(int)
+    first = np.concatenate(([0], np.nonzero(np.diff(bins))[0] + 1))
+    reduced = np.zeros(len(grid)) * np.nan
+    reduced[bins[first]] = how.reduceat(values, first)
+    filled = ~np.isnan(reduced)
+    reduced = np.interp(grid, grid[filled], reduced[filled])
+    return grid, reduced
+
+
+def seasonal_naive(values, season_length, horizon):
+    """
+    Forecast each step as the mean of the same step of the past seasons.
+
+    :param values: regular series, at least one season long
+    :param season_length: steps per season
+    :param horizon: steps to forecast
+    :return: array of horizon values
+    """
+    values = np.asarray(values, dtype=float)
+    seasons = len(values) // season_length
+    history = values[len(values) - seasons * season_length:].reshape(
+        seasons, season_length)
+    profile = history.mean(axis=0)
+    return profile[np.arange(horizon) % season_length]
+
+
+def holt_winters(values, season_length, horizon, alpha=HOLT_WINTERS_ALPHA,
+                 beta=HOLT_WINTERS_BETA, gamma=HOLT_WINTERS_GAMMA):
+    """
+    Additive Holt-Winters forecast.
+
+    :param values: regular series, at least two seasons long
+    :param season_length: steps per season
+    :param horizon: steps to forecast
+    :return: array of horizon values
+    """
+    values = np.asarray(values, dtype=float)
+    m = season_length
+    level = values[:m].mean()
+    trend = (values[m:2 * m].mean() - level) / m
+    seasonal = list(values[:m] - level)
+    for i in range(m, len(values)):
+        previous_level = level
+        level = alpha * (values[i] - seasonal[i - m]) + \
+            (1 - alpha) * (level + trend)
+        trend = beta * (level - previous_level) + (1 - beta) * trend
+        seasonal.append(gamma * (values[i] - level) +
+                        (1 - gamma) * seasonal[i - m])
+    steps = np.arange(1, horizon + 1)
+    last_season = np.array(seasonal[-m:])
+    return level + steps * trend + last_season[(steps - 1) % m]
+
+
+def forecast(times, values, now, horizon_seconds, step,
+             season_seconds=DAY_SECONDS):
+    """
+    Forecast a metric from its history.
+
+    Uses Holt-Winters with two or more seasons of history and the seasonal
+    naive forecast with one.
+
+    :param times: epoch seconds of the history
+    :param values:
+    :param now: epoch seconds the history ends at
+    :param horizon_seconds: how far ahead to forecast
+    :param step: resolution in seconds, must divide season_seconds
+    :param season_seconds: length of the season
+    :return: forecast times and values, None if the history is too short
+    """
+    season_length = int(season_seconds // step)
+    if not len(times):
+        return None
+    seasons = int((now - times[0]) // season_seconds)
+    if seasons < 1:
+        return None
+    start = now - seasons * season_seconds
+    _, regular = resample(times, values, step, start, now)
+    if np.isnan(regular).any():
+        return None
+    horizon = int(np.ceil(horizon_seconds / float(step)))
+    if seasons >= 2:
+        predicted = holt_winters(regular, season_length, horizon)
+    else:
+        predicted = seasonal_naive(regular, season_length, horizon)
+    return now + step * np.arange(1, horizon + 1), predicted
@@ -0,0 +1,37 @@
+"""Route fresh monitoring data to the scaling decision."""
+from __future__ import absolute_import
+
+import logging
+
+from monitoring import dataproc_monitoring, metrics
+from scaling import scaling, scaling_decisions
+from util import config
+
+
+def handle_monitor_data(monitor_data_list):
+    """
+    Act on the monitoring data of clusters as config.PIPELINE_MODE says.
+
+    In pubsub mode the data is published to the monitoring topic. In direct
+    mode the clusters are decided and sized here and /patch is enqueued
+    without going through Pub/Sub.
+
+    :param monitor_data_list: list of DataProc.get_monitor_data() results
+    """
+    if config.PIPELINE_MODE != 'direct':
+        dataproc_monitoring.publish_monitor_data(monitor_data_list)
+        return
+
+    batch = metrics.TimeSeriesBatch()
+    for monitor_data in monitor_data_list:
+        body = scaling_decisions.decide_scaling(monitor_data, batch)
+        if body is None:
+            continue
+        try:
+            scaling.Scale(body).do_scale()
+        except (scaling.ScalingException,
+                dataproc_monitoring.DataProcException) as e:
+            logging.error('Scaling %s failed: %s', monitor_data['cluster'], e)
+    batch.flush()
+    if config.PIPELINE_FANOUT:
+        dataproc_monitoring.publish_monitor_data(monitor_data_list)
@@ -0,0 +1,410 @@
+"""Scaling policy.
+
+Pure functions from what a cluster looks like to how big it should be. They
+don't read or write anything, so they can be run over any number of clusters
+at once, from the scaling handlers, the simulator or a preview.
+"""
+from __future__ import absolute_import
+
+import logging
+import math
+
+from scaling import trend
+
+TIME_SERIES_HISTORY_IN_MINUTES = 60
+
+TREND_METRICS = ('YARNMemoryAvailablePercentage', 'ContainerPendingRatio',
+                 'YarnNodes')
+
+# Roughly how long new Dataproc nodes take to join the cluster
+SCALE_HORIZON_MINUTES = 10
+
+# A trend based step never changes the cluster by more than this share
+MAX_TREND_STEP_FRACTION = 0.5
+
+# Why a cluster should change size
+PENDING_UP = 'pending_up'
+PENDING_DOWN = 'pending_down'
+IDLE = 'idle'
+MEMORY_UP = 'memory_up'
+MEMORY_DOWN = 'memory_down'
+FORECAST = 'forecast'
+STEADY = 'steady'
+MISSING_METRICS = 'missing_metrics'
+
+UP_REASONS = (PENDING_UP, MEMORY_UP, FORECAST)
+DOWN_REASONS = (PENDING_DOWN, IDLE, MEMORY_DOWN)
+
+
+class Record(object):
+    """What the policy is told about a cluster."""
+
+    def __init__(self, snapshot, cluster_settings, history=None,
+                 predicted_memory_available_percentage=None):
+        """
+        :param snapshot: ClusterSnapshot
+        :param cluster_settings: the cluster Settings
+        :param history: dict of TREND_METRICS to (times, values) over the
+        last TIME_SERIES_HISTORY_IN_MINUTES, only used when a delta is 0
+        :param predicted_memory_available_percentage: forecast
+        YARNMemoryAvailablePercentage, if predictive scaling is on
+        """
+        self.snapshot = snapshot
+        self.cluster_settings = cluster_settings
+        self.history = history
+        self.predicted_memory_available_percentage = \
+            predicted_memory_available_percentage
+
+
+class Decision(object):
+    """What the policy wants for a cluster."""
+
+    def __init__(self, cluster_name, reason, current_nodes=None, target=None,
+                 containerpendingratio=-1, scale_to=-1,
+                 predicted_memory_available_percentage=None):
+        self.cluster_name = cluster_name
+        self.reason = reason
+        self.current_nodes = current_nodes
+        self.containerpendingratio = containerpendingratio
+        self.scale_to = scale_to
+        self.predicted_memory_available_percentage = \
+            predicted_memory_available_percentage
+        if target is None:
+            self.workers, self.preemptibles = None, None
+        else:
+            self.workers, self.preemptibles = target
+
+    @property
+    def direction(self):
+        """'up', 'down' or None."""
+        return get_direction(self.reason)
+
+    def to_dict(self):
+        return {
+            'cluster': self.cluster_name,
+            'reason': self.reason,
+            'scaling_direction': self.direction,
+            'current_nodes': self.current_nodes,
+            'new_workers': self.workers,
+            'new_preemptible': self.preemptibles
+        }
+
+    def __repr__(self):
+        return 'Decision({})'.format(self.to_dict())
+
+
+def get_direction(reason):
+    """The scaling direction of a reason, 'up', 'down' or None."""
+    if reason in UP_REASONS:
+        return 'up'
+    if reason in DOWN_REASONS:
+        return 'down'
+    return None
+
+
+def decide(memory_available, pending_ratio, number_of_nodes,
+           cluster_settings, predicted_memory_available_percentage=None):
+    """
+    Apply the scaling rules to the monitoring data of a cluster.
+
+    :param memory_available: yarn_memory_available_percentage, a 0..1
+    fraction, compared in percent with the settings
+    :param pending_ratio: container_pending_ratio
+    :param number_of_nodes: active YARN nodes
+    :param cluster_settings: the cluster Settings
+    :param predicted_memory_available_percentage: forecast, scales out ahead
+    of a shortage instead of waiting for it
+    :return: reason
+    """
+    reason = STEADY
+    # pending containers are waiting....
+    if pending_ratio > cluster_settings.UpContainerPendingRatio:
+        reason = PENDING_UP
+    elif pending_ratio < cluster_settings.DownContainerPendingRatio:
+        reason = PENDING_DOWN
+    # No memory is allocated so no needs for more nodes just scale down to
+    # the minimum
+    elif memory_available == 1:
+        if number_of_nodes > cluster_settings.MinInstances:
+            reason = IDLE
+    # We don't have enough memory lets go up
+    elif 100 * memory_available < cluster_settings.UpYARNMemAvailPct:
+        reason = MEMORY_UP
+    # we have too much memory  :)
+    elif 100 * memory_available > cluster_settings.DownYARNMemAvailePct:
+        reason = MEMORY_DOWN
+    if predicted_memory_available_percentage is not None and \
+            reason not in UP_REASONS and \
+            predicted_memory_available_percentage < \
+            cluster_settings.UpYARNMemAvailPct:
+        reason = FORECAST
+    return reason
+
+
+def reason_from_message(data):
+    """
+    Recover the reason of a scaling message.
+
+    :param data: decoded scaling message
+    :return: reason
+    """
+    if data.get('reason'):
+        return data['reason']
+    if data['scale_to'] != -1:
+        return IDLE
+    if data.get('predicted_memory_available_percentage') is not None:
+        return FORECAST
+    if data['containerpendingratio'] != -1:
+        if data['scaling_direction'] == 'up':
+            return PENDING_UP
+        return PENDING_DOWN
+    if data['scaling_direction'] == 'up':
+        return MEMORY_UP
+    return MEMORY_DOWN
+
+
+def needs_history(cluster_settings, reason):
+    """
+    Whether calc_total reads the metric history for a reason.
+
+    :param cluster_settings: the cluster Settings
+    :param reason: output of decide
+    :return: bool
+    """
+    if reason == MEMORY_UP:
+        return cluster_settings.AddRemoveUpDelta == 0
+    if reason == MEMORY_DOWN:
+        return cluster_settings.AddRemoveDownDelta == 0
+    return False
+
+
+def calc_trend_step(direction, features, current_nodes):
+    """
+    How many nodes the trend asks for in the scaling direction.
+
+    The change of available memory projected over the provisioning
+    horizon is converted to the share of the cluster needed to absorb
+    it. On the way up a rising pending ratio asks for at least as many
+    nodes as it projects. Trends that point the other way or that don't
+    stand out of the noise move by a single node.
+
+    :param direction: 1 for up, -1 for down
+    :param features: trend.compute of TREND_METRICS
+    :param current_nodes: active YARN nodes
+    :return: number of nodes
+    """
+    memory = features['YARNMemoryAvailablePercentage']
+    pending = features['ContainerPendingRatio']
+    nodes = features['YarnNodes']
+    base = nodes.ewma if nodes.points else current_nodes
+    change = memory.project(SCALE_HORIZON_MINUTES)
+    step = 1
+    if -direction * change > math.sqrt(memory.residual_variance):
+        step = abs(change) / 100.0 * base
+    if direction > 0 and pending.slope > 0:
+        expected_pending = pending.ewma + pending.project(
+            SCALE_HORIZON_MINUTES)
+        step = max(step, expected_pending * base)
+    step = min(step, max(1, MAX_TREND_STEP_FRACTION * base))
+    return int(math.ceil(step))
+
+
+def calc_forecast_total(record, current_nodes):
+    """
+    How many nodes are needed for the forecast demand.
+
+    The memory in use at the forecast availability is spread over enough
+    nodes to bring availability back between the scale out and scale in
+    thresholds.
+    """
+    cluster_settings = record.cluster_settings
+    predicted = record.predicted_memory_available_percentage
+    if cluster_settings.AddRemoveUpDelta != 0:
+        total = current_nodes + cluster_settings.AddRemoveUpDelta
+    else:
+        target = (cluster_settings.UpYARNMemAvailPct +
+                  cluster_settings.DownYARNMemAvailePct) / 200.0
+        demand = current_nodes * (1 - predicted / 100.0)
+        total = max(current_nodes + 1, int(math.ceil(demand / (1 - target))))
+    logging.info('Forecast YARNMemAvailPct %s, new workers %s prev %s',
+                 predicted, total, current_nodes)
+    return total
+
+
+def calc_total(record, reason):
+    """
+    Calculate how many nodes the cluster should have.
+
+    :param record: Record
+    :param reason: output of decide
+    :return: number of nodes or None if it can't be calculated
+    """
+    snapshot = record.snapshot
+    cluster_settings = record.cluster_settings
+    current_nodes = snapshot.get_yarn_metric('yarn-nodes-active')
+    direction = 1 if get_direction(reason) == 'up' else -1
+
+    # No allocated memory so we don't need any workers above the
+    # bare minimum
+    if reason == IDLE:
+        if cluster_settings.AddRemoveDownDelta != 0:
+            return max(current_nodes - cluster_settings.AddRemoveDownDelta,
+                       cluster_settings.MinInstances)
+        return cluster_settings.MinInstances
+
+    # the forecast says we will run out of memory
+    if reason == FORECAST:
+        return calc_forecast_total(record, current_nodes)
+
+    # pending containers are waiting....
+    if reason in (PENDING_UP, PENDING_DOWN):
+        if current_nodes == 0:
+            logging.info('No active nodes on %s, can not size it',
+                         snapshot.cluster_name)
+            return None
+        yarn_containers_allocated = snapshot.get_yarn_metric(
+            'yarn-containers-allocated')
+        yarn_containers_pending = snapshot.get_yarn_metric(
+            'yarn-containers-pending')
+        ratio = float(int(yarn_containers_allocated) / int(current_nodes))
+        if ratio == 0:
+            logging.info('No containers allocated on %s, can not size it',
+                         snapshot.cluster_name)
+            return None
+        factor = float(int(yarn_containers_pending) / ratio)
+        if cluster_settings.AddRemoveUpDelta != 0:
+            total = current_nodes + \
+                direction * cluster_settings.AddRemoveUpDelta
+        elif reason == PENDING_UP:
+            total = int(current_nodes * factor)
+        else:
+            total = int((current_nodes *
+                         (100 - cluster_settings.DownContainerPendingRatio) /
+                         100))
+        logging.debug(
+            'yarn_containers_allocated %s pending %s ratio %s factor %s'
+            ' current %s total %s', yarn_containers_allocated,
+            yarn_containers_pending, ratio, factor, current_nodes, total)
+        return total
+
+    # no more memory lets get some  nodes. calculate how many memory each
+    # node uses. Then calculate how many nodes we need by memory
+    # consumption
+    if not cluster_settings.UseMemoryForScaling:
+        return 0
+    if snapshot.yarn_memory_available_percentage == 0:
+        if current_nodes == 0:
+            logging.info('No active nodes on %s, can not size it',
+                         snapshot.cluster_name)
+            return None
+        yarn_memory_mb_allocated = snapshot.get_yarn_metric(
+            'yarn-memory-mb-allocated')
+        yarn_memory_mb_pending = snapshot.get_yarn_metric(
+            'yarn-memory-mb-pending')
+        ratio = float(int(yarn_memory_mb_allocated) / int(current_nodes))
+        if ratio == 0:
+            ratio = 1
+        factor = float(int(yarn_memory_mb_pending) / ratio)
+        if cluster_settings.AddRemoveUpDelta != 0:
+            total = current_nodes + cluster_settings.AddRemoveUpDelta
+        else:
+            total = int(current_nodes * factor)
+        logging.debug(
+            'yarn_memory_mb_allocated %s pending %s ratio %s factor %s'
+            ' current %s total %s', yarn_memory_mb_allocated,
+            yarn_memory_mb_pending, ratio, factor, current_nodes, total)
+        return total
+
+    if direction == 1:
+        delta = cluster_settings.AddRemoveUpDelta
+    else:
+        delta = cluster_settings.AddRemoveDownDelta
+    if delta == 0:
+        features = trend.compute(record.history or {},
+                                 'YARNMemoryAvailablePercentage')
+        for custom_metric_type in TREND_METRICS:
+            features.setdefault(custom_metric_type, trend.TrendFeatures())
+        delta = calc_trend_step(direction, features, current_nodes)
+    return current_nodes + direction * delta
+
+
+def preserve_ratio(cluster_settings, total):
+    """
+    Split a number of nodes into workers and preemptible workers.
+
+    :return: new_workers, new_preemptible
+    """
+    scale_ratio = (float(cluster_settings.PreemptiblePct) / 100.0)
+    new_preemptible = int(round(scale_ratio * total))
+    new_workers = int(round((1 - scale_ratio) * total))
+
+    # Make sure that we have the minimum normal workers
+    if new_workers < cluster_settings.MinInstances:
+        diff = cluster_settings.MinInstances - new_workers
+        new_workers = cluster_settings.MinInstances
+        new_preemptible = new_preemptible - diff
+
+    # Make sure that we have the requested number of preemptible workers
+    if total > new_workers + new_preemptible:
+        diff = total - (new_workers + new_preemptible)
+        new_preemptible = new_preemptible + diff
+
+    new_preemptible = max(0, new_preemptible)
+    logging.debug('new_workers %s new_preemptible %s', new_workers,
+                  new_preemptible)
+    return new_workers, new_preemptible
+
+
+def calc_target(record, reason):
+    """
+    Calculate the new number of workers of each type.
+
+    :param record: Record
+    :param reason: output of decide
+    :return: new_workers, new_preemptible or None if the cluster size
+    should not change
+    """
+    if get_direction(reason) is None:
+        return None
+    total = calc_total(record, reason)
+    if total is None:
+        return None
+    total = min(total, record.cluster_settings.MaxInstances)
+    if total == record.snapshot.get_yarn_metric('yarn-nodes-active'):
+        return None
+    # make sure that we have the correct ratio between 2 type of workers
+    return preserve_ratio(record.cluster_settings, total)
+
+
+def evaluate(records):
+    """
+    Decide the size of a batch of clusters.
+
+    :param records: iterable of Record
+    :return: list of Decision, in the same order
+    """
+    decisions = []
+    for record in records:
+        snapshot = record.snapshot
+        cluster_settings = record.cluster_settings
+        try:
+            pending_ratio = snapshot.container_pending_ratio
+            reason = decide(
+                snapshot.yarn_memory_available_percentage, pending_ratio,
+                snapshot.get_yarn_metric('yarn-nodes-active'),
+                cluster_settings,
+                record.predicted_memory_available_percentage)
+            current_nodes = snapshot.get_yarn_metric('yarn-nodes-active')
+            target = calc_target(record, reason)
+        except KeyError as e:
+            logging.warning('Cluster %s is missing %s',
+                            snapshot.cluster_name, e)
+            decisions.append(Decision(snapshot.cluster_name, MISSING_METRICS))
+            continue
+        decisions.append(Decision(
+            snapshot.cluster_name, reason, current_nodes, target,
+            pending_ratio if reason in (PENDING_UP, PENDING_DOWN) else -1,
+            cluster_settings.MinInstances if reason == IDLE else -1,
+            record.predicted_memory_available_percentage
+            if reason == FORECAST else None))
+    return decisions
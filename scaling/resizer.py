@@ -0,0 +1,160 @@
+"""Cluster resizes tracked through their Dataproc operations."""
+from __future__ import absolute_import
+
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from googleapiclient.errors import HttpError
+
+from model import resize
+from monitoring import dataproc_monitoring
+from util import config
+
+# Delay before the first poll of a patch operation, doubled up to the max
+FIRST_POLL_SECONDS = 15
+MAX_POLL_SECONDS = 60
+
+
+def _enqueue(url, cluster_name, countdown, **params):
+    params['cluster_name'] = cluster_name
+    task = taskqueue.add(queue_name='shamash',
+                         url=url,
+                         method='GET',
+                         countdown=countdown,
+                         params=params)
+    logging.debug('Task %s enqueued, ETA %s Cluster %s', task.name, task.eta,
+                  cluster_name)
+
+
+def _enqueue_poll(cluster_name, operation_name, polls):
+    _enqueue('/patch/poll', cluster_name,
+             min(FIRST_POLL_SECONDS * 2 ** polls, MAX_POLL_SECONDS),
+             operation=operation_name)
+
+
+def _record_finished(cluster_name, cooldown_seconds, error=None):
+    state, countdown = resize.record_finished(cluster_name, error,
+                                              cooldown_seconds)
+    if countdown is not None:
+        logging.info('Cluster %s patching the queued %s %s in %ds',
+                     cluster_name, state.Workers, state.Preemptibles,
+                     countdown)
+        _enqueue('/patch', cluster_name, countdown)
+    return state
+
+
+def _finish(cluster_settings, error=None):
+    return _record_finished(cluster_settings.Cluster,
+                            cluster_settings.CooldownMinutes * 60, error)
+
+
+def request_resize(cluster_settings, new_workers, new_preemptible, direction,
+                   observed_at=None):
+    """
+    Resize a cluster unless it is already being resized.
+
+    :param cluster_settings: the cluster Settings
+    :param direction: 'up' or 'down'
+    :param observed_at: epoch seconds the cluster data the size was decided
+    on was read
+    :return: response body, status code
+    """
+    cluster_name = cluster_settings.Cluster
+    outcome, countdown = resize.claim(
+        cluster_name, new_workers, new_preemptible, direction, observed_at,
+        cluster_settings.CooldownMinutes * 60,
+        cluster_settings.StabilizationMinutes * 60)
+    logging.info('Resize of %s to %s %s %s', cluster_name, new_workers,
+                 new_preemptible, outcome)
+    if outcome == resize.CLAIMED:
+        _enqueue('/patch', cluster_name, countdown)
+        return 'ok', 204
+    if outcome == resize.STABILIZING:
+        return 'Stabilizing', 200
+    return 'Queued', 200
+
+
+def start_resize(cluster_name):
+    """
+    Submit the patch of the pending resize of a cluster and schedule polling
+    its operation.
+
+    :return: response body, status code
+    """
+    state = resize.begin_patch(cluster_name)
+    if state is None:
+        logging.info('No resize of %s is pending', cluster_name)
+        return 'Gone', 200
+    # The lease is running from here on, release it on any failure so the
+    # cluster isn't left waiting for an operation that was never started
+    dp = None
+    try:
+        dp = dataproc_monitoring.DataProc(cluster_name)
+        logging.debug('Patching new_workers %s new_preemptible %s',
+                      state.Workers, state.Preemptibles)
+        operation_name, remaining = dp.patch_cluster(state.Workers,
+                                                     state.Preemptibles)
+        if operation_name is not None:
+            resize.record_started(cluster_name, operation_name, remaining)
+            _enqueue_poll(cluster_name, operation_name, 0)
+    except Exception as e:
+        if dp is not None:
+            _finish(dp.cluster_settings, str(e))
+        else:
+            _record_finished(cluster_name, 0, str(e))
+        raise
+    if operation_name is None:
+        _finish(dp.cluster_settings)
+        return 'Not Modified', 200
+    if state.ObservedAt:
+        logging.info('Cluster %s patched %.1fs after it was read (%s)',
+                     cluster_name, time.time() - state.ObservedAt,
+                     config.PIPELINE_MODE)
+    return 'ok', 200
+
+
+def poll_resize(cluster_name, operation_name):
+    """
+    Check the operation of a resize, moving it on when it is done.
+
+    :return: response body, status code
+    """
+    state = resize.get_state(cluster_name)
+    if state is None or not state.in_flight or \
+            state.OperationName != operation_name:
+        logging.info('Operation %s of %s is no longer tracked',
+                     operation_name, cluster_name)
+        return 'Gone', 200
+
+    dp = dataproc_monitoring.DataProc(cluster_name)
+    operation = dp.get_operation(operation_name)
+    if not operation.get('done'):
+        if state.running_expired:
+            _finish(dp.cluster_settings,
+                    'Operation {} timed out'.format(operation_name))
+            return 'Timed out', 200
+        state = resize.record_poll(cluster_name)
+        _enqueue_poll(cluster_name, operation_name, state.Polls)
+        return 'Running', 200
+
+    if 'error' in operation:
+        _finish(dp.cluster_settings,
+                operation['error'].get('message', 'Unknown error'))
+        return 'Failed', 200
+    if state.RemainingChanges:
+        try:
+            next_operation = dp.patch_changes(state.RemainingChanges[:1])
+        except HttpError as e:
+            _finish(dp.cluster_settings, str(e))
+            return 'Failed', 200
+        resize.record_started(cluster_name, next_operation,
+                              state.RemainingChanges[1:])
+        _enqueue_poll(cluster_name, next_operation, 0)
+        return 'Running', 200
+    _finish(dp.cluster_settings)
+    if state.ObservedAt:
+        logging.info('Cluster %s resized %.1fs after it was read (%s)',
+                     cluster_name, time.time() - state.ObservedAt,
+                     config.PIPELINE_MODE)
+    return 'ok', 200
@@ -1,15 +1,18 @@
 """Handle scaling."""
+from __future__ import absolute_import
+
 import base64
 import json
 import logging
+import time
 
-import numpy as np
-from google.appengine.api import taskqueue
+from googleapiclient.errors import HttpError
 
 from model import settings
-from monitoring import dataproc_monitoring, metrics
-
-TIME_SERIES_HISTORY_IN_MINUTES = 60
+from monitoring import dataproc_monitoring, snapshot, timeseries_cache
+from scaling import policy, resizer, scaling_decisions
+from util import (concurrency, config, instrumentation, pubsub, tracing,
+                  utils)
 
 
 class ScalingException(Exception):
@@ -25,118 +28,106 @@ class ScalingException(Exception):
 class Scale(object):
     """Class for all scaling operations."""
 
-    def __init__(self, payload):
-        data = json.loads(base64.b64decode(payload))
-        s = settings.get_cluster_settings(data['cluster'])
-        if s.count(1) == 1:
-            for st in s:
-                self.cluster_settings = st
+    def __init__(self, payload, cluster_settings=None, dataproc=None,
+                 timeseries=None):
+        """
+        :param payload: base64 encoded scaling message, or the message
+        itself when it didn't go through Pub/Sub
+        :param cluster_settings: the cluster Settings, looked up if not given
+        :param dataproc: DataProc to read the cluster from when the message
+        has no snapshot, created if not given
+        :param timeseries: source of the metric history with a
+        read(cluster_name, custom_metric_type, minutes) function, defaults
+        to timeseries_cache
+        """
+        if isinstance(payload, dict):
+            data = payload
         else:
+            data = json.loads(base64.b64decode(payload))
+        if cluster_settings is None:
+            cluster_settings = settings.get_cluster_settings(data['cluster'])
+        self.cluster_settings = cluster_settings
+        if self.cluster_settings is None:
             raise ScalingException('Cluster not found!')
 
-        self.total = 0
-        self.dataproc = dataproc_monitoring.DataProc(data['cluster'])
-        self.scale_to = data['scale_to']
-        self.scaling_direction = data['scaling_direction']
-        self.containerpendingratio = data['containerpendingratio']
         self.cluster_name = self.cluster_settings.Cluster
-        self.preemptible_pct = self.cluster_settings.PreemptiblePct
-        self.min_instances = self.cluster_settings.MinInstances
-        self.max_instances = self.cluster_settings.MaxInstances
-        self.use_memory = self.cluster_settings.UseMemoryForScaling
-
-        self.up_container_pending_ratio = \
-            self.cluster_settings.UpContainerPendingRatio
-        self.down_container_pending_ratio = \
-            self.cluster_settings.DownContainerPendingRatio
-        if self.preemptible_pct != 100:
-            self.preemptibles_to_workers_ratio = self.preemptible_pct / (
-                100 - self.preemptible_pct)
-        else:
-            self.preemptibles_to_workers_ratio = -1
-
+        self.timeseries = timeseries or timeseries_cache
+        self.reason = policy.reason_from_message(data)
+        self.predicted_memory_available_percentage = data.get(
+            'predicted_memory_available_percentage')
+
+        # Decide on the data that triggered the message rather than
+        # reading the cluster again
+        self.snapshot = None
+        if data.get('snapshot'):
+            self.snapshot = snapshot.ClusterSnapshot.from_dict(
+                data['snapshot'])
+        if self.snapshot is None:
+            if dataproc is None:
+                dataproc = dataproc_monitoring.DataProc(
+                    self.cluster_name, self.cluster_settings)
+            try:
+                dataproc.get_cluster_status()
+                self.snapshot = dataproc.get_snapshot()
+            except dataproc_monitoring.DataProcException as e:
+                logging.error(e)
+                raise e
+        self.cluster_status = self.snapshot.status
         try:
-            self.cluster_status = self.dataproc.get_cluster_status()
-            self.current_nodes = \
-                int(self.dataproc.get_yarn_metric('yarn-nodes-active'))
-        except dataproc_monitoring.DataProcException as e:
-            logging.error(e)
-            raise e
-
-    def calc_how_many(self):
+            self.current_nodes = int(
+                self.snapshot.get_yarn_metric('yarn-nodes-active'))
+        except KeyError as e:
+            raise ScalingException(e)
+
+        self.age = time.time() - self.snapshot.fetched_at
+        self.expired = self.age > config.SCALING_MESSAGE_MAX_AGE_SECONDS
+        settings_version = data.get('settings_version')
+        if settings_version is not None and \
+                settings_version != self.cluster_settings.Version:
+            logging.info('Settings of %s changed since the decision, '
+                         'deciding again', self.cluster_name)
+            self.reason = policy.decide(
+                self.snapshot.yarn_memory_available_percentage,
+                self.snapshot.container_pending_ratio, self.current_nodes,
+                self.cluster_settings,
+                self.predicted_memory_available_percentage)
+
+    def read_history(self):
         """
-        Calculate how  many new nodes of each type we need.
+        Read the history of the trend metrics.
 
-        :return:
+        :return: dict of metric to (times, values)
         """
-        # No allocated memory so we don't need any workers above the
-        # bare minimum
-        if self.scale_to != -1:
-            if self.cluster_settings.AddRemoveDownDelta != 0:
-                self.total = max(self.current_nodes -
-                                 self.cluster_settings.AddRemoveDownDelta,
-                                 self.cluster_settings.MinInstances)
-            else:
-                self.total = self.min_instances
-            logging.debug('No allocated memory lets go down! New workers %s'
-                          ' New preemptibel', self.total)
-            return
-
-        # pending containers are waiting....
-        if self.containerpendingratio != -1:
-            if self.scaling_direction == 'up':
-                direction = 1
-            else:
-                direction = -1
-            yarn_containers_allocated, yarn_containers_pending = \
-                self.dataproc.get_container_data()
-            ratio = float(
-                int(yarn_containers_allocated) / int(self.current_nodes))
-            factor = float(int(yarn_containers_pending) / ratio)
-            if self.cluster_settings.AddRemoveUpDelta != 0:
-                self.total = self.current_nodes + direction * self.cluster_settings.AddRemoveUpDelta
-            else:
-                if self.scaling_direction == 'up':
-                    self.total = int(self.current_nodes * factor)
-                else:
-                    self.total = int(
-                        (self.current_nodes *
-                         (100 - self.down_container_pending_ratio) / 100))
-            logging.debug(
-                'yarn_containers_allocated %s pending %s ratio %s factor %s'
-                ' current %s total %s', yarn_containers_allocated,
-                yarn_containers_pending, ratio, factor, self.current_nodes,
-                self.total)
-            logging.debug('Need more containers! New workers %s  prev %s',
-                          self.total, self.current_nodes)
-            return
+        history = {}
+        for custom_metric_type in policy.TREND_METRICS:
+            history[custom_metric_type] = self.timeseries.read(
+                self.cluster_name, custom_metric_type,
+                policy.TIME_SERIES_HISTORY_IN_MINUTES)
+        return history
+
+    def calc_target(self):
+        """
+        Calculate the new number of workers of each type.
 
-        # no more memory lets get some  nodes. calculate how many memory each
-        # node uses. Then calculate how many nodes we need by memory
-        # consumption
-        if self.use_memory:
-            if self.dataproc.get_yarn_memory_available_percentage() == 0:
-                yarn_memory_mb_allocated, yarn_memory_mb_pending = \
-                    self.dataproc.get_memory_data()
-                ratio = float(
-                    int(yarn_memory_mb_allocated) / int(self.current_nodes))
-                if ratio == 0:
-                    ratio = 1
-                factor = float(int(yarn_memory_mb_pending) / ratio)
-                if self.cluster_settings.AddRemoveUpDelta != 0:
-                    self.total = self.current_nodes + self.cluster_settings.AddRemoveUpDelta
-                else:
-                    self.total = int(self.current_nodes * factor)
-                logging.debug(
-                    'yarn_memory_mb_allocated %s pending %s ratio %s factor %s'
-                    ' current %s total %s', yarn_memory_mb_allocated,
-                    yarn_memory_mb_pending, ratio, factor, self.current_nodes,
-                    self.total)
-                logging.debug('No More Mem! New workers %s  prev %s',
-                              self.total, self.current_nodes)
-                return
-            self.calc_scale()
+        :return: new_workers, new_preemptible or None if the cluster size
+        should not change
+        """
+        history = None
+        if policy.needs_history(self.cluster_settings, self.reason):
+            history = self.read_history()
+        record = policy.Record(self.snapshot, self.cluster_settings, history,
+                               self.predicted_memory_available_percentage)
+        try:
+            target = policy.calc_target(record, self.reason)
+        except KeyError as e:
+            logging.error(e)
+            raise ScalingException(e)
+        logging.info('Cluster %s %s: workers %s target %s',
+                     self.cluster_name, self.reason, self.current_nodes,
+                     target)
+        return target
 
+    @instrumentation.instrumented('do_scale', 'cluster_name')
     def do_scale(self):
         """
         Calculate and actually scale the cluster.
@@ -144,116 +135,118 @@ class Scale(object):
         :return:
         """
         logging.debug('Starting do_scale %s', self.current_nodes)
-        self.calc_how_many()
-        self.total = min(self.total, self.max_instances)
-        logging.info("Scaling to workers %s", self.total)
-
-        if self.total == self.current_nodes:
+        if self.expired:
+            logging.info('Dropping scaling of %s, its data is %ds old',
+                         self.cluster_name, self.age)
+            return 'Expired', 200
+        target = self.calc_target()
+        if target is None:
             logging.debug('Not Modified')
             return 'Not Modified', 200
-
-        # make sure that we have the correct ratio between 2 type of workers
-        new_workers, new_preemptible = self.preserve_ratio()
-
-        # do the scaling
-        retry_options = taskqueue.TaskRetryOptions(task_retry_limit=0)
-        task = taskqueue.add(queue_name='shamash',
-                             url="/patch",
-                             method='GET',
-                             retry_options=retry_options,
-                             params={
-                                 'cluster_name': self.cluster_name,
-                                 'new_workers': new_workers,
-                                 'new_preemptible': new_preemptible
-                             })
-        logging.debug('Task %s enqueued, ETA %s Cluster %s', task.name,
-                      task.eta, self.cluster_name)
-        return 'ok', 204
-
-    def calc_slope(self, minuets):
-        """
-        Calculate the slope of available memory change.
-
-        :param: minuets how long to go back in time
-        """
-
-        met = metrics.Metrics(self.cluster_name)
-        series = met.read_timeseries('YARNMemoryAvailablePercentage', minuets)
-        retlist = []
-        x = []
-        y = []
-        retlist.extend(series[0]['points'])
-        i = len(retlist)
-        for rl in retlist:
-            x.insert(0, rl['value']['doubleValue'])
-            y.insert(0, i)
-            i = i - 1
+        new_workers, new_preemptible = target
+
+        logging.info('Cluster %s decided %.1fs after it was read',
+                     self.cluster_name, time.time() - self.snapshot.fetched_at)
+        return resizer.request_resize(
+            self.cluster_settings, new_workers, new_preemptible,
+            policy.get_direction(self.reason), self.snapshot.fetched_at)
+
+
+def _is_transient(e):
+    """Whether scaling a cluster that failed with e may work on a retry."""
+    cause = getattr(e, 'parameter', None)
+    return isinstance(cause, HttpError) and not utils.fatal_code(cause)
+
+
+def scale_message(payload):
+    """
+    Size every cluster of a scaling message.
+
+    Clusters that can't be scaled, e.g. because they were deleted or miss a
+    metric, are logged and skipped. Those that failed on an error that may
+    go away are published again on their own so the other clusters of the
+    message are not sized twice.
+
+    :param payload: data of a scaling message
+    :return: response body, status code. For a single cluster those of
+    do_scale, an error if a cluster has to be retried and could not be
+    published again, so that the message is delivered again.
+    """
+    items = pubsub.decode_items(payload)
+    tracing.set_items(len(items))
+    results = []
+    retry = []
+    for data in items:
         try:
-            slope, intercept = np.polyfit(x, y, 1)
-            logging.debug('Slope is %s', slope)
-        except np.RankWarning:
-            # not enough data so add remove by 2
-            if self.scaling_direction == 'up':
-                slope = 1
-            else:
-                slope = -1
-            logging.debug('No Data slope is %s', slope)
-
-        return slope
-
-    def calc_scale(self):
-        """
-        How many nodes to add.
-
-        :return:
-        """
-
-        sl = self.calc_slope(TIME_SERIES_HISTORY_IN_MINUTES)
-        if sl != 0:
-            slope = (1 / sl)
-            logging.debug('Slope is %s', slope)
-            if slope > 0:
-                if self.cluster_settings.AddRemoveUpDelta != 0:
-                    self.total = self.total + self.cluster_settings.AddRemoveUpDelta
-                else:
-                    self.total = self.total + slope
-            if slope < 0:
-                if self.cluster_settings.AddRemoveDownDelta != 0:
-                    self.total = self.total - self.cluster_settings.AddRemoveDownDelta
-                else:
-                    self.total = self.total + slope
-            logging.debug('New workers %s  prev %s', self.total,
-                          self.current_nodes)
-
-        logging.info('New workers %s prev %s', self.total, self.current_nodes)
-
-    def preserve_ratio(self):
-        """
-        Make sure that we have the correct ratio between the 2 types of
-        workers.
-        """
-
-        scale_ratio = (float(self.cluster_settings.PreemptiblePct) / 100.0)
-        new_preemptible = int(round(scale_ratio * self.total))
-        new_workers = int(round((1 - scale_ratio) * self.total))
-        logging.debug('new_workers %s new_preemptible %s', new_workers,
-                      new_preemptible)
-
-        # Make sure that we have the minimum normal workers
-        if new_workers < self.min_instances:
-            logging.debug('Adjusting minimum as well %s', new_workers)
-            diff = self.min_instances - new_workers
-            new_workers = self.min_instances
-            new_preemptible = new_preemptible - diff
-
-        # Make sure that we didn't fuck up and we have the requested number of
-        # preemptible workers
-        if self.total > new_workers + new_preemptible:
-            logging.debug('Adjusting number of preemptible workers to %s',
-                          new_preemptible)
-            diff = self.total - (new_workers + new_preemptible)
-            new_preemptible = new_preemptible + diff
-
-        new_preemptible = max(0, new_preemptible)
-        logging.debug('After adjustment %s %s ', new_workers, new_preemptible)
-        return new_workers, new_preemptible
+            results.append(Scale(data).do_scale())
+        except (ScalingException,
+                dataproc_monitoring.DataProcException) as e:
+            if not _is_transient(e):
+                logging.warning('Dropping scaling of %s: %s',
+                                data.get('cluster'), e)
+                continue
+            logging.info('Scaling %s failed: %s', data.get('cluster'), e)
+            retry.append(data)
+    if retry:
+        if len(items) == 1:
+            return 'error', 500
+        publisher = pubsub.Publisher(scaling_decisions.SCALING_TOPIC)
+        for data in retry:
+            publisher.add(data)
+        if publisher.flush():
+            return 'error', 500
+        logging.info('Published %s clusters again', len(retry))
+        return 'OK', 200
+    if len(results) == 1:
+        return results[0]
+    return 'OK', 200
+
+
+def preview(clusters_settings):
+    """
+    What the policy would do to clusters right now, without scaling them.
+
+    :param clusters_settings: list of Settings
+    :return: list of policy.Decision
+    """
+
+    def _record(cluster_settings):
+        dp = dataproc_monitoring.DataProc(cluster_settings.Cluster,
+                                          cluster_settings)
+        cluster_snapshot = dp.get_snapshot()
+        predicted = None
+        if cluster_settings.PredictiveScaling:
+            predicted = scaling_decisions.get_memory_forecast(
+                cluster_settings.Cluster,
+                cluster_settings.ProvisioningLeadMinutes)
+        # Like Scale.calc_target only read the history if the reason uses it
+        history = None
+        try:
+            reason = policy.decide(
+                cluster_snapshot.yarn_memory_available_percentage,
+                cluster_snapshot.container_pending_ratio,
+                cluster_snapshot.get_yarn_metric('yarn-nodes-active'),
+                cluster_settings, predicted)
+        except KeyError:
+            # evaluate reports the missing metrics
+            reason = None
+        if reason is not None and \
+                policy.needs_history(cluster_settings, reason):
+            history = {}
+            for custom_metric_type in policy.TREND_METRICS:
+                history[custom_metric_type] = timeseries_cache.read(
+                    cluster_settings.Cluster, custom_metric_type,
+                    policy.TIME_SERIES_HISTORY_IN_MINUTES)
+        return policy.Record(cluster_snapshot, cluster_settings, history,
+                             predicted)
+
+    records = []
+    for cluster_settings, record, error in concurrency.run_bounded(
+            _record, clusters_settings, config.MONITORING_CONCURRENCY,
+            config.CLUSTER_TIMEOUT_SECONDS):
+        if error is not None:
+            logging.error('Reading %s failed: %s', cluster_settings.Cluster,
+                          error)
+            continue
+        records.append(record)
+    return policy.evaluate(records)
@@ -1,39 +1,122 @@
 """Helper functions for scaling."""
-import base64
-import json
+from __future__ import absolute_import
+
+import datetime
 import logging
+import time
+
+import numpy as np
+from google.appengine.api import memcache
 
 from model import settings
-from monitoring import metrics
-from util import pubsub
+from monitoring import metrics, timeseries_cache
+from scaling import forecast, policy
+from util import instrumentation, pubsub, tracing
 
 SCALING_TOPIC = 'shamash-scaling'
 
+FORECAST_HISTORY_DAYS = 14
+FORECAST_STEP_SECONDS = 10 * 60
+# The forecast curve is computed from the history this often and then
+# reused by every tick
+FORECAST_REFRESH_SECONDS = 30 * 60
+FORECAST_MEMCACHE_PREFIX = 'shamash-forecast-'
+
 
-def trigger_scaling(direction):
+def trigger_scaling(direction, publisher=None):
     """
     Start scaling operation.
 
     :param direction:
+    :param publisher: pubsub.Publisher of the scaling topic to queue the
+    message on. If not given it is published right away.
     """
     logging.info('Trigger Scaling %s', direction)
-    msg = {'messages': [{'data': base64.b64encode(json.dumps(direction))}]}
-    pubsub_client = pubsub.get_pubsub_client()
-    try:
-        pubsub.publish(pubsub_client, msg, SCALING_TOPIC)
-    except pubsub.PubSubException as e:
-        logging.error(e)
+    if publisher is not None:
+        publisher.add(direction)
+        return
+    publisher = pubsub.Publisher(SCALING_TOPIC)
+    publisher.add(direction)
+    publisher.flush()
 
 
-def should_scale(payload):
+def get_memory_forecast(cluster_name, lead_minutes):
     """
-    Make a decision to scale or not.
+    Forecast YARNMemoryAvailablePercentage lead_minutes from now.
+
+    :param cluster_name:
+    :param lead_minutes:
+    :return: percentage or None if there isn't enough history
+    """
+    now = time.time()
+    key = FORECAST_MEMCACHE_PREFIX + cluster_name
+    cached = memcache.get(key)
+    if cached is None or cached['expires'] < now or \
+            cached['lead_minutes'] < lead_minutes:
+        met = metrics.Metrics(cluster_name)
+        # The forecast resamples to FORECAST_STEP_SECONDS anyway, have
+        # Stackdriver do it instead of sending two weeks of raw points
+        times, values = met.read_timeseries(
+            'YARNMemoryAvailablePercentage', FORECAST_HISTORY_DAYS * 24 * 60,
+            alignment_period_seconds=FORECAST_STEP_SECONDS,
+            aligner='ALIGN_MEAN')
+        result = forecast.forecast(
+            times, values, now, FORECAST_REFRESH_SECONDS + lead_minutes * 60,
+            FORECAST_STEP_SECONDS)
+        cached = {
+            'times': [],
+            'values': [],
+            'expires': now + FORECAST_REFRESH_SECONDS,
+            'lead_minutes': lead_minutes
+        }
+        if result is not None:
+            cached['times'] = result[0].tolist()
+            cached['values'] = result[1].tolist()
+        memcache.set(key, cached, time=FORECAST_REFRESH_SECONDS)
+    if not cached['times']:
+        return None
+    predicted = float(
+        np.interp(now + lead_minutes * 60, cached['times'], cached['values']))
+    return min(100.0, max(0.0, predicted))
+
 
-    :param payload:
+@instrumentation.instrumented('should_scale')
+def should_scale(payload, batch=None):
+    """
+    Make a decision to scale or not for every cluster of a monitoring
+    message, publishing the scaling messages together.
+
+    :param payload: data of a monitoring message
+    :param batch: metrics.TimeSeriesBatch to queue the cluster metrics on.
+    If not given the metrics of all the clusters are written together
+    before returning.
     :return:
     """
-    cluster_settings = None
-    data = json.loads(base64.b64decode(payload))
+    flush = batch is None
+    if flush:
+        batch = metrics.TimeSeriesBatch()
+    publisher = pubsub.Publisher(SCALING_TOPIC)
+    items = pubsub.decode_items(payload)
+    tracing.set_items(len(items))
+    for data in items:
+        body = decide_scaling(data, batch)
+        if body is not None:
+            trigger_scaling(body, publisher)
+    if flush:
+        batch.flush()
+    publisher.flush()
+    return 'OK', 204
+
+
+def decide_scaling(data, batch=None):
+    """
+    Record the metrics of a cluster and decide if it should be scaled.
+
+    :param data: monitoring data as returned by DataProc.get_monitor_data
+    :param batch: metrics.TimeSeriesBatch to queue the cluster metrics on.
+    If not given the metrics are written before returning.
+    :return: scaling message or None
+    """
     yarn_memory_available_percentage = data[
         'yarn_memory_available_percentage']
     container_pending_ratio = data['container_pending_ratio']
@@ -42,53 +125,70 @@ def should_scale(payload):
     yarn_containers_pending = data['yarn_containers_pending']
     workers = data['worker_nodes']
     preemptible_workers = data['preemptible_workers']
-    s = settings.get_cluster_settings(cluster_name)
-    for st in s:
-        cluster_settings = st
+    cluster_settings = settings.get_cluster_settings(cluster_name)
+    if cluster_settings is None:
+        logging.warning('Cluster %s is not managed', cluster_name)
+        return None
     logging.info(
         'Cluster %s YARNMemAvailPct %s ContainerPendingRatio %s number of '
         'nodes %s', cluster_name, yarn_memory_available_percentage,
         container_pending_ratio, number_of_nodes)
-    met = metrics.Metrics(cluster_name)
-    met.write_timeseries_value('YARNMemoryAvailablePercentage',
-                               100 * yarn_memory_available_percentage)
-    met.write_timeseries_value('ContainerPendingRatio',
-                               container_pending_ratio)
-    met.write_timeseries_value('YarnNodes',
-                               str(int(workers) + int(preemptible_workers)))
-    met.write_timeseries_value('Workers', workers)
-    met.write_timeseries_value('PreemptibleWorkers', preemptible_workers)
-
-    scaling_direction = None
+    flush = batch is None
+    if flush:
+        batch = metrics.TimeSeriesBatch()
+    now = datetime.datetime.utcnow()
+    points = {
+        'YARNMemoryAvailablePercentage':
+        100 * yarn_memory_available_percentage,
+        'ContainerPendingRatio': container_pending_ratio,
+        'YarnNodes': int(workers) + int(preemptible_workers),
+        'Workers': workers,
+        'PreemptibleWorkers': preemptible_workers
+    }
+    for custom_metric_type, value in points.items():
+        batch.add(cluster_name, custom_metric_type, value, now)
+    if flush:
+        batch.flush()
+    timeseries_cache.record(cluster_name, points, metrics.to_epoch(now))
+
+    reason = policy.decide(yarn_memory_available_percentage,
+                           container_pending_ratio, number_of_nodes,
+                           cluster_settings)
+
+    # Scale out ahead of a forecast shortage rather than waiting for it.
+    # This also overrides scaling in just before it.
+    predicted = None
+    if cluster_settings.PredictiveScaling and \
+            policy.get_direction(reason) != 'up':
+        predicted = get_memory_forecast(
+            cluster_name, cluster_settings.ProvisioningLeadMinutes)
+        if policy.decide(yarn_memory_available_percentage,
+                         container_pending_ratio, number_of_nodes,
+                         cluster_settings, predicted) == policy.FORECAST:
+            logging.info('Cluster %s forecast YARNMemAvailPct %s in %s '
+                         'minutes', cluster_name, predicted,
+                         cluster_settings.ProvisioningLeadMinutes)
+            reason = policy.FORECAST
+        else:
+            predicted = None
+    scaling_direction = policy.get_direction(reason)
     containerpendingratio = -1
-    scale_to = -1
-    # No memory is allocated so no needs for more nodes just scale down to the
-    # minimum
-    # pending containers are waiting....
-    if container_pending_ratio > cluster_settings.UpContainerPendingRatio:
-        scaling_direction = 'up'
-        containerpendingratio = container_pending_ratio
-    elif container_pending_ratio < cluster_settings.DownContainerPendingRatio:
-        scaling_direction = 'down'
+    if reason in (policy.PENDING_UP, policy.PENDING_DOWN):
         containerpendingratio = container_pending_ratio
-    elif yarn_memory_available_percentage == 1:
-        if number_of_nodes > cluster_settings.MinInstances:
-            scaling_direction = 'down'
-            scale_to = cluster_settings.MinInstances
-    # We don't have enough memory lets go up
-    elif yarn_memory_available_percentage < cluster_settings.UpYARNMemAvailPct:
-        scaling_direction = 'up'
-    # we have too much memory  :)
-    elif yarn_memory_available_percentage > \
-            cluster_settings.DownYARNMemAvailePct:
-        scaling_direction = 'down'
+    scale_to = -1
+    if reason == policy.IDLE:
+        scale_to = cluster_settings.MinInstances
     body = {
         'cluster': cluster_name,
         'scaling_direction': scaling_direction,
         'containerpendingratio': containerpendingratio,
-        'scale_to': scale_to
+        'scale_to': scale_to,
+        'predicted_memory_available_percentage': predicted,
+        'reason': reason,
+        'snapshot': data.get('snapshot'),
+        'settings_version': cluster_settings.Version
     }
 
-    if scaling_direction is not None:
-        trigger_scaling(body)
-    return 'OK', 204
+    if scaling_direction is None:
+        return None
+    return body
@@ -0,0 +1,97 @@
+"""Trend features of cluster metrics."""
+import numpy as np
+
+DEFAULT_EWMA_ALPHA = 0.3
+
+
+class TrendFeatures(object):
+    """Trend of a single metric. Rates are per minute."""
+
+    def __init__(self, last=0.0, ewma=0.0, slope=0.0, acceleration=0.0,
+                 residual_variance=0.0, points=0):
+        self.last = last
+        self.ewma = ewma
+        self.slope = slope
+        self.acceleration = acceleration
+        self.residual_variance = residual_variance
+        self.points = points
+
+    def project(self, minutes):
+        """Expected change of the metric over the next minutes."""
+        return self.slope * minutes + 0.5 * self.acceleration * minutes ** 2
+
+    def __repr__(self):
+        return ('TrendFeatures(last={}, ewma={}, slope={}, acceleration={}, '
+                'residual_variance={}, points={})'.format(
+                    self.last, self.ewma, self.slope, self.acceleration,
+                    self.residual_variance, self.points))
+
+
+def align(series, reference):
+    """
+    Put several series on the time grid of one of them.
+
+    :param series: dict of name to (times, values) arrays, times in seconds
+    :param reference: name of the series whose timestamps are the grid
+    :return: grid times, list of names, values matrix of shape
+    (len(grid), len(names))
+    """
+    grid = np.asarray(series[reference][0], dtype=float)
+    names = [reference]
+    columns = [np.asarray(series[reference][1], dtype=float)]
+    for name in sorted(series):
+        times, values = series[name]
+        if name == reference or not len(times):
+            continue
+        names.append(name)
+        columns.append(np.interp(grid, times, values))
+    return grid, names, np.column_stack(columns)
+
+
+def compute(series, reference, ewma_alpha=DEFAULT_EWMA_ALPHA):
+    """
+    Compute the trend features of several metrics in one pass.
+
+    The series are aligned on the reference timestamps and then fitted
+    together: a least squares line gives the slope and residual variance,
+    a parabola gives the acceleration.
+
+    :param series: dict of name to (times, values) arrays, times in seconds
+    :param reference: name of the series whose timestamps are the grid
+    :param ewma_alpha: smoothing factor of the exponential moving average
+    :return: dict of name to TrendFeatures, metrics without points get the
+    defaults
+    """
+    features = dict((name, TrendFeatures()) for name in series)
+    if not len(series.get(reference, ((), ()))[0]):
+        return features
+    grid, names, values = align(series, reference)
+    n = len(grid)
+    last = values[-1]
+    # EWMA seeded with the first value, as a single dot product
+    weights = ewma_alpha * (1 - ewma_alpha) ** np.arange(n - 1, -1, -1.0)
+    weights[0] = (1 - ewma_alpha) ** (n - 1)
+    ewma = weights.dot(values)
+
+    slope = np.zeros(len(names))
+    acceleration = np.zeros(len(names))
+    residual_variance = np.zeros(len(names))
+    # Minutes relative to the newest point keeps the fit well conditioned
+    t = (grid - grid[-1]) / 60.0
+    if n >= 2 and t[0] != 0:
+        linear = np.column_stack((t, np.ones(n)))
+        coefficients = np.linalg.lstsq(linear, values, rcond=-1)[0]
+        slope = coefficients[0]
+        if n > 2:
+            residuals = values - linear.dot(coefficients)
+            residual_variance = (residuals ** 2).sum(axis=0) / (n - 2)
+    if n >= 3 and t[0] != 0:
+        quadratic = np.column_stack((t ** 2, t, np.ones(n)))
+        acceleration = 2 * np.linalg.lstsq(
+            quadratic, values, rcond=-1)[0][0]
+
+    for i, name in enumerate(names):
+        features[name] = TrendFeatures(
+            float(last[i]), float(ewma[i]), float(slope[i]),
+            float(acceleration[i]), float(residual_variance[i]), n)
+    return features
@@ -0,0 +1,343 @@
+"""Pull worker consuming the monitoring and scaling subscriptions.
+
+With SHAMASH_CONSUMER_MODE=pull in app.yaml the subscriptions have no push
+endpoint. The shamash-worker service (worker.yaml) runs run() from its
+/_ah/start request instead, once the default service provisioned pull mode:
+every subscription is pulled in batches, at most
+PULL_MAX_OUTSTANDING_MESSAGES messages of a subscription are being handled
+at once and the handled messages are acknowledged together. Messages that
+failed are delivered again after a delay that grows with every attempt.
+
+Against the Pub/Sub emulator, with the App Engine SDK on the PYTHONPATH for
+the imports and the project id in config.json:
+    PUBSUB_EMULATOR_HOST=localhost:8085 python -m scaling.worker --log-only
+"""
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from monitoring import metrics
+from scaling import scaling, scaling_decisions
+from util import config, instrumentation, pubsub, tracing
+
+WORKER_SERVICE = 'shamash-worker'
+
+MONITORING_SUBSCRIPTION = 'monitoring'
+SCALING_SUBSCRIPTION = 'scaling'
+
+# Acknowledgements are sent this often
+ACK_INTERVAL_SECONDS = 1.0
+# Pulled messages are assumed to have the shortest deadline Pub/Sub allows
+# and are extended by LEASE_SECONDS once less than LEASE_MARGIN_SECONDS is
+# left, so messages waiting for a thread are not delivered again.
+MIN_ACK_DEADLINE_SECONDS = 10
+LEASE_SECONDS = 60
+LEASE_MARGIN_SECONDS = 5
+# Wait after a failed pull
+PULL_ERROR_BACKOFF_SECONDS = 5
+# Failed messages are delivered again after this, doubled with every
+# attempt up to the longest ack deadline Pub/Sub allows
+NACK_MIN_SECONDS = 10
+NACK_MAX_SECONDS = 600
+
+
+def is_worker_service():
+    """Whether this instance belongs to the shamash-worker service."""
+    return os.environ.get('CURRENT_MODULE_ID') == WORKER_SERVICE
+
+
+def flush_instrumentation():
+    """Write the instrumentation counts to Stackdriver when it is time, the
+    worker has no after_request doing it."""
+    if not instrumentation.flush_due(config.INSTRUMENTATION_FLUSH_SECONDS):
+        return
+    try:
+        instrumentation.flush(metrics.TimeSeriesBatch())
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('Flushing the instrumentation counts failed')
+
+
+def handle_monitoring(payload):
+    """Decide on a monitoring message, as /get_monitoring_data does."""
+    if config.PIPELINE_MODE == 'direct':
+        return 'OK', 204
+    return scaling_decisions.should_scale(payload)
+
+
+def handle_scaling(payload):
+    """Size the clusters of a scaling message, as /scale does."""
+    return scaling.scale_message(payload)
+
+
+class SubscriptionWorker(object):
+    """Pull the messages of a subscription and handle them on a pool of
+    threads.
+
+    handle is called with the data of a message and returns a response
+    body and status code. The message is acknowledged unless it raised or
+    returned a 5xx status, then it is delivered again after a backoff.
+    Messages whose data can't be decoded are logged and acknowledged.
+    """
+
+    def __init__(self, subscription, handle,
+                 max_outstanding=None, threads=None):
+        self.subscription = subscription
+        self.handle = handle
+        self.max_outstanding = max_outstanding or \
+            config.PULL_MAX_OUTSTANDING_MESSAGES
+        self.threads = threads or config.PULL_THREADS
+        self.stopped = threading.Event()
+        self._work = queue.Queue()
+        self._condition = threading.Condition()
+        # ack id to the time its deadline runs out, of every message that
+        # was pulled and not acknowledged yet
+        self._leases = {}
+        self._acks = []
+        # (ack id, seconds until the message is delivered again)
+        self._nacks = []
+        # message id to failed deliveries, when Pub/Sub doesn't count them
+        self._attempts = {}
+
+    @property
+    def outstanding(self):
+        with self._condition:
+            return len(self._leases)
+
+    def _nack_seconds(self, received):
+        """Backoff of a failed message, counting its failed deliveries."""
+        message_id = received['message'].get('messageId')
+        attempts = received.get('deliveryAttempt')
+        if attempts is None:
+            if len(self._attempts) > 10 * self.max_outstanding:
+                self._attempts.clear()
+            attempts = self._attempts.get(message_id, 0) + 1
+            self._attempts[message_id] = attempts
+        return min(NACK_MIN_SECONDS * 2 ** (attempts - 1), NACK_MAX_SECONDS)
+
+    def _handle_message(self, received):
+        message_id = received['message'].get('messageId')
+        tracing.start('worker_' + self.subscription, message=message_id)
+        payload = received['message'].get('data', '')
+        ok = True
+        try:
+            pubsub.decode_items(payload)
+        except (ValueError, TypeError) as e:
+            # Trying again won't decode it either
+            logging.error('Dropping malformed message %s of %s: %s',
+                          message_id, self.subscription, e)
+        else:
+            try:
+                result = self.handle(payload)
+                ok = result is None or result[1] < 500
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Failed handling message %s of %s',
+                                  message_id, self.subscription)
+                ok = False
+        tracing.finish(ok=ok)
+        with self._condition:
+            if ok:
+                self._attempts.pop(message_id, None)
+                self._acks.append(received['ackId'])
+            else:
+                self._nacks.append((received['ackId'],
+                                    self._nack_seconds(received)))
+
+    def _process(self):
+        while True:
+            received = self._work.get()
+            if received is None:
+                return
+            self._handle_message(received)
+
+    def _wait_for_slots(self):
+        """Block until messages can be pulled, return how many."""
+        with self._condition:
+            while len(self._leases) >= self.max_outstanding and \
+                    not self.stopped.is_set():
+                self._condition.wait(ACK_INTERVAL_SECONDS)
+            return self.max_outstanding - len(self._leases)
+
+    def _pull(self):
+        client = pubsub.get_pubsub_client()
+        while not self.stopped.is_set():
+            free = self._wait_for_slots()
+            if self.stopped.is_set():
+                return
+            try:
+                received_messages = pubsub.pull_messages(
+                    client, self.subscription,
+                    min(free, pubsub.MAX_MESSAGES_PER_PULL))
+            except (pubsub.PubSubException, socket.error) as e:
+                # Long polls that time out on our side end up here too
+                logging.warning('Pulling %s failed: %s', self.subscription, e)
+                self.stopped.wait(PULL_ERROR_BACKOFF_SECONDS)
+                continue
+            expires = time.time() + MIN_ACK_DEADLINE_SECONDS
+            with self._condition:
+                for received in received_messages:
+                    self._leases[received['ackId']] = expires
+            for received in received_messages:
+                self._work.put(received)
+
+    def _flush(self, client):
+        """Send the acknowledgements and extend the expiring leases."""
+        now = time.time()
+        with self._condition:
+            acks, self._acks = self._acks, []
+            nacks, self._nacks = self._nacks, []
+            done = set(acks + [ack_id for ack_id, _ in nacks])
+            expiring = [
+                ack_id for ack_id, expires in self._leases.items()
+                if expires - now < LEASE_MARGIN_SECONDS and
+                ack_id not in done
+            ]
+            for ack_id in expiring:
+                self._leases[ack_id] = now + LEASE_SECONDS
+        try:
+            if acks:
+                pubsub.acknowledge(client, self.subscription, acks)
+            backoffs = {}
+            for ack_id, seconds in nacks:
+                backoffs.setdefault(seconds, []).append(ack_id)
+            for seconds, ack_ids in sorted(backoffs.items()):
+                pubsub.modify_ack_deadline(client, self.subscription,
+                                           ack_ids, seconds)
+            if expiring:
+                pubsub.modify_ack_deadline(client, self.subscription,
+                                           expiring, LEASE_SECONDS)
+        except pubsub.PubSubException as e:
+            # The messages are delivered again once their deadline is over
+            logging.error('Acknowledging %s failed: %s', self.subscription,
+                          e)
+        with self._condition:
+            for ack_id in done:
+                self._leases.pop(ack_id, None)
+            self._condition.notify_all()
+        if acks or nacks:
+            logging.debug('Subscription %s acked %s, nacked %s, %s '
+                          'outstanding', self.subscription, len(acks),
+                          len(nacks), len(self._leases))
+
+    def _ack(self):
+        client = pubsub.get_pubsub_client()
+        while not self.stopped.wait(ACK_INTERVAL_SECONDS):
+            self._flush(client)
+            flush_instrumentation()
+        self._flush(client)
+
+    def run(self):
+        """Pull and handle messages until stop() is called."""
+        pool = []
+        for _ in range(self.threads):
+            thread = threading.Thread(target=self._process)
+            thread.daemon = True
+            thread.start()
+            pool.append(thread)
+        acker = threading.Thread(target=self._ack)
+        acker.daemon = True
+        acker.start()
+        logging.info('Pulling %s with %s threads, at most %s outstanding '
+                     'messages', self.subscription, self.threads,
+                     self.max_outstanding)
+        self._pull()
+        for _ in pool:
+            self._work.put(None)
+        for thread in pool:
+            thread.join()
+        acker.join()
+
+    def stop(self):
+        """Stop pulling, the pulled messages are still handled."""
+        self.stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+
+
+_workers = []
+
+
+def run(handlers=None):
+    """
+    Consume the subscriptions until stop() is called.
+
+    :param handlers: dict of subscription to handle function, defaults to
+    the monitoring and scaling subscriptions
+    """
+    if handlers is None:
+        handlers = {
+            MONITORING_SUBSCRIPTION: handle_monitoring,
+            SCALING_SUBSCRIPTION: handle_scaling
+        }
+    workers = [
+        SubscriptionWorker(subscription, handle)
+        for subscription, handle in sorted(handlers.items())
+    ]
+    _workers.extend(workers)
+    threads = []
+    for subscription_worker in workers:
+        thread = threading.Thread(target=subscription_worker.run)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # join() with a timeout so the main thread still sees KeyboardInterrupt
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(ACK_INTERVAL_SECONDS)
+
+
+def stop():
+    """Stop the workers started by run()."""
+    for subscription_worker in _workers:
+        subscription_worker.stop()
+
+
+def _log_only(payload):
+    logging.info('Received %s', pubsub.decode_items(payload))
+    return 'OK', 204
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Consume the Shamash subscriptions')
+    parser.add_argument('--subscription', action='append',
+                        help='subscription to pull, may be repeated, '
+                        'defaults to monitoring and scaling')
+    parser.add_argument('--log-only', action='store_true',
+                        help='log and acknowledge the messages instead of '
+                        'acting on them')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    # Outside App Engine, read the project id from config.json
+    os.environ.setdefault('SERVER_SOFTWARE', 'Development/worker')
+
+    handlers = {
+        MONITORING_SUBSCRIPTION: handle_monitoring,
+        SCALING_SUBSCRIPTION: handle_scaling
+    }
+    if args.subscription:
+        handlers = dict((subscription, handlers.get(subscription))
+                        for subscription in args.subscription)
+    if args.log_only:
+        handlers = dict((subscription, _log_only) for subscription in handlers)
+    if None in handlers.values():
+        parser.error('--log-only is needed for other subscriptions')
+    try:
+        run(handlers)
+    except KeyboardInterrupt:
+        stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
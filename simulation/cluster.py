@@ -0,0 +1,190 @@
+"""Modelled Dataproc cluster for offline simulations."""
+import math
+
+import numpy as np
+
+from model import settings
+
+WORKER = 'worker'
+PREEMPTIBLE = 'preemptible'
+
+
+class SimulatedSettings(object):
+    """Plain object with the fields and defaults of settings.Settings."""
+
+    def __init__(self, **overrides):
+        for prop in settings.Settings._properties.values():
+            setattr(self, prop._code_name, prop._default)
+        for name, value in overrides.items():
+            if name not in settings.Settings._properties:
+                raise ValueError('Unknown setting {}'.format(name))
+            setattr(self, name, value)
+
+
+class SimulatedCluster(object):
+    """
+    A Dataproc cluster driven by a memory demand.
+
+    Added nodes join YARN after a provisioning delay, removed nodes keep
+    being billed for the graceful decommission timeout and preemptible nodes
+    are lost at random and recreated by Dataproc.
+    """
+
+    def __init__(self, cluster_name, workers, preemptibles, node_memory_mb,
+                 container_memory_mb, provisioning_seconds=150,
+                 graceful_decommission_seconds=0,
+                 preemptible_lifetime_hours=24, patch_latency_seconds=30,
+                 seed=0):
+        self.cluster_name = cluster_name
+        self.node_memory_mb = node_memory_mb
+        self.container_memory_mb = container_memory_mb
+        self.provisioning_seconds = provisioning_seconds
+        self.graceful_decommission_seconds = graceful_decommission_seconds
+        self.preemptible_lifetime_hours = preemptible_lifetime_hours
+        self.patch_latency_seconds = patch_latency_seconds
+        self.random = np.random.RandomState(seed)
+        # Configured size, what clusters().get reports
+        self.workers = workers
+        self.preemptibles = preemptibles
+        self.active = {WORKER: workers, PREEMPTIBLE: preemptibles}
+        self.joining = {WORKER: [], PREEMPTIBLE: []}
+        self.leaving = []
+        self.patches = []
+        self.patch_count = 0
+
+    def patch(self, now, workers, preemptibles):
+        """Request a new size, applied after the patch latency."""
+        self.patch_count += 1
+        self.patches.append((now + self.patch_latency_seconds, workers,
+                             preemptibles))
+
+    def _resize(self, now, kind, count):
+        joining = self.joining[kind]
+        current = self.active[kind] + sum(n for _, n in joining)
+        if count > current:
+            joining.append((now + self.provisioning_seconds, count - current))
+            return
+        remove = current - count
+        # Cancel the nodes that didn't join yet first, newest first
+        while remove and joining:
+            ready_at, n = joining.pop()
+            if n > remove:
+                joining.append((ready_at, n - remove))
+                remove = 0
+            else:
+                remove -= n
+        remove = min(remove, self.active[kind])
+        if remove:
+            self.active[kind] -= remove
+            self.leaving.append(
+                (now + self.graceful_decommission_seconds, remove))
+
+    def advance(self, now, step):
+        """Move the cluster to now, step seconds after the last call."""
+        while self.patches and self.patches[0][0] <= now:
+            _, workers, preemptibles = self.patches.pop(0)
+            self.workers = workers
+            self.preemptibles = preemptibles
+            self._resize(now, WORKER, workers)
+            self._resize(now, PREEMPTIBLE, preemptibles)
+        for kind in (WORKER, PREEMPTIBLE):
+            joined = [n for ready_at, n in self.joining[kind] if ready_at <= now]
+            if joined:
+                self.active[kind] += sum(joined)
+                self.joining[kind] = [(ready_at, n) for ready_at, n in
+                                      self.joining[kind] if ready_at > now]
+        if self.leaving:
+            self.leaving = [(done_at, n) for done_at, n in self.leaving
+                            if done_at > now]
+        if self.preemptible_lifetime_hours and self.active[PREEMPTIBLE]:
+            probability = 1 - math.exp(
+                -step / (self.preemptible_lifetime_hours * 3600.0))
+            lost = self.random.binomial(self.active[PREEMPTIBLE], probability)
+            if lost:
+                self.active[PREEMPTIBLE] -= lost
+                self.joining[PREEMPTIBLE].append(
+                    (now + self.provisioning_seconds, lost))
+
+    @property
+    def active_nodes(self):
+        return self.active[WORKER] + self.active[PREEMPTIBLE]
+
+    @property
+    def billed_nodes(self):
+        """Every node that has a running VM."""
+        return (self.active_nodes +
+                sum(n for _, n in self.joining[WORKER]) +
+                sum(n for _, n in self.joining[PREEMPTIBLE]) +
+                sum(n for _, n in self.leaving))
+
+    def observe(self, memory_demand_mb):
+        """
+        Return the cluster as clusters().get would for a memory demand.
+
+        :param memory_demand_mb: memory the running and waiting containers
+        ask for
+        :return: cluster json
+        """
+        capacity = self.active_nodes * self.node_memory_mb
+        containers_capacity = capacity // self.container_memory_mb
+        containers_demand = int(
+            math.ceil(memory_demand_mb / float(self.container_memory_mb)))
+        allocated = min(containers_demand, containers_capacity)
+        pending = containers_demand - allocated
+        allocated_mb = allocated * self.container_memory_mb
+        return {
+            'clusterName': self.cluster_name,
+            'status': {'state': 'RUNNING'},
+            'config': {
+                'workerConfig': {'numInstances': self.workers},
+                'secondaryWorkerConfig': {'numInstances': self.preemptibles}
+            },
+            'metrics': {
+                'yarnMetrics': {
+                    'yarn-nodes-active': str(self.active_nodes),
+                    'yarn-memory-mb-allocated': str(allocated_mb),
+                    'yarn-memory-mb-available': str(capacity - allocated_mb),
+                    'yarn-memory-mb-pending':
+                    str(pending * self.container_memory_mb),
+                    'yarn-containers-allocated': str(allocated),
+                    'yarn-containers-pending': str(pending)
+                }
+            }
+        }
+
+
+class SimulatedSeries(object):
+    """
+    In memory stand-in for timeseries_cache on the simulated clock.
+
+    Keeps at least the last capacity points, older ones are dropped so
+    memory stays flat over long replays.
+    """
+
+    def __init__(self, capacity):
+        self.now = 0.0
+        self.size = 0
+        self.times = np.zeros(2 * capacity)
+        self.values = {}
+
+    def record(self, now, points):
+        """Add the points of a tick."""
+        if self.size == len(self.times):
+            keep = self.size // 2
+            self.times[:keep] = self.times[-keep:].copy()
+            for values in self.values.values():
+                values[:keep] = values[-keep:].copy()
+            self.size = keep
+        self.now = now
+        self.times[self.size] = now
+        for name, value in points.items():
+            if name not in self.values:
+                self.values[name] = np.zeros(len(self.times))
+            self.values[name][self.size] = value
+        self.size += 1
+
+    def read(self, cluster_name, custom_metric_type, minutes):
+        """Same as timeseries_cache.read."""
+        first = self.times[:self.size].searchsorted(self.now - minutes * 60)
+        return (self.times[first:self.size],
+                self.values[custom_metric_type][first:self.size])
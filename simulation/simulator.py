@@ -0,0 +1,315 @@
+"""Replay recorded cluster load through the Shamash scaling pipeline.
+
+Usage:
+    python -m simulation.simulator trace.json [--days 1000]
+        [--settings '{"UpYARNMemAvailPct": 20}']
+    python -m simulation.simulator trace.json --record CLUSTER [--days 14]
+
+A trace is a JSON object with the memory demand (allocated plus pending
+YARN memory) of a cluster at a fixed step:
+    {"step_seconds": 120, "node_memory_mb": 12288,
+     "container_memory_mb": 1024, "memory_demand_mb": [...]}
+
+Replaying is pure computation, only --record reads from Stackdriver.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+
+from monitoring import snapshot
+from scaling import policy
+from simulation import cluster
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+class Trace(object):
+    """Memory demand of a cluster over time."""
+
+    def __init__(self, memory_demand_mb, step_seconds, node_memory_mb,
+                 container_memory_mb):
+        self.memory_demand_mb = np.asarray(memory_demand_mb, dtype=float)
+        self.step_seconds = step_seconds
+        self.node_memory_mb = node_memory_mb
+        self.container_memory_mb = container_memory_mb
+
+    @classmethod
+    def load(cls, path):
+        """Read a trace file."""
+        with open(path, 'r') as trace_file:
+            data = json.load(trace_file)
+        return cls(data['memory_demand_mb'], data['step_seconds'],
+                   data['node_memory_mb'], data['container_memory_mb'])
+
+    def save(self, path):
+        """Write a trace file."""
+        with open(path, 'w') as trace_file:
+            json.dump({
+                'step_seconds': self.step_seconds,
+                'node_memory_mb': self.node_memory_mb,
+                'container_memory_mb': self.container_memory_mb,
+                'memory_demand_mb': self.memory_demand_mb.tolist()
+            }, trace_file)
+
+    @classmethod
+    def from_metrics(cls, times, memory_available_pct, pending_ratio,
+                     yarn_nodes, step_seconds, node_memory_mb,
+                     container_memory_mb):
+        """
+        Rebuild the memory demand from the metrics Shamash stores.
+
+        :param times: epoch seconds of the points of the three series
+        :param memory_available_pct: YARNMemoryAvailablePercentage
+        :param pending_ratio: ContainerPendingRatio
+        :param yarn_nodes: YarnNodes
+        :return: Trace on a regular grid of step_seconds
+        """
+        grid = np.arange(times[0], times[-1], float(step_seconds))
+        available = np.interp(grid, times, memory_available_pct) / 100.0
+        ratio = np.interp(grid, times, pending_ratio)
+        nodes = np.interp(grid, times, yarn_nodes)
+        allocated_mb = nodes * node_memory_mb * (1 - available)
+        allocated = allocated_mb / container_memory_mb
+        # The ratio is the pending count when nothing is allocated
+        pending = np.where(allocated >= 1, ratio * allocated, ratio)
+        return cls(allocated_mb + pending * container_memory_mb,
+                   step_seconds, node_memory_mb, container_memory_mb)
+
+
+class _Lease(object):
+    """
+    The resize lease of model.resize, on the simulated clock.
+
+    A resize runs from its patch until the cluster applied it and the nodes
+    it adds joined or the ones it removes were decommissioned, the time the
+    Dataproc operation takes.
+    """
+
+    def __init__(self, cooldown_seconds, stabilization_seconds):
+        self.cooldown_seconds = cooldown_seconds
+        self.stabilization_seconds = stabilization_seconds
+        self.direction = None
+        self.pending = None
+        self.queued = None
+        self.running_until = None
+        self.finished_at = None
+        self.stabilized = 0
+
+    def _is_reversal(self, direction, now):
+        if self.direction is None or direction == self.direction:
+            return False
+        if self.pending is not None or self.running_until is not None:
+            return True
+        return self.finished_at is not None and \
+            now - self.finished_at < self.stabilization_seconds
+
+    def claim(self, now, workers, preemptibles, direction):
+        """Ask to resize, see resize.claim."""
+        if self._is_reversal(direction, now):
+            self.stabilized += 1
+            return
+        target = (workers, preemptibles, direction)
+        if self.running_until is not None:
+            self.queued = target
+            return
+        if self.pending is not None:
+            self.pending = target + (self.pending[3],)
+            self.direction = direction
+            return
+        countdown = 0
+        if self.finished_at is not None:
+            countdown = max(0, self.cooldown_seconds -
+                            (now - self.finished_at))
+        self.pending = target + (now + countdown,)
+        self.direction = direction
+
+    def advance(self, now, sim):
+        """Finish the running resize and patch the pending one when due."""
+        if self.running_until is not None and self.running_until <= now:
+            self.finished_at = self.running_until
+            self.running_until = None
+            if self.queued is not None:
+                self.pending = self.queued + (
+                    self.finished_at + self.cooldown_seconds,)
+                self.direction = self.queued[2]
+                self.queued = None
+        if self.pending is None or self.pending[3] > now:
+            return
+        workers, preemptibles, direction, _ = self.pending
+        self.pending = None
+        sim.patch(now, workers, preemptibles)
+        if direction == 'up':
+            settle_seconds = sim.provisioning_seconds
+        else:
+            settle_seconds = sim.graceful_decommission_seconds
+        self.running_until = now + sim.patch_latency_seconds + settle_seconds
+
+
+class SimulationResult(object):
+    """What a replay cost and how long work waited."""
+
+    def __init__(self, days, node_hours, pending_container_hours, patches,
+                 stabilized):
+        self.days = days
+        self.node_hours = node_hours
+        self.pending_container_hours = pending_container_hours
+        self.patches = patches
+        self.stabilized = stabilized
+
+    def to_dict(self):
+        return {
+            'days': self.days,
+            'node_hours': self.node_hours,
+            'pending_container_hours': self.pending_container_hours,
+            'patches': self.patches,
+            'stabilized': self.stabilized
+        }
+
+
+def simulate(trace, cluster_settings, days=None, **cluster_options):
+    """
+    Replay a trace through the scaling rules.
+
+    Every step reads the modelled cluster, evaluates the scaling policy on
+    it and hands the decision to a model of the resize lease, which keeps
+    the CooldownMinutes between resizes and drops the reversals within
+    StabilizationMinutes like model.resize.claim does.
+
+    :param trace: Trace, repeated as needed to cover days
+    :param cluster_settings: Settings or cluster.SimulatedSettings
+    :param days: length of the replay, defaults to the trace length
+    :param cluster_options: passed on to cluster.SimulatedCluster
+    :return: SimulationResult
+    """
+    step = trace.step_seconds
+    demand = trace.memory_demand_mb
+    if days is None:
+        steps = len(demand)
+    else:
+        steps = int(days * DAY_SECONDS // step)
+    name = cluster_settings.Cluster or 'simulated'
+    sim = cluster.SimulatedCluster(
+        name, cluster_settings.MinInstances, 0, trace.node_memory_mb,
+        trace.container_memory_mb, **cluster_options)
+    series = cluster.SimulatedSeries(
+        policy.TIME_SERIES_HISTORY_IN_MINUTES * 60 // step + 1)
+    lease = _Lease(cluster_settings.CooldownMinutes * 60,
+                   cluster_settings.StabilizationMinutes * 60)
+    node_steps = 0
+    pending_container_steps = 0
+    for i in range(steps):
+        now = float(i * step)
+        lease.advance(now, sim)
+        sim.advance(now, step)
+        node_steps += sim.billed_nodes
+        cluster_snapshot = snapshot.ClusterSnapshot.from_cluster_data(
+            sim.observe(demand[i % len(demand)]), now)
+        pending_container_steps += int(cluster_snapshot.get_yarn_metric(
+            'yarn-containers-pending'))
+        series.record(now, {
+            'YARNMemoryAvailablePercentage':
+            100 * cluster_snapshot.yarn_memory_available_percentage,
+            'ContainerPendingRatio': cluster_snapshot.container_pending_ratio,
+            'YarnNodes': cluster_snapshot.workers +
+            cluster_snapshot.secondary_workers
+        })
+
+        history = {}
+        for custom_metric_type in policy.TREND_METRICS:
+            history[custom_metric_type] = series.read(
+                name, custom_metric_type,
+                policy.TIME_SERIES_HISTORY_IN_MINUTES)
+        decision = policy.evaluate([policy.Record(
+            cluster_snapshot, cluster_settings, history)])[0]
+        if decision.workers is not None and \
+                (decision.workers, decision.preemptibles) != \
+                (sim.workers, sim.preemptibles):
+            lease.claim(now, decision.workers, decision.preemptibles,
+                        decision.direction)
+    hours = step / 3600.0
+    return SimulationResult(steps * step / float(DAY_SECONDS),
+                            node_steps * hours,
+                            pending_container_steps * hours, sim.patch_count,
+                            lease.stabilized)
+
+
+def record_trace(cluster_name, days, step_seconds, node_memory_mb,
+                 container_memory_mb):
+    """
+    Build a trace from the metrics Shamash stored for a cluster.
+
+    :return: Trace
+    """
+    from monitoring import metrics
+
+    met = metrics.Metrics(cluster_name)
+    series = {}
+    for custom_metric_type in ('YARNMemoryAvailablePercentage',
+                               'ContainerPendingRatio', 'YarnNodes'):
+        series[custom_metric_type] = met.read_timeseries(
+            custom_metric_type, days * 24 * 60,
+            alignment_period_seconds=step_seconds, aligner='ALIGN_MEAN')
+    times = series['YARNMemoryAvailablePercentage'][0]
+    if len(times) < 2:
+        raise ValueError('No history for {}'.format(cluster_name))
+
+    def _on_grid(custom_metric_type):
+        other_times, values = series[custom_metric_type]
+        return np.interp(times, other_times, values)
+
+    return Trace.from_metrics(
+        times, series['YARNMemoryAvailablePercentage'][1],
+        _on_grid('ContainerPendingRatio'), _on_grid('YarnNodes'),
+        step_seconds, node_memory_mb, container_memory_mb)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay a cluster trace through the Shamash scaling '
+        'rules')
+    parser.add_argument('trace', help='trace file')
+    parser.add_argument('--days', type=float,
+                        help='days to simulate or record')
+    parser.add_argument('--settings', default='{}',
+                        help='JSON object of Settings fields')
+    parser.add_argument('--provisioning-seconds', type=int, default=150)
+    parser.add_argument('--preemptible-lifetime-hours', type=float,
+                        default=24)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='CLUSTER',
+                        help='write the trace from the Stackdriver history '
+                        'of a cluster instead of replaying it')
+    parser.add_argument('--step-seconds', type=int, default=120)
+    parser.add_argument('--node-memory-mb', type=int, default=12288)
+    parser.add_argument('--container-memory-mb', type=int, default=1024)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.record:
+        trace = record_trace(args.record, args.days or 14, args.step_seconds,
+                             args.node_memory_mb, args.container_memory_mb)
+        trace.save(args.trace)
+        return 0
+
+    cluster_settings = cluster.SimulatedSettings(**json.loads(args.settings))
+    trace = Trace.load(args.trace)
+    started = time.time()
+    result = simulate(
+        trace, cluster_settings, args.days,
+        provisioning_seconds=args.provisioning_seconds,
+        graceful_decommission_seconds=(
+            cluster_settings.GracefulDecommissionTimeout * 60),
+        preemptible_lifetime_hours=args.preemptible_lifetime_hours,
+        seed=args.seed)
+    output = result.to_dict()
+    output['elapsed_seconds'] = time.time() - started
+    print(json.dumps(output, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
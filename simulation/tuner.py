@@ -0,0 +1,377 @@
+"""Search scaling settings against the recorded load of a cluster.
+
+Usage:
+    python -m simulation.tuner trace.json
+        [--grid '{"UpYARNMemAvailPct": [10, 15, 20], "PreemptiblePct": [0, 50]}']
+        [--settings '{"MinInstances": 2, "MaxInstances": 40}']
+
+Traces are recorded with python -m simulation.simulator --record.
+
+Every combination of the grid is replayed at once: the scaling rules of
+policy.decide and policy.calc_target are applied to arrays with
+one entry per candidate, so a step of the replay costs the same numpy
+operations whatever the size of the grid. The output is the Pareto front of
+node cost against container hours spent pending.
+
+The model is coarser than simulator.simulate, which should be used to check
+the chosen settings: nodes are not lost to preemption and a trend based
+step (AddRemoveUpDelta or AddRemoveDownDelta of 0 on the memory rules) is
+taken as a single node.
+"""
+import argparse
+import itertools
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+
+from simulation import cluster, simulator
+
+TUNABLE_SETTINGS = ('UpYARNMemAvailPct', 'DownYARNMemAvailePct',
+                    'UpContainerPendingRatio', 'DownContainerPendingRatio',
+                    'AddRemoveUpDelta', 'AddRemoveDownDelta',
+                    'PreemptiblePct', 'MinInstances', 'MaxInstances')
+
+DEFAULT_GRID = {
+    'UpYARNMemAvailPct': [5, 10, 15, 20, 30],
+    'DownYARNMemAvailePct': [50, 65, 75, 90],
+    'UpContainerPendingRatio': [0.1, 0.5, 1, 2],
+    'DownContainerPendingRatio': [0, 0.1, 1],
+    'AddRemoveUpDelta': [0, 1, 2, 5],
+    'AddRemoveDownDelta': [0, 1, 2],
+    'PreemptiblePct': [0, 50, 80]
+}
+
+# Price of a preemptible node relative to a regular one
+PREEMPTIBLE_COST = 0.2
+
+UP = 1
+DOWN = -1
+
+
+def build_grid(grid, base_settings):
+    """
+    Expand a grid of settings values into one array per setting.
+
+    :param grid: dict of setting name to list of values
+    :param base_settings: values of the settings that are not in the grid
+    :return: dict of setting name to array, all of the same length
+    """
+    for name in grid:
+        if name not in TUNABLE_SETTINGS:
+            raise ValueError('{} can not be tuned'.format(name))
+    names = sorted(grid)
+    combinations = np.array(list(itertools.product(
+        *[grid[name] for name in names])), dtype=float)
+    candidates = {}
+    for name in TUNABLE_SETTINGS:
+        if name in grid:
+            candidates[name] = combinations[:, names.index(name)]
+        else:
+            candidates[name] = np.zeros(len(combinations)) + getattr(
+                base_settings, name)
+    return candidates
+
+
+def _py2_round(values):
+    """round() of Python 2, halves away from zero."""
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+
+def decide(memory_available, pending_ratio, number_of_nodes, candidates):
+    """
+    policy.decide for every candidate.
+
+    :param memory_available: yarn_memory_available_percentage per candidate,
+    a 0..1 fraction
+    :param pending_ratio: container_pending_ratio per candidate
+    :param number_of_nodes: active nodes per candidate
+    :param candidates: output of build_grid
+    :return: direction (UP, DOWN or 0), pending and scale_to masks
+    """
+    pending_up = pending_ratio > candidates['UpContainerPendingRatio']
+    pending_down = ~pending_up & (
+        pending_ratio < candidates['DownContainerPendingRatio'])
+    pending = pending_up | pending_down
+    idle = ~pending & (memory_available == 1)
+    scale_to = idle & (number_of_nodes > candidates['MinInstances'])
+    rest = ~pending & ~idle
+    memory_up = rest & (
+        100 * memory_available < candidates['UpYARNMemAvailPct'])
+    memory_down = rest & ~memory_up & (
+        100 * memory_available > candidates['DownYARNMemAvailePct'])
+    direction = np.zeros(len(memory_available), dtype=int)
+    direction[pending_up | memory_up] = UP
+    direction[pending_down | scale_to | memory_down] = DOWN
+    return direction, pending, scale_to
+
+
+def calc_targets(direction, pending, scale_to, observed, candidates,
+                 use_memory):
+    """
+    policy.calc_target for every candidate.
+
+    :param direction: output of decide
+    :param pending: output of decide
+    :param scale_to: output of decide
+    :param observed: dict of the YARN figures per candidate
+    :param candidates: output of build_grid
+    :param use_memory: UseMemoryForScaling
+    :return: new workers, new preemptibles and a mask of the candidates that
+    scale
+    """
+    current = observed['nodes']
+    up_delta = candidates['AddRemoveUpDelta']
+    down_delta = candidates['AddRemoveDownDelta']
+    min_instances = candidates['MinInstances']
+    valid = direction != 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Pending containers, divided by the containers per node
+        ratio = np.floor(observed['containers_allocated'] /
+                         np.maximum(current, 1))
+        factor = observed['containers_pending'] / ratio
+        by_pending = np.where(
+            up_delta != 0, current + direction * up_delta,
+            np.where(direction == UP, np.floor(current * factor),
+                     np.floor(current * (
+                         100 - candidates['DownContainerPendingRatio']) /
+                         100)))
+        valid &= ~(pending & ~scale_to & ((ratio == 0) | (current == 0)))
+        # No memory left
+        memory_ratio = np.floor(observed['memory_allocated_mb'] /
+                                np.maximum(current, 1))
+        memory_ratio[memory_ratio == 0] = 1
+        by_memory = np.where(
+            up_delta != 0, current + up_delta,
+            np.floor(current * observed['memory_pending_mb'] / memory_ratio))
+    by_step = current + direction * np.where(
+        direction == UP, np.maximum(up_delta, 1), np.maximum(down_delta, 1))
+    if not use_memory:
+        by_step = np.zeros(len(current))
+    no_memory = observed['memory_available'] == 0
+    total = np.where(no_memory, by_memory, by_step)
+    if use_memory:
+        valid &= ~(~pending & ~scale_to & no_memory & (current == 0))
+    total = np.where(pending, by_pending, total)
+    total = np.where(
+        scale_to,
+        np.where(down_delta != 0,
+                 np.maximum(current - down_delta, min_instances),
+                 min_instances),
+        total)
+    total = np.where(np.isfinite(total), total, current)
+    total = np.minimum(total, candidates['MaxInstances'])
+    valid &= total != current
+
+    # policy.preserve_ratio
+    share = candidates['PreemptiblePct'] / 100.0
+    new_preemptible = _py2_round(share * total)
+    new_workers = _py2_round((1 - share) * total)
+    short = np.maximum(min_instances - new_workers, 0)
+    new_workers += short
+    new_preemptible -= short
+    new_preemptible += np.maximum(total - (new_workers + new_preemptible), 0)
+    new_preemptible = np.maximum(new_preemptible, 0)
+    return new_workers, new_preemptible, valid
+
+
+class TuningResult(object):
+    """Cost and queueing of every candidate of a grid."""
+
+    def __init__(self, candidates, cost, node_hours, pending_container_hours,
+                 patches):
+        self.candidates = candidates
+        self.cost = cost
+        self.node_hours = node_hours
+        self.pending_container_hours = pending_container_hours
+        self.patches = patches
+
+    def pareto_front(self):
+        """
+        Indexes of the candidates no other one beats on both cost and
+        pending container hours, cheapest first.
+        """
+        order = np.lexsort((self.pending_container_hours, self.cost))
+        front = []
+        best_pending = np.inf
+        for i in order:
+            if self.pending_container_hours[i] < best_pending:
+                front.append(i)
+                best_pending = self.pending_container_hours[i]
+        return front
+
+    def describe(self, i):
+        """Settings and scores of a candidate."""
+        settings_values = {}
+        for name, values in self.candidates.items():
+            if name in ('UpContainerPendingRatio', 'DownContainerPendingRatio'):
+                settings_values[name] = float(values[i])
+            else:
+                settings_values[name] = int(values[i])
+        return {
+            'settings': settings_values,
+            'cost': float(self.cost[i]),
+            'node_hours': float(self.node_hours[i]),
+            'pending_container_hours': float(self.pending_container_hours[i]),
+            'patches': int(self.patches[i])
+        }
+
+
+def tune(trace, base_settings, grid, days=None, provisioning_seconds=180,
+         graceful_decommission_seconds=0, preemptible_cost=PREEMPTIBLE_COST):
+    """
+    Replay a trace for every combination of a settings grid.
+
+    :param trace: simulator.Trace, repeated as needed to cover days
+    :param base_settings: Settings or cluster.SimulatedSettings for the
+    values that are not in the grid
+    :param grid: dict of setting name to list of values
+    :param days: length of the replay, defaults to the trace length
+    :param provisioning_seconds: time for a new node to join YARN
+    :param graceful_decommission_seconds: time a removed node stays billed
+    :param preemptible_cost: price of a preemptible node relative to a
+    regular one
+    :return: TuningResult
+    """
+    step = trace.step_seconds
+    demand = trace.memory_demand_mb
+    if days is None:
+        steps = len(demand)
+    else:
+        steps = int(days * simulator.DAY_SECONDS // step)
+    candidates = build_grid(grid, base_settings)
+    count = len(candidates['MinInstances'])
+    container_mb = trace.container_memory_mb
+    containers_per_node = trace.node_memory_mb // container_mb
+    demand_containers = np.ceil(demand / float(container_mb))
+
+    workers = candidates['MinInstances'].copy()
+    preemptibles = np.zeros(count)
+    active = workers.copy()
+    # Nodes that join, or stop being billed, a whole number of steps later.
+    # Slot t % len holds the nodes due at step t.
+    joining = np.zeros((count, max(1, int(np.ceil(
+        provisioning_seconds / float(step))))))
+    leaving = np.zeros((count, max(1, int(np.ceil(
+        graceful_decommission_seconds / float(step))))))
+    cost = np.zeros(count)
+    node_steps = np.zeros(count)
+    pending_container_steps = np.zeros(count)
+    patches = np.zeros(count, dtype=int)
+    use_memory = base_settings.UseMemoryForScaling
+    for t in range(steps):
+        join_slot = t % joining.shape[1]
+        active += joining[:, join_slot]
+        joining[:, join_slot] = 0
+        leave_slot = t % leaving.shape[1]
+        leaving[:, leave_slot] = 0
+        billed = active + joining.sum(axis=1) + leaving.sum(axis=1)
+        configured = workers + preemptibles
+        node_steps += billed
+        cost += billed * np.where(
+            configured > 0,
+            (workers + preemptible_cost * preemptibles) /
+            np.maximum(configured, 1), 1)
+
+        # What the monitoring reads, as in SimulatedCluster.observe
+        wanted = demand_containers[t % len(demand_containers)]
+        allocated = np.minimum(wanted, active * containers_per_node)
+        waiting = wanted - allocated
+        pending_container_steps += waiting
+        capacity_mb = active * trace.node_memory_mb
+        allocated_mb = allocated * container_mb
+        memory_available = np.where(
+            capacity_mb > 0,
+            (capacity_mb - allocated_mb) / np.maximum(capacity_mb, 1), 0)
+        # ClusterSnapshot divides the integer counts
+        pending_ratio = np.where(
+            allocated > 0, np.floor(waiting / np.maximum(allocated, 1)),
+            waiting)
+
+        direction, pending, scale_to = decide(
+            memory_available, pending_ratio, active, candidates)
+        if not direction.any():
+            continue
+        observed = {
+            'nodes': active,
+            'memory_available': memory_available,
+            'containers_allocated': allocated,
+            'containers_pending': waiting,
+            'memory_allocated_mb': allocated_mb,
+            'memory_pending_mb': waiting * container_mb
+        }
+        new_workers, new_preemptible, scaling = calc_targets(
+            direction, pending, scale_to, observed, candidates, use_memory)
+        scaling &= (new_workers != workers) | (new_preemptible != preemptibles)
+        if not scaling.any():
+            continue
+        patches += scaling
+        workers = np.where(scaling, new_workers, workers)
+        preemptibles = np.where(scaling, new_preemptible, preemptibles)
+
+        # Resize, cancelling the newest joining nodes before removing any
+        change = np.where(
+            scaling, workers + preemptibles - active - joining.sum(axis=1), 0)
+        joining[:, join_slot] += np.maximum(change, 0)
+        remove = np.maximum(-change, 0)
+        for age in range(joining.shape[1]):
+            slot = (t - age) % joining.shape[1]
+            cancelled = np.minimum(joining[:, slot], remove)
+            joining[:, slot] -= cancelled
+            remove -= cancelled
+        remove = np.minimum(remove, active)
+        active -= remove
+        if graceful_decommission_seconds:
+            leaving[:, leave_slot] += remove
+
+    hours = step / 3600.0
+    return TuningResult(candidates, cost * hours, node_steps * hours,
+                        pending_container_steps * hours, patches)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Search Shamash scaling settings against the load of '
+        'a cluster')
+    parser.add_argument('trace', help='trace file')
+    parser.add_argument('--days', type=float, help='days to replay')
+    parser.add_argument('--grid',
+                        help='JSON object of setting name to list of values')
+    parser.add_argument('--settings', default='{}',
+                        help='JSON object of the fixed Settings fields')
+    parser.add_argument('--provisioning-seconds', type=int, default=180)
+    parser.add_argument('--preemptible-cost', type=float,
+                        default=PREEMPTIBLE_COST,
+                        help='price of a preemptible node relative to a '
+                        'regular one')
+    parser.add_argument('--all', action='store_true',
+                        help='report every candidate, not just the front')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    base_settings = cluster.SimulatedSettings(**json.loads(args.settings))
+    grid = json.loads(args.grid) if args.grid else DEFAULT_GRID
+    trace = simulator.Trace.load(args.trace)
+    started = time.time()
+    result = tune(trace, base_settings, grid, args.days,
+                  provisioning_seconds=args.provisioning_seconds,
+                  graceful_decommission_seconds=(
+                      base_settings.GracefulDecommissionTimeout * 60),
+                  preemptible_cost=args.preemptible_cost)
+    if args.all:
+        indexes = range(len(result.cost))
+    else:
+        indexes = result.pareto_front()
+    output = {
+        'candidates': len(result.cost),
+        'elapsed_seconds': time.time() - started,
+        'results': [result.describe(i) for i in indexes]
+    }
+    print(json.dumps(output, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
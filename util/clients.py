@@ -0,0 +1,148 @@
+"""Shared Google API clients."""
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+import google_auth_httplib2
+import httplib2
+from google.auth import app_engine
+from googleapiclient import discovery
+
+from util import concurrency, instrumentation, tracing
+
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+# Discovery documents are downloaded by deploy.sh and shipped with the app
+# so building a client never has to fetch them.
+DISCOVERY_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'discovery')
+
+API_VERSIONS = {
+    'compute': 'v1',
+    'dataproc': 'v1',
+    'monitoring': 'v3',
+    'pubsub': 'v1',
+}
+
+# Local emulators, set to host:port to use one instead of the API
+EMULATOR_HOST_VARIABLES = {
+    'pubsub': 'PUBSUB_EMULATOR_HOST',
+}
+
+HTTP_TIMEOUT_SECONDS = 60
+
+_credentials = None
+_documents = {}
+_documents_lock = threading.Lock()
+# httplib2 connections are not thread safe, so every thread keeps its own
+# set of clients. App Engine reuses request threads so they stay warm.
+_local = threading.local()
+
+
+class _ApiHttp(httplib2.Http):
+    """Connection that keeps to the concurrent call limit of its API and
+    counts its requests."""
+
+    def __init__(self, api, **kwargs):
+        super(_ApiHttp, self).__init__(**kwargs)
+        self.api = api
+
+    def request(self, uri, method='GET', *args, **kwargs):
+        with concurrency.api_slot(self.api), tracing.call(
+                self.api, '{} {}'.format(method,
+                                         urlparse(uri).path)) as call:
+            started = time.time()
+            error = True
+            try:
+                response, content = super(_ApiHttp, self).request(
+                    uri, method, *args, **kwargs)
+                error = response.status >= 400
+                call.status = response.status
+                call.bytes_received = len(content or '')
+                return response, content
+            finally:
+                instrumentation.observe('api.' + self.api,
+                                        time.time() - started, error=error)
+
+
+def _get_document(api, version):
+    """
+    Return the parsed bundled discovery document, loading it once.
+
+    :param api: api name
+    :param version: api version
+    :return: dict or None if no document is bundled
+    """
+    key = (api, version)
+    if key not in _documents:
+        with _documents_lock:
+            if key not in _documents:
+                path = os.path.join(DISCOVERY_DIR,
+                                    '{}.{}.json'.format(api, version))
+                try:
+                    with open(path, 'r') as doc_file:
+                        _documents[key] = json.load(doc_file)
+                except IOError:
+                    logging.warning('No bundled discovery document for %s %s',
+                                    api, version)
+                    _documents[key] = None
+    return _documents[key]
+
+
+def _get_credentials():
+    """Create the App Engine credentials on first use, not at import."""
+    global _credentials
+    if _credentials is None:
+        _credentials = app_engine.Credentials(scopes=SCOPES)
+    return _credentials
+
+
+def _get_emulator_url(api):
+    """Return the base URL of the emulator of an API or None."""
+    host = os.environ.get(EMULATOR_HOST_VARIABLES.get(api, ''))
+    if not host:
+        return None
+    return 'http://{}/'.format(host)
+
+
+def _build(api, version):
+    """Build a client over a new authorized connection."""
+    emulator_url = _get_emulator_url(api)
+    if emulator_url is not None:
+        # Emulators don't check credentials
+        http = _ApiHttp(api, timeout=HTTP_TIMEOUT_SECONDS)
+    else:
+        http = google_auth_httplib2.AuthorizedHttp(
+            _get_credentials(),
+            http=_ApiHttp(api, timeout=HTTP_TIMEOUT_SECONDS))
+    document = _get_document(api, version)
+    if document is not None:
+        return discovery.build_from_document(document, base=emulator_url,
+                                             http=http)
+    if emulator_url is not None:
+        return discovery.build(api, version, http=http, cache_discovery=False,
+                               client_options={'api_endpoint': emulator_url})
+    return discovery.build(api, version, http=http, cache_discovery=False)
+
+
+def get_client(api):
+    """
+    Return this thread's client for a Google API, building it on first use.
+
+    :param api: one of API_VERSIONS
+    :return: googleapiclient resource
+    """
+    clients = getattr(_local, 'clients', None)
+    if clients is None:
+        clients = _local.clients = {}
+    client = clients.get(api)
+    if client is None:
+        client = clients[api] = _build(api, API_VERSIONS[api])
+    return client
@@ -0,0 +1,122 @@
+"""Bounded concurrency helpers for threadsafe request handlers."""
+import contextlib
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from util import config, tracing
+
+DEFAULT_API_CONCURRENCY = 8
+
+_api_semaphores = {}
+_api_semaphores_lock = threading.Lock()
+
+
+class ConcurrencyTimeout(Exception):
+    """Raised for work items that didn't finish in time."""
+
+    def __init__(self, value):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
+
+
+def _get_api_semaphore(api):
+    semaphore = _api_semaphores.get(api)
+    if semaphore is None:
+        with _api_semaphores_lock:
+            semaphore = _api_semaphores.get(api)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(
+                    config.API_CONCURRENCY.get(api, DEFAULT_API_CONCURRENCY))
+                _api_semaphores[api] = semaphore
+    return semaphore
+
+
+@contextlib.contextmanager
+def api_slot(api):
+    """Hold one of the concurrent call slots of a Google API."""
+    semaphore = _get_api_semaphore(api)
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def run_bounded(func, items, max_workers, timeout):
+    """
+    Call func for every item using at most max_workers threads.
+
+    An item running longer than timeout seconds is reported with a
+    ConcurrencyTimeout and a new thread takes over the remaining items. The
+    late call is not interrupted, its result is dropped. Every thread is
+    joined before returning since App Engine threads can't outlive the
+    request, so timeout must stay well below the request deadline.
+
+    :param func: called with a single item
+    :param items: list of work items
+    :param max_workers:
+    :param timeout: seconds per item
+    :return: list of (item, result, exception) in the order of items
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = queue.Queue()
+    for index, item in enumerate(items):
+        pending.put(index)
+    started = {}
+    threads = []
+    condition = threading.Condition()
+    trace = tracing.current()
+
+    def _worker():
+        tracing.attach(trace)
+        while True:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            with condition:
+                started[index] = time.time()
+            try:
+                outcome = (items[index], func(items[index]), None)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.exception('Failed processing %s', items[index])
+                outcome = (items[index], None, e)
+            with condition:
+                if results[index] is None:
+                    results[index] = outcome
+                condition.notify()
+                if results[index] is not outcome:
+                    # Timed out, a replacement thread took over
+                    return
+
+    def _start_worker():
+        thread = threading.Thread(target=_worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for _ in range(min(max_workers, len(items))):
+        _start_worker()
+
+    with condition:
+        while None in results:
+            now = time.time()
+            for index, start in started.items():
+                if results[index] is None and now - start > timeout:
+                    results[index] = (items[index], None, ConcurrencyTimeout(
+                        'Timed out after {}s'.format(timeout)))
+                    _start_worker()
+            if None in results:
+                condition.wait(min(1.0, timeout))
+    for thread in threads:
+        thread.join()
+    return results
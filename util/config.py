@@ -0,0 +1,82 @@
+"""Service wide configuration, set through env_variables in app.yaml."""
+import os
+
+# How /tasks/check-load reads the clusters:
+#   cluster - one /monitors task and one clusters().get per cluster
+#   region - one /monitors/region task and one clusters().list per region
+#   batch - one /monitors/batch task per MONITORING_BATCH_SIZE clusters that
+#           reads them concurrently
+#   adaptive - a chain of /monitors/poll tasks per cluster, each polling
+#              again after POLL_MIN_SECONDS to POLL_MAX_SECONDS depending on
+#              how busy the cluster is. /tasks/check-load only restarts the
+#              chains that stopped.
+MONITORING_MODE = os.environ.get('SHAMASH_MONITORING_MODE', 'cluster')
+
+# adaptive mode: shortest and longest interval between polls of a cluster
+POLL_MIN_SECONDS = int(os.environ.get('SHAMASH_POLL_MIN_SECONDS', '15'))
+POLL_MAX_SECONDS = int(os.environ.get('SHAMASH_POLL_MAX_SECONDS', '300'))
+
+# How monitoring data reaches the scaling decision:
+#   pubsub - published to shamash-monitoring, decided by /get_monitoring_data,
+#            published to shamash-scaling and sized by /scale
+#   direct - decided and sized by the monitoring task itself, which enqueues
+#            /patch. With PIPELINE_FANOUT the data is still published to
+#            shamash-monitoring for other consumers.
+PIPELINE_MODE = os.environ.get('SHAMASH_PIPELINE_MODE', 'pubsub')
+PIPELINE_FANOUT = os.environ.get(
+    'SHAMASH_PIPELINE_FANOUT', 'false').lower() == 'true'
+
+# How the monitoring and scaling subscriptions are consumed:
+#   push - Pub/Sub pushes every message to /get_monitoring_data and /scale
+#   pull - the shamash-worker service (worker.yaml) pulls them in batches
+CONSUMER_MODE = os.environ.get('SHAMASH_CONSUMER_MODE', 'push')
+# pull mode: messages of a subscription pulled and not acknowledged yet at
+# any time, and threads handling them
+PULL_MAX_OUTSTANDING_MESSAGES = int(
+    os.environ.get('SHAMASH_PULL_MAX_OUTSTANDING_MESSAGES', '100'))
+PULL_THREADS = int(os.environ.get('SHAMASH_PULL_THREADS', '10'))
+
+# Share the per cluster time series cache between instances through memcache
+TIMESERIES_CACHE_MEMCACHE = os.environ.get(
+    'SHAMASH_TIMESERIES_CACHE_MEMCACHE', 'true').lower() == 'true'
+
+# batch mode of /tasks/check-load: clusters per /monitors/batch task and how
+# many of them a task monitors at the same time
+MONITORING_BATCH_SIZE = int(
+    os.environ.get('SHAMASH_MONITORING_BATCH_SIZE', '25'))
+MONITORING_CONCURRENCY = int(
+    os.environ.get('SHAMASH_MONITORING_CONCURRENCY', '10'))
+# Clusters that take longer are reported as failed and the others go on
+# without them. Their calls still finish before the request does, so keep
+# this well below the request deadline (60s for /preview).
+CLUSTER_TIMEOUT_SECONDS = float(
+    os.environ.get('SHAMASH_CLUSTER_TIMEOUT_SECONDS', '30'))
+
+# Max concurrent calls per Google API and instance, e.g. "dataproc:8,pubsub:4"
+API_CONCURRENCY = dict(
+    (api.strip(), int(limit)) for api, limit in (
+        item.split(':') for item in os.environ.get(
+            'SHAMASH_API_CONCURRENCY',
+            'compute:4,dataproc:8,monitoring:8,pubsub:8').split(',')))
+
+# Write the latency, call and error counts of the instrumented stages to
+# Stackdriver this often per instance, 0 to only serve them on /metrics
+INSTRUMENTATION_FLUSH_SECONDS = float(
+    os.environ.get('SHAMASH_INSTRUMENTATION_FLUSH_SECONDS', '0'))
+
+# Budget per handler: the outbound calls per item handled and seconds a
+# request should take at most, "handler:calls:seconds,...". The pull worker
+# traces its messages as worker_<subscription>. Traces over budget are
+# logged as warnings.
+HANDLER_BUDGETS = dict(
+    (handler.strip(), (int(calls), float(seconds)))
+    for handler, calls, seconds in (
+        item.split(':') for item in os.environ.get(
+            'SHAMASH_HANDLER_BUDGETS',
+            'monitors:4:10,monitors_poll:6:10,get_monitoring_data:8:20,'
+            'scale:6:10,patch:4:10,patch_poll:4:10,worker_monitoring:8:20,'
+            'worker_scaling:6:10').split(',')))
+
+# /scale drops scaling messages whose cluster snapshot is older than this
+SCALING_MESSAGE_MAX_AGE_SECONDS = float(
+    os.environ.get('SHAMASH_SCALING_MESSAGE_MAX_AGE_SECONDS', '300'))
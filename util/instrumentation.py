@@ -0,0 +1,219 @@
+"""Latency, call, retry and error counts of the scaling hot path.
+
+The counts are kept per instance. Stages are timed per cluster with timed()
+or instrumented(), every Google API request is counted per API by
+clients._ApiHttp and the backoff decorators count their retries with
+count_retries(), which also counts them in the trace of the request.
+/metrics serves them in the Prometheus text format and flush() writes what
+changed since the last flush to Stackdriver, labeled with the instance.
+"""
+import contextlib
+import functools
+import os
+import threading
+import time
+
+from util import tracing
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Every instance writes its own series so they don't overwrite each other
+INSTANCE_ID = os.environ.get('INSTANCE_ID', 'local')
+
+_lock = threading.Lock()
+# (stage, cluster) to _Histogram
+_stages = {}
+# stage to number of retries
+_retries = {}
+# (stage, cluster) to (count, errors, total) at the last flush
+_flushed = {}
+_last_flush = time.time()
+
+
+class _Histogram(object):
+    """Calls, errors and latency distribution of a stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds, error):
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+
+def observe(stage, seconds, cluster=None, error=False):
+    """
+    Record a call of a stage.
+
+    :param stage: e.g. dataproc.get_cluster
+    :param seconds: how long it took
+    :param cluster: cluster name the call was for, if any
+    :param error: whether it failed
+    """
+    key = (stage, cluster)
+    with _lock:
+        histogram = _stages.get(key)
+        if histogram is None:
+            histogram = _stages[key] = _Histogram()
+        histogram.observe(seconds, error)
+
+
+@contextlib.contextmanager
+def timed(stage, cluster=None):
+    """Time the block as a call of stage, an exception counts as an
+    error."""
+    started = time.time()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        observe(stage, time.time() - started, cluster, error)
+
+
+def instrumented(stage, cluster_attribute=None):
+    """
+    Decorate a function to time its calls as a stage.
+
+    :param cluster_attribute: for methods, the attribute of self holding the
+    cluster name
+    """
+
+    def _decorator(func):
+
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            cluster = None
+            if cluster_attribute is not None:
+                cluster = getattr(args[0], cluster_attribute, None)
+            with timed(stage, cluster):
+                return func(*args, **kwargs)
+
+        return _wrapper
+
+    return _decorator
+
+
+def count_retries(stage):
+    """
+    Return a backoff on_backoff handler counting the retries of a stage.
+
+    :param stage: usually the API method that is retried
+    """
+
+    def _on_backoff(details):
+        with _lock:
+            _retries[stage] = _retries.get(stage, 0) + 1
+        tracing.record_retry(stage)
+
+    return _on_backoff
+
+
+def _labels(**labels):
+    items = []
+    for name, value in sorted(labels.items()):
+        if value is None:
+            continue
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+        items.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(items) + '}'
+
+
+def render():
+    """
+    Format the counts of this instance for Prometheus.
+
+    :return: text exposition format
+    """
+    with _lock:
+        stages = sorted((key, (histogram.count, histogram.errors,
+                               histogram.total, list(histogram.buckets)))
+                        for key, histogram in _stages.items())
+        retries = sorted(_retries.items())
+    lines = [
+        '# HELP shamash_stage_seconds Latency of the scaling stages and API '
+        'requests.',
+        '# TYPE shamash_stage_seconds histogram'
+    ]
+    for (stage, cluster), (count, _, total, buckets) in stages:
+        cumulative = 0
+        for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+            cumulative += bucket
+            lines.append('shamash_stage_seconds_bucket{} {}'.format(
+                _labels(stage=stage, cluster=cluster, le=repr(bound)),
+                cumulative))
+        lines.append('shamash_stage_seconds_bucket{} {}'.format(
+            _labels(stage=stage, cluster=cluster, le='+Inf'), count))
+        lines.append('shamash_stage_seconds_sum{} {!r}'.format(
+            _labels(stage=stage, cluster=cluster), total))
+        lines.append('shamash_stage_seconds_count{} {}'.format(
+            _labels(stage=stage, cluster=cluster), count))
+    lines.extend([
+        '# HELP shamash_stage_errors_total Failed calls of the scaling '
+        'stages and API requests.',
+        '# TYPE shamash_stage_errors_total counter'
+    ])
+    for (stage, cluster), (_, errors, _, _) in stages:
+        lines.append('shamash_stage_errors_total{} {}'.format(
+            _labels(stage=stage, cluster=cluster), errors))
+    lines.extend([
+        '# HELP shamash_retries_total Retries by the backoff decorators.',
+        '# TYPE shamash_retries_total counter'
+    ])
+    for stage, count in retries:
+        lines.append('shamash_retries_total{} {}'.format(
+            _labels(stage=stage), count))
+    return '\n'.join(lines) + '\n'
+
+
+def flush_due(interval_seconds):
+    """Whether the last flush of this instance is interval_seconds old."""
+    return interval_seconds > 0 and \
+        time.time() - _last_flush >= interval_seconds
+
+
+def flush(batch):
+    """
+    Write the calls, errors and mean latency of every stage since the last
+    flush as StageCalls, StageErrors and StageLatencySeconds of this
+    instance.
+
+    :param batch: metrics.TimeSeriesBatch to write the points with
+    :return: what batch.flush() returned
+    """
+    global _last_flush
+    with _lock:
+        _last_flush = time.time()
+        changes = []
+        for key, histogram in _stages.items():
+            count, errors, total = _flushed.get(key, (0, 0, 0.0))
+            if histogram.count == count:
+                continue
+            changes.append((key, histogram.count - count,
+                            histogram.errors - errors,
+                            histogram.total - total))
+            _flushed[key] = (histogram.count, histogram.errors,
+                             histogram.total)
+    for (stage, cluster), count, errors, total in changes:
+        labels = {'stage': stage, 'instance': INSTANCE_ID}
+        batch.add(cluster or '', 'StageCalls', count, labels=labels)
+        batch.add(cluster or '', 'StageErrors', errors, labels=labels)
+        batch.add(cluster or '', 'StageLatencySeconds', total / count,
+                  labels=labels)
+    return batch.flush()
@@ -1,18 +1,26 @@
 """Interact with pub/sub."""
+import base64
+import json
 import logging
 
 import backoff
-from google.auth import app_engine
-from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 
-from util import utils
+from util import clients, instrumentation, utils
 
-PUBSUB_SCOPES = [
-    'https://www.googleapis.com/auth/pubsub',
-    'https://www.googleapis.com/auth/cloud-platform'
-]
-CREDENTIALS = app_engine.Credentials(scopes=PUBSUB_SCOPES)
+# topics.publish accepts at most 1000 messages per call
+MAX_MESSAGES_PER_PUBLISH = 1000
+# and at most 10MB, leave room for the rest of the request
+MAX_BYTES_PER_PUBLISH = 9 * 1000 * 1000
+# subscriptions.pull returns at most 1000 messages per call
+MAX_MESSAGES_PER_PULL = 1000
+# subscriptions.acknowledge and modifyAckDeadline ids per call
+MAX_ACK_IDS_PER_REQUEST = 1000
+# Subscriptions give this long to handle a message, existing ones are
+# updated when provisioning
+ACK_DEADLINE_SECONDS = 60
+# Items Publisher packs into a single message, a push delivers them together
+MAX_ITEMS_PER_MESSAGE = 100
 
 
 class PubSubException(Exception):
@@ -27,30 +35,122 @@ class PubSubException(Exception):
 
 def get_pubsub_client():
     """Get a pubsub client from the API."""
-    return discovery.build('pubsub', 'v1', credentials=CREDENTIALS)
+    return clients.get_client('pubsub')
 
 
+@instrumentation.instrumented('pubsub.publish')
 def publish(client, body, topic):
-    """Publish a message to a Pub/Sub topic."""
+    """
+    Publish messages to a Pub/Sub topic.
+
+    :return: ids of the published messages
+    """
     project = 'projects/{}'.format(utils.get_project_id())
     dest_topic = project + '/topics/' + topic
 
     @backoff.on_exception(
-        backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
+        backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code,
+        on_backoff=instrumentation.count_retries('pubsub.topics.publish'))
     def _do_request():
-        client.projects().topics().publish(
+        return client.projects().topics().publish(
             topic=dest_topic, body=body).execute()
 
     try:
-        _do_request()
+        response = _do_request()
     except HttpError as e:
         logging.error(e)
         raise PubSubException(e)
+    return response.get('messageIds', [])
+
+
+def decode_items(payload):
+    """
+    Decode the data of a message published by Publisher.
+
+    :param payload: base64 encoded data of a Pub/Sub message
+    :return: list of the items, a message holding a single object (as
+    published before Publisher) is a list of one
+    """
+    data = json.loads(base64.b64decode(payload))
+    if isinstance(data, list):
+        return data
+    return [data]
+
+
+class Publisher(object):
+    """Collect items for a topic and publish them with as few
+    topics.publish calls as possible.
+
+    Up to items_per_message JSON serializable items are packed into a
+    message, read them back with decode_items.
+    """
+
+    def __init__(self, topic, client=None,
+                 items_per_message=MAX_ITEMS_PER_MESSAGE):
+        self.topic = topic
+        self.client = client
+        self.items_per_message = items_per_message
+        self.items = []
+        self.message_ids = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        """Queue an item."""
+        self.items.append(item)
+
+    def _requests(self):
+        """Split the queued items into messages and the messages into
+        valid topics.publish bodies."""
+        requests = []
+        messages, items, size = [], [], 0
+        step = self.items_per_message
+        for i in range(0, len(self.items), step):
+            chunk = self.items[i:i + step]
+            message = {'data': base64.b64encode(json.dumps(chunk))}
+            if messages and (len(messages) == MAX_MESSAGES_PER_PUBLISH or
+                             size + len(message['data']) >
+                             MAX_BYTES_PER_PUBLISH):
+                requests.append((messages, items))
+                messages, items, size = [], [], 0
+            messages.append(message)
+            items.extend(chunk)
+            size += len(message['data'])
+        if messages:
+            requests.append((messages, items))
+        return requests
+
+    def flush(self):
+        """
+        Publish all queued items. The ids of the messages are added to
+        message_ids.
+
+        :return: list of dicts with the items and error of every call that
+        failed, empty if all succeeded
+        """
+        if not self.items:
+            return []
+        client = self.client or get_pubsub_client()
+        failures = []
+        for messages, items in self._requests():
+            try:
+                self.message_ids.extend(
+                    publish(client, {'messages': messages}, self.topic))
+            except PubSubException as e:
+                failures.append({'items': items, 'error': e})
+        self.items = []
+        for failure in failures:
+            logging.error('Failed publishing %s items to %s: %s',
+                          len(failure['items']), self.topic,
+                          failure['error'])
+        return failures
 
 
 def create_subscriptions(client, sub, topic):
     """
-    Create a subscription in pub/sub.
+    Create a subscription in pub/sub, or set the ack deadline of an
+    existing one to ACK_DEADLINE_SECONDS.
 
     :param client:
     :param sub:
@@ -60,7 +160,7 @@ def create_subscriptions(client, sub, topic):
     project = 'projects/{}'.format(utils.get_project_id())
     dest_sub = project + '/subscriptions/' + sub
     dest_topic = project + '/topics/' + topic
-    body = {'topic': dest_topic}
+    body = {'topic': dest_topic, 'ackDeadlineSeconds': ACK_DEADLINE_SECONDS}
 
     @backoff.on_exception(
         backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
@@ -74,14 +174,39 @@ def create_subscriptions(client, sub, topic):
         client.projects().subscriptions().create(
             name=dest_sub, body=body).execute()
 
+    @backoff.on_exception(
+        backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
+    def _do_patch_request():
+        client.projects().subscriptions().patch(
+            name=dest_sub,
+            body={
+                'subscription': {
+                    'ackDeadlineSeconds': ACK_DEADLINE_SECONDS
+                },
+                'updateMask': 'ackDeadlineSeconds'
+            }).execute()
+
     try:
-        _do_get_request()
+        existing = _do_get_request()
     except HttpError as e:
-        if e.resp.status == 404:
+        if e.resp.status != 404:
+            logging.error(e)
+            raise PubSubException(e)
+        try:
             _do_create_request()
-        else:
+        except HttpError as e:
             logging.error(e)
             raise PubSubException(e)
+        return
+    if existing.get('ackDeadlineSeconds') == ACK_DEADLINE_SECONDS:
+        return
+    logging.info('Setting the ack deadline of %s from %s to %ss', sub,
+                 existing.get('ackDeadlineSeconds'), ACK_DEADLINE_SECONDS)
+    try:
+        _do_patch_request()
+    except HttpError as e:
+        logging.error(e)
+        raise PubSubException(e)
 
 
 def create_topic(client, topic):
@@ -108,9 +233,12 @@ def create_topic(client, topic):
     try:
         _do_get_request()
     except HttpError as e:
-        if e.resp.status == 404:
+        if e.resp.status != 404:
+            logging.error(e)
+            raise PubSubException(e)
+        try:
             _do_create_request()
-        else:
+        except HttpError as e:
             logging.error(e)
             raise PubSubException(e)
 
@@ -126,9 +254,15 @@ def get_full_subscription_name(project, subscription):
 
 
 def pull(client, sub, endpoint):
-    """Register a listener endpoint."""
+    """
+    Register a listener endpoint.
+
+    :param endpoint: push endpoint URL, None to make it a pull subscription
+    """
     subscription = get_full_subscription_name(utils.get_project_id(), sub)
-    body = {'pushConfig': {'pushEndpoint': endpoint}}
+    body = {'pushConfig': {}}
+    if endpoint is not None:
+        body['pushConfig']['pushEndpoint'] = endpoint
 
     @backoff.on_exception(
         backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
@@ -139,7 +273,71 @@ def pull(client, sub, endpoint):
     try:
         _do_request()
     except HttpError as e:
-
         logging.error(e)
-        return 'Error', 500
+        raise PubSubException(e)
     return 'ok, 204'
+
+
+def pull_messages(client, sub, max_messages):
+    """
+    Pull messages from a subscription, waiting for some to arrive.
+
+    :param max_messages: at most this many messages are returned
+    :return: list of received messages with ackId and message
+    """
+    subscription = get_full_subscription_name(utils.get_project_id(), sub)
+    body = {'maxMessages': max_messages}
+
+    @backoff.on_exception(
+        backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
+    def _do_request():
+        return client.projects().subscriptions().pull(
+            subscription=subscription, body=body).execute()
+
+    try:
+        response = _do_request()
+    except HttpError as e:
+        logging.error(e)
+        raise PubSubException(e)
+    return response.get('receivedMessages', [])
+
+
+def acknowledge(client, sub, ack_ids):
+    """Acknowledge messages pulled from a subscription."""
+    subscription = get_full_subscription_name(utils.get_project_id(), sub)
+
+    @backoff.on_exception(
+        backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
+    def _do_request(ids):
+        client.projects().subscriptions().acknowledge(
+            subscription=subscription, body={'ackIds': ids}).execute()
+
+    try:
+        for i in range(0, len(ack_ids), MAX_ACK_IDS_PER_REQUEST):
+            _do_request(ack_ids[i:i + MAX_ACK_IDS_PER_REQUEST])
+    except HttpError as e:
+        logging.error(e)
+        raise PubSubException(e)
+
+
+def modify_ack_deadline(client, sub, ack_ids, seconds):
+    """
+    Change how long pulled messages have before they are delivered again.
+
+    :param seconds: from now, 0 makes them available again right away
+    """
+    subscription = get_full_subscription_name(utils.get_project_id(), sub)
+
+    @backoff.on_exception(
+        backoff.expo, HttpError, max_tries=3, giveup=utils.fatal_code)
+    def _do_request(ids):
+        client.projects().subscriptions().modifyAckDeadline(
+            subscription=subscription,
+            body={'ackIds': ids, 'ackDeadlineSeconds': seconds}).execute()
+
+    try:
+        for i in range(0, len(ack_ids), MAX_ACK_IDS_PER_REQUEST):
+            _do_request(ack_ids[i:i + MAX_ACK_IDS_PER_REQUEST])
+    except HttpError as e:
+        logging.error(e)
+        raise PubSubException(e)
@@ -0,0 +1,184 @@
+"""Request scoped record of the outbound calls.
+
+Every handler runs in a trace. Google API requests register with it from
+clients._ApiHttp, the Datastore settings queries from model.settings and the
+retries of the backoff decorators through instrumentation.count_retries. At
+the end of the handler a JSON summary is logged, as a warning if the handler
+went over its budget in config.HANDLER_BUDGETS. Handlers of batched messages
+set how many items they handled, the call budget is per item.
+"""
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from util import config
+
+# Slowest calls listed in the summary
+SLOWEST_CALLS = 5
+
+_local = threading.local()
+
+
+class Call(object):
+    """An outbound call of a trace."""
+
+    def __init__(self, api, method):
+        self.api = api
+        self.method = method
+        self.elapsed = None
+        self.status = None
+        self.bytes_received = 0
+
+    def to_dict(self):
+        return {
+            'api': self.api,
+            'method': self.method,
+            'ms': int(self.elapsed * 1000),
+            'status': self.status,
+            'bytes': self.bytes_received
+        }
+
+
+class Trace(object):
+    """The outbound calls and retries of a handler."""
+
+    def __init__(self, handler, **labels):
+        self.handler = handler
+        self.labels = labels
+        self.started = time.time()
+        self.calls = []
+        self.retries = {}
+        self.items = 1
+        self._lock = threading.Lock()
+
+    def add_call(self, call_record):
+        with self._lock:
+            self.calls.append(call_record)
+
+    def add_retry(self, stage):
+        with self._lock:
+            self.retries[stage] = self.retries.get(stage, 0) + 1
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def summary(self):
+        """
+        Totals per API and the slowest calls.
+
+        :return: dict
+        """
+        with self._lock:
+            calls = list(self.calls)
+            retries = dict(self.retries)
+        apis = {}
+        for call_record in calls:
+            api = apis.setdefault(call_record.api,
+                                  {'calls': 0, 'ms': 0, 'bytes': 0})
+            api['calls'] += 1
+            api['ms'] += int(call_record.elapsed * 1000)
+            api['bytes'] += call_record.bytes_received
+        slowest = sorted(calls, key=lambda c: c.elapsed, reverse=True)
+        summary = {
+            'handler': self.handler,
+            'ms': int(self.elapsed * 1000),
+            'calls': len(calls),
+            'items': self.items,
+            'bytes': sum(c.bytes_received for c in calls),
+            'retries': retries,
+            'apis': apis,
+            'slowest': [c.to_dict() for c in slowest[:SLOWEST_CALLS]]
+        }
+        summary.update(self.labels)
+        return summary
+
+
+def start(handler, **labels):
+    """
+    Start the trace of a handler on this thread.
+
+    :param handler: name of the handler, the key of its budget
+    :param labels: added to the summary, e.g. cluster=name
+    :return: Trace
+    """
+    trace = Trace(handler, **labels)
+    _local.trace = trace
+    return trace
+
+
+def current():
+    """Return the trace of this thread or None."""
+    return getattr(_local, 'trace', None)
+
+
+def attach(trace):
+    """Make a thread working for a handler register with its trace."""
+    _local.trace = trace
+
+
+def set_items(count):
+    """Set how many items, e.g. clusters of a message, the handler of this
+    thread handles."""
+    trace = current()
+    if trace is not None:
+        trace.items = max(1, count)
+
+
+def finish(**labels):
+    """
+    End the trace of this thread and log its summary.
+
+    :param labels: added to the summary, e.g. status=200
+    :return: the summary or None if there was no trace
+    """
+    trace = current()
+    if trace is None:
+        return None
+    _local.trace = None
+    summary = trace.summary()
+    summary.update(labels)
+    over = []
+    budget = config.HANDLER_BUDGETS.get(trace.handler)
+    if budget is not None:
+        max_calls, max_seconds = budget
+        max_calls *= trace.items
+        if summary['calls'] > max_calls:
+            over.append('{} calls > {}'.format(summary['calls'], max_calls))
+        if summary['ms'] > max_seconds * 1000:
+            over.append('{}ms > {}s'.format(summary['ms'], max_seconds))
+    if over:
+        logging.warning('Trace over budget (%s) %s', ', '.join(over),
+                        json.dumps(summary, sort_keys=True))
+    else:
+        logging.info('Trace %s', json.dumps(summary, sort_keys=True))
+    return summary
+
+
+@contextlib.contextmanager
+def call(api, method):
+    """
+    Register the block as an outbound call with the trace of this thread.
+
+    :param api: e.g. dataproc
+    :param method: what was called
+    :return: the Call, to set its status and bytes_received
+    """
+    trace = current()
+    call_record = Call(api, method)
+    started = time.time()
+    try:
+        yield call_record
+    finally:
+        call_record.elapsed = time.time() - started
+        if trace is not None:
+            trace.add_call(call_record)
+
+
+def record_retry(stage):
+    """Count a retry with the trace of this thread."""
+    trace = current()
+    if trace is not None:
+        trace.add_retry(stage)
@@ -3,8 +3,9 @@ from collections import OrderedDict
 
 import flask_admin
 from flask_admin.contrib import appengine
-from wtforms import validators
+from wtforms import SelectField, validators
 
+from model import settings
 from view.validators import GreaterEqualThan, SmallerEqualThan
 
 
@@ -122,6 +123,33 @@ class AdminCustomView(flask_admin.contrib.appengine.view.NdbModelView):
             'description': 'Graceful Decommission Timeout in minutes',
             'validators': [validators.NumberRange(0, 1440),]
         },
+        'PredictiveScaling': {
+            'label': 'Predictive scale out',
+            'description':
+            'Scale out ahead of time when the daily pattern of the cluster '
+            'forecasts a memory shortage'
+        },
+        'ProvisioningLeadMinutes': {
+            'label': 'Provisioning lead time',
+            'description':
+            'Minutes it takes new nodes to join the cluster, how far ahead '
+            'predictive scale out looks',
+            'validators': [validators.NumberRange(1, 120)]
+        },
+        'CooldownMinutes': {
+            'label': 'Cooldown',
+            'description':
+            'Minutes to wait after a resize before the next one, decisions '
+            'made meanwhile replace each other',
+            'validators': [validators.NumberRange(0, 120)]
+        },
+        'StabilizationMinutes': {
+            'label': 'Stabilization window',
+            'description':
+            'Minutes after a resize during which scaling the other way is '
+            'ignored',
+            'validators': [validators.NumberRange(0, 120)]
+        },
     })
 
     column_list = ([key for key in column_dic])
@@ -139,3 +167,20 @@ class AdminCustomView(flask_admin.contrib.appengine.view.NdbModelView):
     create_template = 'create.html'
 
     form_args = column_dic
+    form_excluded_columns = ('Version',)
+
+    # The regions are read when a form is shown rather than at import
+    form_overrides = {'Region': SelectField}
+
+    def _set_region_choices(self, form):
+        form.Region.choices = [(region, region)
+                               for region in settings.get_regions()]
+        return form
+
+    def create_form(self, obj=None):
+        return self._set_region_choices(
+            super(AdminCustomView, self).create_form(obj))
+
+    def edit_form(self, obj=None):
+        return self._set_region_choices(
+            super(AdminCustomView, self).edit_form(obj))
@@ -0,0 +1,41 @@
+"""Dashboard view."""
+import flask_admin
+from flask import jsonify, request
+
+from model import settings
+from monitoring import charts
+
+MIN_CHART_WIDTH = 50
+MAX_CHART_WIDTH = 2000
+
+
+class DashboardView(flask_admin.BaseView):
+    """Charts of the metrics Shamash keeps for every cluster."""
+
+    @flask_admin.expose('/')
+    def index(self):
+        clusters = sorted(cluster.Cluster
+                          for cluster in settings.get_all_clusters_settings())
+        return self.render(
+            'dashboard.html',
+            clusters=clusters,
+            chart_metrics=charts.CHART_METRICS,
+            windows=sorted(charts.CHART_WINDOWS,
+                           key=charts.CHART_WINDOWS.get))
+
+    @flask_admin.expose('/data')
+    def data(self):
+        """Downsampled points of a cluster metric as JSON."""
+        custom_metric_type = request.args.get('metric')
+        window = request.args.get('window', '1d')
+        if custom_metric_type not in charts.CHART_METRICS or \
+                window not in charts.CHART_WINDOWS:
+            return jsonify({'error': 'Unknown metric or window'}), 400
+        try:
+            width = int(request.args.get('width', 800))
+        except ValueError:
+            return jsonify({'error': 'Bad width'}), 400
+        width = min(MAX_CHART_WIDTH, max(MIN_CHART_WIDTH, width))
+        return jsonify(
+            charts.get_chart_data(request.args.get('cluster_name'),
+                                  custom_metric_type, window, width))